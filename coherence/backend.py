@@ -6,6 +6,9 @@
 # Copyright 2007,, Frank Scholz <coherence@beebits.net>
 
 import time
+import bisect
+from functools import cmp_to_key
+
 from coherence.extern.simple_plugin import Plugin
 
 from coherence import log
@@ -15,6 +18,7 @@ import coherence.extern.louie as louie
 from coherence.upnp.core.utils import getPage
 from coherence.extern.et import parse_xml
 from coherence.upnp.core import DIDLLite
+from coherence.upnp.core import search
 from twisted.internet import defer,reactor
 
 class Backend(log.Loggable,Plugin):
@@ -83,6 +87,21 @@ class BackendStore(Backend):
 
     logCategory = 'backend_store'
 
+    """ set to True if the DIDL-Lite objects returned by get_item
+        are kept around and are only changed together with
+        an increase of the item's or the store's update_id,
+        the ContentDirectoryServer will then cache their
+        serialized form
+    """
+    cache_didl_fragments = False
+
+    """ the SearchCriteria properties we keep an index for,
+        when the store has called create_search_indexes()
+    """
+    search_properties = ('dc:title', 'upnp:artist', 'upnp:album',
+                         'upnp:genre', 'upnp:class')
+    search_indexes = None
+
     def __init__(self,server,*args,**kwargs):
         """ the init method for a MediaServer backend,
             should probably most of the time be overwritten
@@ -132,6 +151,94 @@ class BackendStore(Backend):
         pass
 
 
+    def create_search_indexes(self):
+        """ for a store that has all of its items at hand,
+            lets search() answer from in-memory indexes
+
+            the store has to call index_item() when it adds or
+            changes an item, and unindex_item() when it removes one
+        """
+        self.search_indexes = search.SearchIndexes(self.search_properties)
+
+    def index_item(self, id):
+        if self.search_indexes is not None:
+            self.search_indexes.add(id)
+
+    def unindex_item(self, id):
+        if self.search_indexes is not None:
+            self.search_indexes.remove(id)
+
+    def get_search_values(self, item, property):
+        """ returns the list of values the SearchCriteria
+            property has for a BackendItem, by default taken
+            from its DIDL-Lite object
+
+            a store knowing them without the DIDL-Lite object
+            may want to overwrite this
+        """
+        obj = item.get_item()
+        if obj is None or isinstance(obj, defer.Deferred):
+            return []
+        return search.get_values(obj, property)
+
+    def search(self, container, expression, start=0, request_count=0):
+        """ called by the CDS for a Search action,
+            with the parsed SearchCriteria as expression
+
+            returns the BackendItems below container that match,
+            in the order they were indexed, as an (items, total)
+            tuple, with items sliced like in get_children
+
+            returns None when we don't have search indexes
+        """
+        indexes = self.search_indexes
+        if indexes is None:
+            return None
+
+        def get_values(id, property):
+            item = self.get_by_id(id)
+            if item is None:
+                return []
+            return self.get_search_values(item, property)
+        indexes.update(get_values)
+
+        ids, exact = expression.candidates(indexes)
+        if ids is None:
+            ids = indexes.ids
+        ids = indexes.sorted(ids)
+
+        container_id = container.get_id()
+        if exact and getattr(container, 'parent', None) is None:
+            # below the root everything matches, we just
+            # need the items we are going to return
+            ids = [id for id in ids if id != container_id]
+            if request_count == 0:
+                page = ids[start:]
+            else:
+                page = ids[start:start+request_count]
+            return [self.get_by_id(id) for id in page], len(ids)
+
+        items = []
+        for id in ids:
+            item = self.get_by_id(id)
+            if item is None or id == container_id:
+                continue
+            # is it below the container?
+            parent = getattr(item, 'parent', None)
+            while parent is not None and parent is not container:
+                parent = getattr(parent, 'parent', None)
+            if parent is None and getattr(container, 'parent', None) is not None:
+                continue
+            if not exact:
+                def item_values(property):
+                    return self.get_search_values(item, property)
+                if not expression.match(item_values):
+                    continue
+            items.append(item)
+        if request_count == 0:
+            return items[start:], len(items)
+        return items[start:start+request_count], len(items)
+
     def _get_all_items(self,id):
         """ a helper method to get all items as a response
             to some XBox 360 UPnP Search action
@@ -316,6 +423,186 @@ class BackendRssMixin:
         from twisted.internet import reactor
         reactor.callLater(self.refresh, self.update_data,rss_url,container)
 
+class _Reversed(object):
+    """ a sort key that sorts the other way round """
+
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __ne__(self, other):
+        return self.key != other.key
+
+
+class SortedChildren(object):
+    """ the children of a container, kept in sort order
+
+        the sort key of a child is computed once, when it is
+        added, and the child is inserted at its place, so adding
+        or removing a child doesn't make us sort all of them
+        again with the next Browse, a child whose sort key has
+        changed since, e.g. by a new title, has to be passed to
+        update() to get to its new place
+
+        with an index function the children are indexed by the
+        value it returns for them too, like their path or name,
+        for a lookup without going through all of them
+
+        apart from that it has the methods of a list, but the
+        order is always the one of the sort key, so insert() and
+        item assignment put a child at its sort position, and
+        sort() makes what it sorts by the new sort key
+    """
+
+    def __init__(self, key, index=None):
+        self._key = key
+        self._index = index
+        self._keys = []
+        self._children = []
+        self._by_index = {}
+
+    def set_key(self, key):
+        """ changes the sort key and sorts the children again """
+        self._key = key
+        keys = [key(child) for child in self._children]
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        self._keys = [keys[i] for i in order]
+        self._children = [self._children[i] for i in order]
+
+    def sort(self, cmp=None, key=None, reverse=False):
+        """ like list.sort, the children stay in that order """
+        if key is None:
+            key = lambda child: child
+        if cmp is not None:
+            cmp_key = cmp_to_key(cmp)
+            by_key = key
+            key = lambda child: cmp_key(by_key(child))
+        if reverse:
+            forward = key
+            key = lambda child: _Reversed(forward(child))
+        self.set_key(key)
+
+    def append(self, child):
+        key = self._key(child)
+        # insert after the ones with an equal key, as a
+        # stable sort of the appended children would do
+        i = bisect.bisect_right(self._keys, key)
+        self._keys.insert(i, key)
+        self._children.insert(i, child)
+        if self._index is not None:
+            self._by_index[self._index(child)] = child
+
+    def extend(self, children):
+        for child in children:
+            self.append(child)
+
+    def insert(self, position, child):
+        """ the position is ignored, child goes where its key belongs """
+        self.append(child)
+
+    def remove(self, child):
+        i = self._position(child)
+        if i is None:
+            raise ValueError("SortedChildren.remove(x): x not in children")
+        self._remove_at(i)
+
+    def _remove_at(self, i):
+        child = self._children[i]
+        del self._keys[i]
+        del self._children[i]
+        if self._index is not None:
+            value = self._index(child)
+            if self._by_index.get(value) is child:
+                del self._by_index[value]
+        return child
+
+    def pop(self, i=-1):
+        if len(self._children) == 0:
+            raise IndexError("pop from empty SortedChildren")
+        return self._remove_at(i)
+
+    def update(self, child):
+        """ child has a new sort key, or index value,
+            and moves to its new place
+        """
+        i = self._position(child)
+        if i is None:
+            raise ValueError("SortedChildren.update(x): x not in children")
+        del self._keys[i]
+        del self._children[i]
+        if self._index is not None:
+            for value, c in self._by_index.items():
+                if c is child:
+                    del self._by_index[value]
+        self.append(child)
+
+    def get(self, value, default=None):
+        """ returns the child the index function returned value for """
+        return self._by_index.get(value, default)
+
+    def index(self, child):
+        i = self._position(child)
+        if i is None:
+            raise ValueError("SortedChildren.index(x): x not in children")
+        return i
+
+    def count(self, child):
+        return len([c for c in self._children if c is child])
+
+    def _position(self, child):
+        key = self._key(child)
+        i = bisect.bisect_left(self._keys, key)
+        while i < len(self._keys) and self._keys[i] == key:
+            if self._children[i] is child:
+                return i
+            i += 1
+        # the key of the child has changed since it was added
+        for i, c in enumerate(self._children):
+            if c is child:
+                return i
+        return None
+
+    def __contains__(self, child):
+        return self._position(child) is not None
+
+    def __len__(self):
+        return len(self._children)
+
+    def __iter__(self):
+        return iter(self._children)
+
+    def __getitem__(self, index):
+        return self._children[index]
+
+    def __setitem__(self, index, child):
+        """ replaces the child at index, the new
+            one goes to its own sort position
+        """
+        if isinstance(index, slice):
+            del self[index]
+            self.extend(child)
+            return
+        self._remove_at(index)
+        self.append(child)
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            for i in sorted(range(*index.indices(len(self._children))), reverse=True):
+                self._remove_at(i)
+            return
+        self._remove_at(index)
+
+    def __repr__(self):
+        return repr(self._children)
+
+
 class Container(BackendItem):
 
     def __init__(self, parent, title):
@@ -333,7 +620,11 @@ class Container(BackendItem):
         self.name = title
         self.mimetype = 'directory'
 
-        self.children = []
+        def childs_sort(x,y):
+            return cmp(x.name,y.name)
+        self._sorting_method = childs_sort
+
+        self.children = SortedChildren(cmp_to_key(childs_sort))
         self.children_ids = {}
         self.children_by_external_id = {}
 
@@ -341,11 +632,14 @@ class Container(BackendItem):
 
         self.item = None
 
-        self.sorted = False
-        def childs_sort(x,y):
-            return cmp(x.name,y.name)
-        self.sorting_method = childs_sort
-        
+    def _get_sorting_method(self):
+        return self._sorting_method
+
+    def _set_sorting_method(self, sorting_method):
+        self._sorting_method = sorting_method
+        self.children.set_key(cmp_to_key(sorting_method))
+
+    sorting_method = property(_get_sorting_method, _set_sorting_method)
 
     def register_child(self, child, external_id = None): 
         id = self.store.append_item(child)
@@ -357,10 +651,7 @@ class Container(BackendItem):
 
     def add_child(self, child, external_id = None, update=True):
         id = self.register_child(child, external_id)
-        if self.children is None:
-            self.children = []
         self.children.append(child)
-        self.sorted = False
         if update == True:
             self.update_id += 1
 
@@ -374,9 +665,6 @@ class Container(BackendItem):
             del self.children_by_external_id[external_id]
 
     def get_children(self, start=0, end=0):
-        if self.sorted == False:
-            self.children.sort(cmp=self.sorting_method)
-            self.sorted = True
         if end != 0:
             return self.children[start:end]
         return self.children[start:]
@@ -569,6 +857,7 @@ class AbstractBackendStore (BackendStore):
         BackendStore.__init__(self, server, **kwargs)
         self.next_id = SEED_ITEM_ID
         self.store = {}
+        self.create_search_indexes()
 
     def len(self):
         return len(self.store)
@@ -588,10 +877,12 @@ class AbstractBackendStore (BackendStore):
         self.store[storage_id] = item
         item.storage_id = storage_id
         item.store = self
+        self.index_item(storage_id)
         return storage_id
 
     def remove_item(self, item):
         del self.store[item.storage_id]
+        self.unindex_item(item.storage_id)
         item.storage_id = -1
         item.store = None
 
@@ -10,7 +10,9 @@ import tempfile
 import shutil
 import time
 import re
+import traceback
 from datetime import datetime
+from collections import OrderedDict
 import urllib
 
 from sets import Set
@@ -28,6 +30,7 @@ mimetypes.add_type('video/x-matroska', '.mkv')
 
 from urlparse import urlsplit
 
+from twisted.internet import reactor, task, defer
 from twisted.python.filepath import FilePath
 from twisted.python import failure
 
@@ -47,11 +50,18 @@ except Exception,msg:
     haz_inotify = False
     no_inotify_reason = msg
 
+try:
+    import sqlite3
+    haz_sqlite = True
+except ImportError,msg:
+    haz_sqlite = False
+    no_sqlite_reason = msg
+
 from coherence.extern.xdg import xdg_content
 
 import coherence.extern.louie as louie
 
-from coherence.backend import BackendItem, BackendStore
+from coherence.backend import BackendItem, BackendStore, SortedChildren
 
 ## Sorting helpers
 NUMS = re.compile('([0-9]+)')
@@ -60,10 +70,25 @@ def _natural_key(s):
     s = s.get_name().strip()
     return [ part.isdigit() and int(part) or part.lower() for part in NUMS.split(s) ]
 
+def _child_path(child):
+    return child.get_realpath()
+
 
 class NoThumbnailFound(Exception):
     """no thumbnail found"""
 
+def _thumbnail_type(filename):
+    """ returns the mimetype of a thumbnail file and the
+        corresponding DLNA PN string, or None if it isn't
+        an image type we can use as a thumbnail
+    """
+    mimetype,_ = mimetypes.guess_type(filename, strict=False)
+    if mimetype == 'image/jpeg':
+        return mimetype,'DLNA.ORG_PN=JPEG_TN'
+    if mimetype == 'image/png':
+        return mimetype,'DLNA.ORG_PN=PNG_TN'
+    return None
+
 def _find_thumbnail(filename,thumbnail_folder='.thumbs'):
     """ looks for a thumbnail file of the same basename
         in a folder named '.thumbs' relative to the file
@@ -74,211 +99,313 @@ def _find_thumbnail(filename,thumbnail_folder='.thumbs'):
     name,ext = os.path.splitext(os.path.basename(filename))
     pattern = os.path.join(os.path.dirname(filename),thumbnail_folder,name+'.*')
     for f in glob.glob(pattern):
-        mimetype,_ = mimetypes.guess_type(f, strict=False)
-        if mimetype in ('image/jpeg','image/png'):
-            if mimetype == 'image/jpeg':
-                dlna_pn = 'DLNA.ORG_PN=JPEG_TN'
-            else:
-                dlna_pn = 'DLNA.ORG_PN=PNG_TN'
+        thumbnail_type = _thumbnail_type(f)
+        if thumbnail_type is not None:
+            mimetype,dlna_pn = thumbnail_type
             return os.path.abspath(f),mimetype,dlna_pn
     else:
         raise NoThumbnailFound()
 
+def _attachment_key(filename):
+    """ the key of an attachment in the url, it has to stay
+        the same when we create the DIDL-Lite object again
+    """
+    return str(abs(hash(filename)))
+
 class FSItem(BackendItem):
+    """ a file or a folder exported by the FSStore
+
+        to keep large collections small in memory we only hold
+        what we know about the path, the DIDL-Lite object with
+        its resources is created by get_item() when it is asked
+        for, and the FSStore keeps only the most recently used
+        of them around
+    """
     logCategory = 'fs_item'
 
-    def __init__(self, object_id, parent, path, mimetype, urlbase, UPnPClass,update=False,store=None):
+    __slots__ = ('id', 'parent', 'path', 'mimetype', 'urlbase', 'upnp_class',
+                 'store', 'size', 'mtime', 'thumbnail', 'caption_file',
+                 'cover', 'children', 'child_count', 'update_id', '_item')
+
+    def __init__(self, object_id, parent, path, mimetype, urlbase, UPnPClass,update=False,store=None,info=None):
+        """ info, when given, is what scan() found out about
+            the path at some earlier time, usually taken from
+            the FSStore index, and saves us the file-system access
+        """
         self.id = object_id
         self.parent = parent
-        if parent:
-            parent.add_child(self,update=update)
         if mimetype == 'root':
-            self.location = unicode(path)
+            self.path = unicode(path)
         else:
             if mimetype == 'item' and path is None:
                 path = os.path.join(parent.get_realpath(),unicode(self.id))
-            #self.location = FilePath(unicode(path))
-            self.location = FilePath(path)
+            self.path = os.path.abspath(path)
         self.mimetype = mimetype
         if urlbase[-1] != '/':
             urlbase += '/'
-        self.url = urlbase + str(self.id)
-
+        self.urlbase = urlbase
+        self.upnp_class = UPnPClass
         self.store = store
+        self._item = None
+
+        self.child_count = 0
+        if mimetype in ('directory','root'):
+            self.children = SortedChildren(_natural_key, _child_path)
+            self.update_id = 0
+        else:
+            # the empty tuple is shared by all of the files
+            self.children = ()
+        if parent:
+            # the parent sorts and indexes us by our path
+            parent.add_child(self,update=update)
 
-        if parent == None:
+        if info is None:
+            info = self.scan()
+
+        self.mtime = info['mtime']
+        if mimetype in ('directory','root'):
+            self.size = 0
+            self.thumbnail = None
+            self.caption_file = None
+            self.set_cover(info['cover'])
+        else:
+            self.size = info['size']
+            self.thumbnail = info['thumbnail']
+            self.caption_file = info['caption']
+
+    def get_location(self):
+        if self.mimetype == 'root':
+            return self.path
+        return FilePath(self.path)
+
+    location = property(get_location)
+
+    def get_url(self):
+        return self.urlbase + str(self.id)
+
+    url = property(get_url)
+
+    def get_caption(self):
+        if self.caption_file is None:
+            return None
+        return self.url+'?attachment='+_attachment_key(self.caption_file[0])
+
+    caption = property(get_caption)
+
+    def create_item(self):
+        """ creates the DIDL-Lite object for this path """
+        if self.parent == None:
             parent_id = -1
         else:
-            parent_id = parent.get_id()
+            parent_id = self.parent.get_id()
+
+        item = self.upnp_class(self.id, parent_id, self.get_name())
+
+        if self.mimetype in ('directory','root'):
+            #item.searchable = True
+            #item.searchClass = 'object'
+            if hasattr(self, 'cover'):
+                _,ext =  os.path.splitext(self.cover)
+                """ add the cover image extension to help clients not reacting on
+                    the mimetype """
+                item.albumArtURI = ''.join((self.url,'?cover',ext))
+            return item
+
+        url = self.url
+
+        if self.mimetype.startswith('audio/'):
+            if hasattr(self.parent, 'cover'):
+                _,ext =  os.path.splitext(self.parent.cover)
+                """ add the cover image extension to help clients not reacting on
+                    the mimetype """
+                item.albumArtURI = ''.join((url,'?cover',ext))
+
+        _,host_port,_,_,_ = urlsplit(self.urlbase)
+        if host_port.find(':') != -1:
+            host,port = tuple(host_port.split(':'))
+        else:
+            host = host_port
 
-        self.item = UPnPClass(object_id, parent_id, self.get_name())
-        if isinstance(self.item, Container):
-            self.item.childCount = 0
-        self.child_count = 0
-        self.children = []
-        self.sorted = False
-        self.caption = None
+        size = self.size
 
+        if self.store.server.coherence.config.get('transcoding', 'no') == 'yes':
+            if self.mimetype in ('application/ogg','audio/ogg',
+                                 'audio/x-wav',
+                                 'audio/x-m4a',
+                                 'application/x-flac'):
+                new_res = Resource(url+'/transcoded.mp3',
+                    'http-get:*:%s:*' % 'audio/mpeg')
+                new_res.size = None
+                #item.res.append(new_res)
 
-        if mimetype in ['directory','root']:
-            self.update_id = 0
-            self.get_url = lambda : self.url
-            self.get_path = lambda : None
-            #self.item.searchable = True
-            #self.item.searchClass = 'object'
-            if(isinstance(self.location,FilePath) and
-               self.location.isdir() == True):
-                self.check_for_cover_art()
-                if hasattr(self, 'cover'):
-                    _,ext =  os.path.splitext(self.cover)
-                    """ add the cover image extension to help clients not reacting on
-                        the mimetype """
-                    self.item.albumArtURI = ''.join((urlbase,str(self.id),'?cover',ext))
+        if self.mimetype != 'item':
+            res = Resource('file://'+ urllib.quote(self.get_path()), 'internal:%s:%s:*' % (host,self.mimetype))
+            res.size = size
+            item.res.append(res)
+
+        if self.mimetype != 'item':
+            res = Resource(url, 'http-get:*:%s:*' % self.mimetype)
         else:
-            self.get_url = lambda : self.url
-
-            if self.mimetype.startswith('audio/'):
-                if hasattr(parent, 'cover'):
-                    _,ext =  os.path.splitext(parent.cover)
-                    """ add the cover image extension to help clients not reacting on
-                        the mimetype """
-                    self.item.albumArtURI = ''.join((urlbase,str(self.id),'?cover',ext))
-
-            _,host_port,_,_,_ = urlsplit(urlbase)
-            if host_port.find(':') != -1:
-                host,port = tuple(host_port.split(':'))
-            else:
-                host = host_port
+            # a placeholder from a CreateObject call,
+            # waiting for its content to be imported
+            res = Resource(url, 'http-get:*:*:*')
+            res.importUri = url+'?import'
+            res.data = None
 
-            try:
-                size = self.location.getsize()
-            except:
-                size = 0
-
-            if self.store.server.coherence.config.get('transcoding', 'no') == 'yes':
-                if self.mimetype in ('application/ogg','audio/ogg',
-                                     'audio/x-wav',
-                                     'audio/x-m4a',
-                                     'application/x-flac'):
-                    new_res = Resource(self.url+'/transcoded.mp3',
+        res.size = size
+        item.res.append(res)
+
+        """ if this item is of type audio and we want to add a transcoding rule for it,
+            this is the way to do it:
+
+            create a new Resource object, at least a 'http-get'
+            and maybe an 'internal' one too
+
+            for transcoding to wav this looks like that
+
+            res = Resource(url_for_transcoded audio,
+                    'http-get:*:audio/x-wav:%s'% ';'.join(['DLNA.ORG_PN=JPEG_TN']+simple_dlna_tags))
+            res.size = None
+            item.res.append(res)
+        """
+
+        if self.store.server.coherence.config.get('transcoding', 'no') == 'yes':
+            if self.mimetype in ('audio/mpeg',
+                                 'application/ogg','audio/ogg',
+                                 'audio/x-wav',
+                                 'audio/x-m4a',
+                                 'audio/flac',
+                                 'application/x-flac'):
+                dlna_pn = 'DLNA.ORG_PN=LPCM'
+                dlna_tags = simple_dlna_tags[:]
+                #dlna_tags[1] = 'DLNA.ORG_OP=00'
+                dlna_tags[2] = 'DLNA.ORG_CI=1'
+                new_res = Resource(url+'?transcoded=lpcm',
+                    'http-get:*:%s:%s' % ('audio/L16;rate=44100;channels=2', ';'.join([dlna_pn]+dlna_tags)))
+                new_res.size = None
+                #item.res.append(new_res)
+
+                if self.mimetype  != 'audio/mpeg':
+                    new_res = Resource(url+'?transcoded=mp3',
                         'http-get:*:%s:*' % 'audio/mpeg')
                     new_res.size = None
-                    #self.item.res.append(new_res)
+                    #item.res.append(new_res)
 
-            if mimetype != 'item':
-                res = Resource('file://'+ urllib.quote(self.get_path()), 'internal:%s:%s:*' % (host,self.mimetype))
-                res.size = size
-                self.item.res.append(res)
+        """ if this item is an image and we want to add a thumbnail for it
+            we have to follow these rules:
 
-            if mimetype != 'item':
-                res = Resource(self.url, 'http-get:*:%s:*' % self.mimetype)
-            else:
-                res = Resource(self.url, 'http-get:*:*:*')
+            create a new Resource object, at least a 'http-get'
+            and maybe an 'internal' one too
 
-            res.size = size
-            self.item.res.append(res)
-
-            """ if this item is of type audio and we want to add a transcoding rule for it,
-                this is the way to do it:
-
-                create a new Resource object, at least a 'http-get'
-                and maybe an 'internal' one too
-
-                for transcoding to wav this looks like that
-
-                res = Resource(url_for_transcoded audio,
-                        'http-get:*:audio/x-wav:%s'% ';'.join(['DLNA.ORG_PN=JPEG_TN']+simple_dlna_tags))
-                res.size = None
-                self.item.res.append(res)
-            """
-
-            if self.store.server.coherence.config.get('transcoding', 'no') == 'yes':
-                if self.mimetype in ('audio/mpeg',
-                                     'application/ogg','audio/ogg',
-                                     'audio/x-wav',
-                                     'audio/x-m4a',
-                                     'audio/flac',
-                                     'application/x-flac'):
-                    dlna_pn = 'DLNA.ORG_PN=LPCM'
-                    dlna_tags = simple_dlna_tags[:]
-                    #dlna_tags[1] = 'DLNA.ORG_OP=00'
-                    dlna_tags[2] = 'DLNA.ORG_CI=1'
-                    new_res = Resource(self.url+'?transcoded=lpcm',
-                        'http-get:*:%s:%s' % ('audio/L16;rate=44100;channels=2', ';'.join([dlna_pn]+dlna_tags)))
-                    new_res.size = None
-                    #self.item.res.append(new_res)
+            for an JPG this looks like that
 
-                    if self.mimetype  != 'audio/mpeg':
-                        new_res = Resource(self.url+'?transcoded=mp3',
-                            'http-get:*:%s:*' % 'audio/mpeg')
-                        new_res.size = None
-                        #self.item.res.append(new_res)
+            res = Resource(url_for_thumbnail,
+                    'http-get:*:image/jpg:%s'% ';'.join(['DLNA.ORG_PN=JPEG_TN']+simple_dlna_tags))
+            res.size = size_of_thumbnail
+            item.res.append(res)
 
-            """ if this item is an image and we want to add a thumbnail for it
-                we have to follow these rules:
+            and for a PNG the Resource creation is like that
 
-                create a new Resource object, at least a 'http-get'
-                and maybe an 'internal' one too
+            res = Resource(url_for_thumbnail,
+                    'http-get:*:image/png:%s'% ';'.join(simple_dlna_tags+['DLNA.ORG_PN=PNG_TN']))
 
-                for an JPG this looks like that
+            if not hasattr(item, 'attachments'):
+                item.attachments = {}
+            item.attachments[key] = utils.StaticFile(filename_of_thumbnail)
+        """
 
-                res = Resource(url_for_thumbnail,
-                        'http-get:*:image/jpg:%s'% ';'.join(['DLNA.ORG_PN=JPEG_TN']+simple_dlna_tags))
-                res.size = size_of_thumbnail
-                self.item.res.append(res)
+        if self.thumbnail is not None:
+            filename,thumbnail_size = self.thumbnail
+            mimetype,dlna_pn = _thumbnail_type(filename)
+            dlna_tags = simple_dlna_tags[:]
+            dlna_tags[3] = 'DLNA.ORG_FLAGS=00f00000000000000000000000000000'
+
+            hash_from_path = _attachment_key(filename)
+            new_res = Resource(url+'?attachment='+hash_from_path,
+                'http-get:*:%s:%s' % (mimetype, ';'.join([dlna_pn]+dlna_tags)))
+            new_res.size = thumbnail_size
+            item.res.append(new_res)
+            if not hasattr(item, 'attachments'):
+                item.attachments = {}
+            item.attachments[hash_from_path] = utils.StaticFile(filename)
+
+        if self.caption_file is not None:
+            caption,caption_size = self.caption_file
+            hash_from_path = _attachment_key(caption)
+            mimetype = 'smi/caption'
+            new_res = Resource(url+'?attachment='+hash_from_path,
+                'http-get:*:%s:%s' % (mimetype, '*'))
+            new_res.size = caption_size
+            item.res.append(new_res)
+            if not hasattr(item, 'attachments'):
+                item.attachments = {}
+            item.attachments[hash_from_path] = utils.StaticFile(caption)
+
+        if self.mtime is not None:
+            item.date = datetime.fromtimestamp(self.mtime)
+        else:
+            item.date = None
 
-                and for a PNG the Resource creation is like that
+        return item
 
-                res = Resource(url_for_thumbnail,
-                        'http-get:*:image/png:%s'% ';'.join(simple_dlna_tags+['DLNA.ORG_PN=PNG_TN']))
+    def forget_item(self):
+        """ drops our DIDL-Lite object, the next get_item()
+            will create a new one
+        """
+        self._item = None
 
-                if not hasattr(self.item, 'attachments'):
-                    self.item.attachments = {}
-                self.item.attachments[key] = utils.StaticFile(filename_of_thumbnail)
-            """
+    def scan(self):
+        """ collects what we need to know about our location
+            from the file-system, this is what the FSStore
+            keeps in its index between restarts
+        """
+        if self.mimetype == 'root':
+            return {'mtime':None,'cover':None}
+        try:
+            mtime = int(os.path.getmtime(self.path))
+        except:
+            mtime = None
 
-            if(self.mimetype in ('image/jpeg', 'image/png') or
-               self.mimetype.startswith('video/')):
-                try:
-                    filename,mimetype,dlna_pn = _find_thumbnail(self.get_path())
-                except NoThumbnailFound:
-                    pass
-                except:
-                    self.warning(traceback.format_exc())
-                else:
-                    dlna_tags = simple_dlna_tags[:]
-                    dlna_tags[3] = 'DLNA.ORG_FLAGS=00f00000000000000000000000000000'
-
-                    hash_from_path = str(id(filename))
-                    new_res = Resource(self.url+'?attachment='+hash_from_path,
-                        'http-get:*:%s:%s' % (mimetype, ';'.join([dlna_pn]+dlna_tags)))
-                    new_res.size = os.path.getsize(filename)
-                    self.item.res.append(new_res)
-                    if not hasattr(self.item, 'attachments'):
-                        self.item.attachments = {}
-                    self.item.attachments[hash_from_path] = utils.StaticFile(filename)
-
-            if self.mimetype.startswith('video/'):
-                # check for a subtitles file
-                caption,_ =  os.path.splitext(self.get_path())
-                caption = caption + '.srt'
-                if os.path.exists(caption):
-                    hash_from_path = str(id(caption))
-                    mimetype = 'smi/caption'
-                    new_res = Resource(self.url+'?attachment='+hash_from_path,
-                        'http-get:*:%s:%s' % (mimetype, '*'))
-                    new_res.size = os.path.getsize(caption)
-                    self.caption = new_res.data
-                    self.item.res.append(new_res)
-                    if not hasattr(self.item, 'attachments'):
-                        self.item.attachments = {}
-                    self.item.attachments[hash_from_path] = utils.StaticFile(caption)
+        if self.mimetype == 'directory':
+            cover = None
+            if os.path.isdir(self.path) == True:
+                cover = self.find_cover_art()
+            return {'mtime':mtime,'cover':cover}
 
+        try:
+            size = os.path.getsize(self.path)
+        except:
+            size = 0
+
+        thumbnail = None
+        if(self.mimetype in ('image/jpeg', 'image/png') or
+           self.mimetype.startswith('video/')):
             try:
-                # FIXME: getmtime is deprecated in Twisted 2.6
-                self.item.date = datetime.fromtimestamp(self.location.getmtime())
+                filename,_,_ = _find_thumbnail(self.path)
+                thumbnail = (filename,os.path.getsize(filename))
+            except NoThumbnailFound:
+                pass
             except:
-                self.item.date = None
+                self.warning(traceback.format_exc())
+
+        caption = None
+        if self.mimetype.startswith('video/'):
+            # check for a subtitles file
+            filename,_ =  os.path.splitext(self.path)
+            filename = filename + '.srt'
+            if os.path.exists(filename):
+                caption = (filename,os.path.getsize(filename))
+
+        return {'size':size,'mtime':mtime,'thumbnail':thumbnail,'caption':caption}
+
+    def get_info(self):
+        """ returns what we know about our location in the
+            same form scan() hands it out
+        """
+        if self.mimetype in ('directory','root'):
+            return {'mtime':self.mtime,'cover':getattr(self,'cover',None)}
+        return {'size':self.size,'mtime':self.mtime,
+                'thumbnail':self.thumbnail,'caption':self.caption_file}
 
     def rebuild(self, urlbase):
         #print "rebuild", self.mimetype
@@ -290,43 +417,24 @@ class FSItem(BackendItem):
             return
         self.mimetype = mimetype
         #print "rebuild", self.mimetype
-        UPnPClass = classChooser(self.mimetype)
-        self.item = UPnPClass(self.id, self.parent.id, self.get_name())
-        if hasattr(self.parent, 'cover'):
-            _,ext =  os.path.splitext(self.parent.cover)
-            """ add the cover image extension to help clients not reacting on
-                the mimetype """
-            self.item.albumArtURI = ''.join((urlbase,str(self.id),'?cover',ext))
-
-        _,host_port,_,_,_ = urlsplit(urlbase)
-        if host_port.find(':') != -1:
-            host,port = tuple(host_port.split(':'))
-        else:
-            host = host_port
-
-        res = Resource('file://'+urllib.quote(self.get_path()), 'internal:%s:%s:*' % (host,self.mimetype))
-        try:
-            res.size = self.location.getsize()
-        except:
-            res.size = 0
-        self.item.res.append(res)
-        res = Resource(self.url, 'http-get:*:%s:*' % self.mimetype)
+        self.upnp_class = classChooser(self.mimetype)
+        if urlbase[-1] != '/':
+            urlbase += '/'
+        self.urlbase = urlbase
 
         try:
-            res.size = self.location.getsize()
+            self.size = os.path.getsize(self.path)
         except:
-            res.size = 0
-        self.item.res.append(res)
-
+            self.size = 0
         try:
-            # FIXME: getmtime is deprecated in Twisted 2.6
-            self.item.date = datetime.fromtimestamp(self.location.getmtime())
+            self.mtime = int(os.path.getmtime(self.path))
         except:
-            self.item.date = None
+            self.mtime = None
 
+        self.forget_item()
         self.parent.update_id += 1
 
-    def check_for_cover_art(self):
+    def find_cover_art(self):
         """ let's try to find in the current directory some jpg file,
             or png if the jpg search fails, and take the first one
             that comes around
@@ -334,45 +442,58 @@ class FSItem(BackendItem):
         try:
             jpgs = [i.path for i in self.location.children() if i.splitext()[1] in ('.jpg', '.JPG')]
             try:
-                self.cover = jpgs[0]
+                return jpgs[0]
             except IndexError:
                 pngs = [i.path for i in self.location.children() if i.splitext()[1] in ('.png', '.PNG')]
                 try:
-                    self.cover = pngs[0]
+                    return pngs[0]
                 except IndexError:
-                    return
+                    return None
         except UnicodeDecodeError:
-            self.warning("UnicodeDecodeError - there is something wrong with a file located in %r", self.location.path)
+            self.warning("UnicodeDecodeError - there is something wrong with a file located in %r", self.path)
+        return None
+
+    def check_for_cover_art(self):
+        self.set_cover(self.find_cover_art())
+
+    def set_cover(self, cover):
+        if cover is None:
+            if not hasattr(self, 'cover'):
+                return
+            del self.cover
+        else:
+            self.cover = cover
+        # our DIDL-Lite object and the ones of our audio
+        # files have the cover in their albumArtURI
+        self.forget_item()
+        for child in self.children:
+            child.forget_item()
 
     def remove(self):
         #print "FSItem remove", self.id, self.get_name(), self.parent
         if self.parent:
             self.parent.remove_child(self)
-        del self.item
+        self.forget_item()
 
     def add_child(self, child, update=False):
         self.children.append(child)
         self.child_count += 1
-        if isinstance(self.item, Container):
-            self.item.childCount += 1
         if update == True:
             self.update_id += 1
-        self.sorted = False
 
     def remove_child(self, child):
         #print "remove_from %d (%s) child %d (%s)" % (self.id, self.get_name(), child.id, child.get_name())
-        if child in self.children:
-            self.child_count -= 1
-            if isinstance(self.item, Container):
-                self.item.childCount -= 1
+        try:
             self.children.remove(child)
-            self.update_id += 1
-        self.sorted = False
+        except ValueError:
+            return
+        self.child_count -= 1
+        self.update_id += 1
+
+    def get_child_by_path(self, path):
+        return self.children.get(path)
 
     def get_children(self,start=0,request_count=0):
-        if self.sorted == False:
-            self.children.sort(key=_natural_key)
-            self.sorted = True
         if request_count == 0:
             return self.children[start:]
         else:
@@ -391,16 +512,14 @@ class FSItem(BackendItem):
             return None
 
     def get_path(self):
-        if isinstance( self.location,FilePath):
-            return self.location.path
-        else:
-            self.location
+        if self.mimetype in ('directory','root'):
+            return None
+        return self.path
 
     def get_realpath(self):
-        if isinstance( self.location,FilePath):
-            return self.location.path
-        else:
-            self.location
+        if self.mimetype == 'root':
+            return None
+        return self.path
 
     def set_path(self,path=None,extension=None):
         if path is None:
@@ -408,16 +527,22 @@ class FSItem(BackendItem):
         if extension is not None:
             path,old_ext = os.path.splitext(path)
             path = ''.join((path,extension))
-        if isinstance( self.location,FilePath):
-            self.location = FilePath(path)
+        # our parent sorts and indexes us by our path
+        if self.parent:
+            self.parent.children.remove(self)
+        if self.mimetype == 'root':
+            self.path = path
         else:
-            self.location = path
+            self.path = os.path.abspath(path)
+        if self.parent:
+            self.parent.children.append(self)
+        self.forget_item()
 
     def get_name(self):
-        if isinstance(self.location,FilePath):
-            name = self.location.basename().decode("utf-8", "replace")
+        if self.mimetype == 'root':
+            name = self.path.decode("utf-8", "replace")
         else:
-            name = self.location.decode("utf-8", "replace")
+            name = os.path.basename(self.path).decode("utf-8", "replace")
         return name
 
     def get_cover(self):
@@ -433,7 +558,16 @@ class FSItem(BackendItem):
         return self.parent
 
     def get_item(self):
-        return self.item
+        item = self._item
+        if item is None:
+            item = self._item = self.create_item()
+        if isinstance(item, Container):
+            item.childCount = self.child_count
+        if self.store is not None:
+            self.store.cache_item(self)
+        return item
+
+    item = property(get_item)
 
     def get_xml(self):
         return self.item.toString()
@@ -441,6 +575,90 @@ class FSItem(BackendItem):
     def __repr__(self):
         return 'id: ' + str(self.id) + ' @ ' + self.get_name().encode('ascii','xmlcharrefreplace')
 
+class FSIndex(object):
+    """ a persistent index of the FSStore content
+
+        for every path we keep the object id it got, the id of
+        its parent and what FSItem.scan() found out about it,
+        so a restart can rebuild the tree without touching
+        every single file again
+    """
+
+    version = 1
+
+    columns = ('path', 'id', 'parent_id', 'mimetype', 'size', 'mtime',
+               'cover', 'thumbnail', 'thumbnail_size', 'caption', 'caption_size')
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        # our paths are byte strings and we want them back that way
+        self.db.text_factory = str
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version != self.version:
+            self.db.execute('DROP TABLE IF EXISTS items')
+            self.db.execute('PRAGMA user_version = %d' % self.version)
+        self.db.execute('CREATE TABLE IF NOT EXISTS items ('
+                        'path TEXT PRIMARY KEY, id TEXT, parent_id TEXT, mimetype TEXT, '
+                        'size INTEGER, mtime REAL, cover TEXT, '
+                        'thumbnail TEXT, thumbnail_size INTEGER, '
+                        'caption TEXT, caption_size INTEGER)')
+        self.db.commit()
+        self.commit_call = None
+
+    def load(self):
+        """ returns (path, id, parent_id, mimetype, info) for all
+            entries, a parent always before its children
+        """
+        cursor = self.db.execute('SELECT %s FROM items ORDER BY path' % ','.join(self.columns))
+        for row in cursor:
+            (path, id, parent_id, mimetype, size, mtime, cover,
+             thumbnail, thumbnail_size, caption, caption_size) = row
+            if mimetype in ('directory','root'):
+                info = {'mtime':mtime,'cover':cover}
+            else:
+                if thumbnail is not None:
+                    thumbnail = (thumbnail, thumbnail_size)
+                if caption is not None:
+                    caption = (caption, caption_size)
+                info = {'size':size,'mtime':mtime,
+                        'thumbnail':thumbnail,'caption':caption}
+            yield path, id, parent_id, mimetype, info
+
+    def store(self, path, id, parent_id, mimetype, info):
+        thumbnail = info.get('thumbnail') or (None, None)
+        caption = info.get('caption') or (None, None)
+        self.db.execute('INSERT OR REPLACE INTO items (%s) VALUES (%s)' % (
+                            ','.join(self.columns), ','.join(['?'] * len(self.columns))),
+                        (path, id, parent_id, mimetype,
+                         info.get('size'), info.get('mtime'), info.get('cover'),
+                         thumbnail[0], thumbnail[1], caption[0], caption[1]))
+        self.schedule_commit()
+
+    def remove(self, path):
+        """ removes path and everything below it """
+        subtree = path.rstrip(os.sep) + os.sep
+        # all paths starting with subtree sort between it and
+        # the same string with the separator replaced by its successor
+        self.db.execute('DELETE FROM items WHERE path = ? OR (path >= ? AND path < ?)',
+                        (path, subtree, subtree[:-1] + chr(ord(os.sep) + 1)))
+        self.schedule_commit()
+
+    def schedule_commit(self, delay=5):
+        if self.commit_call is None:
+            self.commit_call = reactor.callLater(delay, self.commit)
+
+    def commit(self):
+        if self.commit_call is not None:
+            if self.commit_call.active():
+                self.commit_call.cancel()
+            self.commit_call = None
+        self.db.commit()
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
 class FSStore(BackendStore):
     logCategory = 'fs_store'
 
@@ -448,6 +666,8 @@ class FSStore(BackendStore):
 
     description = """MediaServer exporting files from the file-system"""
 
+    cache_didl_fragments = True
+
     options = [{'option':'name','type':'string','default':'my media','help': 'the name under this MediaServer shall show up with on other UPnP clients'},
                {'option':'version','type':'int','default':2,'enum': (2,1),'help': 'the highest UPnP version this MediaServer shall support','level':'advance'},
                {'option':'uuid','type':'string','help':'the unique (UPnP) identifier for this MediaServer, usually automatically set','level':'advance'},
@@ -455,7 +675,9 @@ class FSStore(BackendStore):
                {'option':'ignore_patterns','type':'string','help':'list of regex patterns, matching filenames will be ignored'},
                {'option':'enable_inotify','type':'string','default':'yes','help':'enable real-time monitoring of the content folders'},
                {'option':'enable_destroy','type':'string','default':'no','help':'enable deleting a file via an UPnP method'},
-               {'option':'import_folder','type':'string','help':'The path to store files imported via an UPnP method, if empty the Import method is disabled'}
+               {'option':'import_folder','type':'string','help':'The path to store files imported via an UPnP method, if empty the Import method is disabled'},
+               {'option':'index_file','type':'string','help':'a file to keep an index of the content in, to speed up the startup with large collections','level':'advance'},
+               {'option':'item_cache_size','type':'int','default':10000,'help':'the number of DIDL-Lite objects to keep in memory, they are created again when needed','level':'advance'}
               ]
 
 
@@ -481,6 +703,9 @@ class FSStore(BackendStore):
         self.content = Set([os.path.abspath(x) for x in self.content])
         ignore_patterns = kwargs.get('ignore_patterns',[])
         self.store = {}
+        self.item_cache = OrderedDict()
+        self.item_cache_size = int(kwargs.get('item_cache_size',10000))
+        self.create_search_indexes()
 
         self.inotify = None
 
@@ -496,6 +721,17 @@ class FSStore(BackendStore):
             self.info("FSStore content auto-update disabled upon user request")
 
 
+        self.index = None
+        index_file = kwargs.get('index_file',None)
+        if index_file:
+            if haz_sqlite == True:
+                try:
+                    self.index = FSIndex(os.path.expanduser(index_file))
+                except sqlite3.Error,msg:
+                    self.warning("can't use %r as index: %r", index_file, msg)
+            else:
+                self.info("%s" %no_sqlite_reason)
+
         if kwargs.get('enable_destroy','no') == 'yes':
             self.upnp_DestroyObject = self.hidden_upnp_DestroyObject
 
@@ -508,6 +744,8 @@ class FSStore(BackendStore):
         self.ignore_file_pattern = re.compile('|'.join(['^\..*'] + list(ignore_patterns)))
         parent = None
         self.update_id = 0
+        self.changed_containers = {}
+        self.update_call = None
         if(len(self.content)>1 or
            utils.means_true(kwargs.get('create_root',False)) or
            self.import_folder != None):
@@ -520,18 +758,25 @@ class FSStore(BackendStore):
             self.store[id] = FSItem( id, parent, self.import_folder, 'directory', self.urlbase, UPnPClass, update=True,store=self)
             self.import_folder_id = id
 
+        content_paths = []
         for path in self.content:
             if isinstance(path,(list,tuple)):
                 path = path[0]
             if self.ignore_file_pattern.match(path):
                 continue
-            try:
-                path = path.encode('utf-8') # patch for #267
-                self.walk(path, parent, self.ignore_file_pattern)
-            except Exception,msg:
-                self.warning('on walk of %r: %r' % (path,msg))
-                import traceback
-                self.debug(traceback.format_exc())
+            content_paths.append(path.encode('utf-8')) # patch for #267
+
+        if self.index is not None:
+            self.load_index(content_paths, parent)
+        else:
+            # only the content folders themselves are added here,
+            # what's below them shows up while the walks go on
+            for path in content_paths:
+                try:
+                    self.walk(path, parent, self.ignore_file_pattern)
+                except Exception,msg:
+                    self.warning('on walk of %r: %r' % (path,msg))
+                    self.debug(traceback.format_exc())
 
         self.wmc_mapping.update({'14': '0',
                                  '15': '0',
@@ -541,12 +786,201 @@ class FSStore(BackendStore):
 
         louie.send('Coherence.UPnP.Backend.init_completed', None, backend=self)
 
+        if self.index is not None:
+            def reconciled(result):
+                self.info("index reconciled, %d items" % len(self.store))
+            def failed(failure):
+                self.warning("reconciling the index failed: %r" % failure.getErrorMessage())
+                self.debug(failure.getTraceback())
+            d = task.coiterate(self.reconcile(content_paths, parent))
+            d.addCallbacks(reconciled, failed)
+
     def __repr__(self):
         return str(self.__class__).split('.')[-1]
 
     def release(self):
         if self.inotify != None:
             self.inotify.release()
+        if self.index != None:
+            self.index.close()
+            self.index = None
+
+    def load_index(self, content_paths, parent):
+        """ rebuilds the tree below the content paths from the index,
+            without any file-system access
+
+            what we find in there may be outdated, reconcile() will
+            take care of that later on
+        """
+        self.indexed = {}
+        rows = list(self.index.load())
+        max_id = self.next_id - 1
+        for row in rows:
+            max_id = max(max_id, int(row[1].split('.')[0]))
+        self.next_id = max_id + 1
+
+        # the items by the id they have in the index
+        loaded = {}
+        for path, id, parent_id, mimetype, info in rows:
+            if path in content_paths:
+                item_parent = parent
+            else:
+                item_parent = loaded.get(parent_id)
+                if item_parent is None:
+                    # not below our content paths anymore
+                    continue
+            UPnPClass = classChooser(mimetype)
+            if UPnPClass == None:
+                continue
+            new_id = id
+            if id in self.store:
+                # the id is already in use for something else, like
+                # a root container that wasn't there before, the path
+                # gets a new one, its children keep theirs
+                new_id = str(self.getnextID())
+                if mimetype != 'directory':
+                    new_id += os.path.splitext(path)[1].lower()
+                self.info("%r gets id %r instead of %r" % (path, new_id, id))
+            item = loaded[id] = self.store[new_id] = FSItem( new_id, item_parent, path, mimetype, self.urlbase, UPnPClass, update=True,store=self,info=info)
+            if(new_id != id or
+               (item_parent is not None and item_parent.get_id() != parent_id)):
+                self.update_index(item)
+            self.index_item(new_id)
+            self.indexed[path] = new_id
+            if mimetype == 'directory' and self.inotify is not None:
+                mask = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_CHANGED
+                self.inotify.watch(path, mask=mask, auto_add=False, callbacks=(self.notify,new_id))
+        self.info("loaded %d items from the index" % len(self.indexed))
+
+    def reconcile(self, content_paths, parent):
+        """ walks the content paths and brings the tree we
+            loaded from the index up to date
+
+            this is a generator, to be run with task.coiterate,
+            so the reactor stays responsive while we do this
+        """
+        count = 0
+        last_progress = time.time()
+        containers = []
+        for path in content_paths:
+            container = self.reconcile_path(path, parent, False)
+            if container is not None:
+                containers.append(container)
+            yield None
+
+        while len(containers) > 0:
+            container, changed = containers.pop()
+            try:
+                children = container.location.children()
+            except (OSError, IOError), msg:
+                self.warning("path %r isn't accessible, error %r", container.get_realpath(), msg)
+                continue
+            for child in children:
+                try:
+                    if self.ignore_file_pattern.match(child.basename()) != None:
+                        continue
+                    new_container = self.reconcile_path(child.path, container, changed)
+                    if new_container is not None:
+                        containers.append(new_container)
+                except UnicodeDecodeError:
+                    self.warning("UnicodeDecodeError - there is something wrong with a file located in %r", container.get_realpath())
+                count += 1
+                if time.time() - last_progress > 1.0:
+                    last_progress = time.time()
+                    self.walk_progress(None, count, len(containers), False)
+                yield None
+
+        # whatever we haven't come across isn't there anymore,
+        # children are removed before their parents
+        vanished = self.indexed.items()
+        vanished.sort(reverse=True)
+        for path, id in vanished:
+            self.remove(id)
+        self.indexed = {}
+        self.index.commit()
+        self.walk_progress(None, count, 0, True)
+
+    def reconcile_path(self, path, parent, parent_changed):
+        """ checks a single path against what the index told us,
+            returns a (container, changed) tuple when we have to
+            descend into path, None otherwise
+        """
+        id = self.indexed.pop(path, None)
+        if id is None:
+            if parent is not None:
+                id = self.get_id_by_name(parent.get_id(), path)
+                if id is not None:
+                    # inotify was faster than us
+                    item = self.store[id]
+                    if item.mimetype == 'directory':
+                        return item, False
+                    return None
+            item = self.append(path, parent)
+            if item is not None:
+                return item, True
+            return None
+
+        item = self.store[id]
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.remove(id)
+            return None
+        if item.mimetype == 'directory':
+            info = item.scan()
+            changed = info != item.get_info()
+            if changed:
+                item.mtime = info['mtime']
+                item.set_cover(info['cover'])
+                self.update_index(item)
+            return item, changed
+
+        if(item.mtime != int(st.st_mtime) or
+           item.size != st.st_size or
+           (parent_changed and item.scan() != item.get_info())):
+            # the file itself, or its thumbnail, caption or cover
+            # art have changed, recreate it with the same id
+            self.remove(id)
+            self.append(path, parent, id)
+        return None
+
+    def update_index(self, item, old_path=None):
+        if self.index is None or item.mimetype == 'root':
+            return
+        path = item.get_realpath()
+        if old_path is not None and old_path != path:
+            self.index.remove(old_path)
+        parent_id = None
+        if item.parent is not None:
+            parent_id = item.parent.get_id()
+        self.index.store(path, item.get_id(), parent_id, item.mimetype, item.get_info())
+
+    def get_search_values(self, item, property):
+        """ we know the title and the class of our items
+            without creating their DIDL-Lite objects, and
+            there is no artist, album or genre in them
+        """
+        if property == 'dc:title':
+            return [item.get_name()]
+        if property == 'upnp:class':
+            return [item.upnp_class.upnp_class]
+        if property in ('upnp:artist', 'upnp:album', 'upnp:genre'):
+            return []
+        return BackendStore.get_search_values(self, item, property)
+
+    def cache_item(self, item):
+        """ keeps the DIDL-Lite object of item around and
+            drops the least recently used ones when there are
+            more than item_cache_size of them
+        """
+        cache = self.item_cache
+        id = item.get_id()
+        if id in cache:
+            del cache[id]
+        cache[id] = item
+        while len(cache) > self.item_cache_size:
+            _,old_item = cache.popitem(last=False)
+            old_item.forget_item()
 
     def len(self):
         return len(self.store)
@@ -577,14 +1011,10 @@ class FSStore(BackendStore):
         try:
             parent = self.store[parent]
             self.debug("%r %d" % (parent,len(parent.children)))
-            for child in parent.children:
-                #if not isinstance(name, unicode):
-                #    name = name.decode("utf8")
-                self.debug("%r %r %r" % (child.get_name(),child.get_realpath(), name == child.get_realpath()))
-                if name == child.get_realpath():
-                    return child.id
+            child = parent.get_child_by_path(name)
+            if child is not None:
+                return child.id
         except:
-            import traceback
             self.info(traceback.format_exc())
         self.debug('get_id_by_name not found')
 
@@ -627,11 +1057,41 @@ class FSStore(BackendStore):
             self.content.remove(path)
 
     def walk(self, path, parent=None, ignore_file_pattern=''):
+        """ adds path and, if it is a directory, everything below it
+
+            only path itself is added right away, the directory tree
+            below it is walked in a cooperative task, which doesn't
+            block the reactor for longer than a few milliseconds
+
+            the items are in the store as soon as they are found,
+            so a client can already browse the partial tree
+
+            returns a Deferred that fires when the walk is done
+        """
         self.debug("walk %r" % path)
-        containers = []
-        parent = self.append(path,parent)
-        if parent != None:
-            containers.append(parent)
+        container = self.append(path,parent)
+        if container == None:
+            return defer.succeed(None)
+
+        def failed(failure):
+            self.warning("walk of %r failed: %r" % (path, failure.getErrorMessage()))
+            self.debug(failure.getTraceback())
+
+        d = task.cooperate(self.walk_container(container, ignore_file_pattern)).whenDone()
+        d.addErrback(failed)
+        return d
+
+    def walk_container(self, container, ignore_file_pattern='', progress_interval=1.0):
+        """ the generator doing the actual walk,
+            every iteration adds at most one item to the store
+
+            sends a 'Coherence.UPnP.Backend.walk_progress' signal
+            every progress_interval seconds and one when it is done
+        """
+        path = container.get_realpath()
+        count = 0
+        last_progress = time.time()
+        containers = [container]
         while len(containers)>0:
             container = containers.pop()
             try:
@@ -642,41 +1102,72 @@ class FSStore(BackendStore):
                     new_container = self.append(child.path,container)
                     if new_container != None:
                         containers.append(new_container)
+                    count += 1
+                    if time.time() - last_progress > progress_interval:
+                        last_progress = time.time()
+                        self.walk_progress(path, count, len(containers), False)
+                    yield None
             except UnicodeDecodeError:
                 self.warning("UnicodeDecodeError - there is something wrong with a file located in %r", container.get_path())
+            except OSError, msg:
+                self.warning("path %r isn't accessible, error %r", container.get_realpath(), msg)
+        self.walk_progress(path, count, 0, True)
+
+    def walk_progress(self, path, count, pending, finished):
+        """ path is None when we are reconciling the index """
+        self.info("walk of %r: %d items, %d folders pending%s" % (
+                    path, count, pending, finished and ', finished' or ''))
+        louie.send('Coherence.UPnP.Backend.walk_progress', None,
+                   backend=self, path=path, items=count,
+                   pending_containers=pending, finished=finished)
+
+    def container_changed(self, container):
+        """ bumps the SystemUpdateID and notes the container
+            for the next ContainerUpdateIDs update
+
+            the state variables are updated once per reactor
+            iteration, not for every single item that is
+            added or removed
+        """
+        self.update_id += 1
+        if container is not None:
+            self.changed_containers[container.get_id()] = container
+        if self.update_call is None:
+            self.update_call = reactor.callLater(0, self.send_update_ids)
+
+    def send_update_ids(self):
+        self.update_call = None
+        containers = self.changed_containers
+        self.changed_containers = {}
+        if(self.server is None or
+           not hasattr(self.server,'content_directory_server')):
+            return
+        cds = self.server.content_directory_server
+        cds.set_variable(0, 'SystemUpdateID', self.update_id)
+        for id, container in containers.items():
+            cds.set_variable(0, 'ContainerUpdateIDs', (id, container.get_update_id()))
 
-    def create(self, mimetype, path, parent):
+    def create(self, mimetype, path, parent, id=None):
         self.debug("create ", mimetype, path, type(path), parent)
         UPnPClass = classChooser(mimetype)
         if UPnPClass == None:
             return None
 
-        id = self.getnextID()
-        if mimetype in ('root','directory'):
-            id = str(id)
-        else:
-            _,ext =  os.path.splitext(path)
-            id = str(id) + ext.lower()
-        update = False
-        if hasattr(self, 'update_id'):
-            update = True
-
+        if id is None:
+            id = self.getnextID()
+            if mimetype in ('root','directory'):
+                id = str(id)
+            else:
+                _,ext =  os.path.splitext(path)
+                id = str(id) + ext.lower()
         self.store[id] = FSItem( id, parent, path, mimetype, self.urlbase, UPnPClass, update=True,store=self)
-        if hasattr(self, 'update_id'):
-            self.update_id += 1
-            #print self.update_id
-            if self.server:
-                if hasattr(self.server,'content_directory_server'):
-                    self.server.content_directory_server.set_variable(0, 'SystemUpdateID', self.update_id)
-            if parent is not None:
-                value = (parent.get_id(),parent.get_update_id())
-                if self.server:
-                    if hasattr(self.server,'content_directory_server'):
-                        self.server.content_directory_server.set_variable(0, 'ContainerUpdateIDs', value)
+        self.update_index(self.store[id])
+        self.index_item(id)
+        self.container_changed(parent)
 
         return id
 
-    def append(self,path,parent):
+    def append(self,path,parent,id=None):
         self.debug("append ", path, type(path), parent)
         if os.path.exists(path) == False:
             self.warning("path %r not available - ignored", path)
@@ -694,7 +1185,7 @@ class FSStore(BackendStore):
             if mimetype == None:
                 return None
 
-            id = self.create(mimetype,path,parent)
+            id = self.create(mimetype,path,parent,id)
 
             if mimetype == 'directory':
                 if self.inotify is not None:
@@ -712,16 +1203,13 @@ class FSStore(BackendStore):
         try:
             item = self.store[id]
             parent = item.get_parent()
+            if self.index is not None and item.mimetype != 'root':
+                self.index.remove(item.get_realpath())
             item.remove()
             del self.store[id]
-            if hasattr(self, 'update_id'):
-                self.update_id += 1
-                if self.server:
-                    self.server.content_directory_server.set_variable(0, 'SystemUpdateID', self.update_id)
-                #value = '%d,%d' % (parent.get_id(),parent_get_update_id())
-                value = (parent.get_id(),parent.get_update_id())
-                if self.server:
-                    self.server.content_directory_server.set_variable(0, 'ContainerUpdateIDs', value)
+            self.item_cache.pop(id, None)
+            self.unindex_item(id)
+            self.container_changed(parent)
 
         except:
             pass
@@ -770,6 +1258,8 @@ class FSStore(BackendStore):
             f.write(data)
             f.close()
             item.rebuild(self.urlbase)
+            self.update_index(item)
+            self.index_item(item.get_id())
             return 200
         except IOError:
             self.warning("import of file %s failed" % item.get_path())
@@ -834,21 +1324,15 @@ class FSStore(BackendStore):
             content_type = headers.get('content-type',[])
             if not isinstance(content_type, list):
                 content_type = list(content_type)
+            old_path = item.get_path()
             if len(content_type) > 0:
                 extension = mimetypes.guess_extension(content_type[0], strict=False)
                 item.set_path(None,extension)
             shutil.move(tmp_path, item.get_path())
             item.rebuild(self.urlbase)
-            if hasattr(self, 'update_id'):
-                self.update_id += 1
-                if self.server:
-                    if hasattr(self.server,'content_directory_server'):
-                        self.server.content_directory_server.set_variable(0, 'SystemUpdateID', self.update_id)
-                if item.parent is not None:
-                    value = (item.parent.get_id(),item.parent.get_update_id())
-                    if self.server:
-                        if hasattr(self.server,'content_directory_server'):
-                            self.server.content_directory_server.set_variable(0, 'ContainerUpdateIDs', value)
+            self.update_index(item, old_path)
+            self.index_item(item.get_id())
+            self.container_changed(item.parent)
 
         def gotError(error, url):
             self.warning("error requesting", url)
@@ -931,9 +1415,6 @@ class FSStore(BackendStore):
             id = self.create('item',path,parent_item)
 
             new_item = self.get_by_id(id)
-            for res in new_item.item.res:
-                res.importUri = new_item.url+'?import'
-                res.data = None
             didl = DIDLElement()
             didl.addItem(new_item.item)
             return {'ObjectID': id, 'Result': didl.toString()}
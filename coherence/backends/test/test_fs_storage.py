@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{backends.fs_storage}
+"""
+
+from twisted.trial import unittest
+from twisted.internet import reactor, defer, task
+from twisted.python.filepath import FilePath
+
+from coherence.backends import fs_storage
+from coherence.backends.fs_storage import FSStore
+
+import coherence.extern.louie as louie
+
+
+class FSStoreTestMixin(object):
+    """ a content folder with
+
+        a.mp3
+        album/b.mp3
+        album/c.mp3
+    """
+
+    def setUp(self):
+        self.tmp = FilePath(self.mktemp())
+        self.content = self.tmp.child('content')
+        album = self.content.child('album')
+        album.makedirs()
+        for f in (self.content.child('a.mp3'), album.child('b.mp3'), album.child('c.mp3')):
+            f.setContent(f.basename())
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.release()
+
+    def create_store(self, server=None, **kwargs):
+        """ returns the store and a Deferred which
+            fires when its content is walked
+        """
+        kwargs.setdefault('enable_inotify', 'no')
+        walked = defer.Deferred()
+        def walk_progress(backend=None, finished=False, **kwargs):
+            if backend is store and finished and not walked.called:
+                walked.callback(store)
+        louie.connect(walk_progress, 'Coherence.UPnP.Backend.walk_progress',
+                      louie.Any, weak=False)
+        self.addCleanup(louie.disconnect, walk_progress,
+                        'Coherence.UPnP.Backend.walk_progress', louie.Any)
+        store = FSStore(server, content=self.content.path, **kwargs)
+        self.stores.append(store)
+        return store, walked
+
+    def ids(self, store):
+        """ path -> id of everything below the content folder """
+        return dict([(item.get_realpath(), id) for id, item in store.store.items()
+                     if item.mimetype != 'root'])
+
+    def restart(self, store, **kwargs):
+        store.release()
+        self.stores.remove(store)
+        return self.create_store(**kwargs)
+
+
+class ContentDirectoryServer(object):
+
+    def __init__(self):
+        self.variables = []
+
+    def set_variable(self, instance, name, value):
+        self.variables.append((name, value))
+
+
+class Coherence(object):
+
+    def __init__(self):
+        self.config = {}
+
+
+class MediaServer(object):
+
+    def __init__(self):
+        self.coherence = Coherence()
+        self.content_directory_server = ContentDirectoryServer()
+
+
+class TestFSStoreWalk(FSStoreTestMixin, unittest.TestCase):
+
+    def test_cooperative_walk(self):
+        """ only the content folder is there right away, the rest
+            shows up in the walk, init_completed doesn't wait for it
+        """
+        initialized = []
+        def init_completed(backend=None, **kwargs):
+            initialized.append(backend)
+        louie.connect(init_completed, 'Coherence.UPnP.Backend.init_completed',
+                      louie.Any, weak=False)
+        self.addCleanup(louie.disconnect, init_completed,
+                        'Coherence.UPnP.Backend.init_completed', louie.Any)
+        store, walked = self.create_store()
+        self.assertEqual(self.ids(store).keys(), [self.content.path])
+        def check_walked(store):
+            self.assertEqual(initialized, [store])
+            self.assertEqual(len(self.ids(store)), 5)
+        walked.addCallback(check_walked)
+        return walked
+
+    def test_batched_update_ids(self):
+        server = MediaServer()
+        store, walked = self.create_store(server)
+        variables = server.content_directory_server.variables
+        def walked_through(store):
+            return task.deferLater(reactor, 0, lambda: None)
+        def changes(_):
+            del variables[:]
+            ids = self.ids(store)
+            root = store.store[ids[self.content.path]]
+            album = store.store[ids[self.content.child('album').path]]
+            update_id = store.update_id
+            for container in (root, album, album, root, album):
+                store.container_changed(container)
+            """ nothing before the next reactor iteration """
+            self.assertEqual(variables, [])
+            def check():
+                self.assertEqual(variables[0], ('SystemUpdateID', update_id + 5))
+                self.assertEqual(sorted(variables[1:]),
+                                 sorted([('ContainerUpdateIDs', (root.get_id(), root.update_id)),
+                                         ('ContainerUpdateIDs', (album.get_id(), album.update_id))]))
+            return task.deferLater(reactor, 0, check)
+        walked.addCallback(walked_through)
+        walked.addCallback(changes)
+        return walked
+
+
+class TestFSItem(FSStoreTestMixin, unittest.TestCase):
+
+    def get_item(self, store, path):
+        return store.store[self.ids(store)[path]]
+
+    def test_created_on_demand(self):
+        store, d = self.create_store(MediaServer())
+        def check(store):
+            item = self.get_item(store, self.content.child('a.mp3').path)
+            self.assertEqual(item._item, None)
+            didl = item.get_item()
+            self.assertEqual(didl.id, item.get_id())
+            self.assertEqual(didl.title, 'a.mp3')
+            self.assertTrue(item.get_item() is didl)
+            self.assertTrue(store.item_cache[item.get_id()] is item)
+            item.forget_item()
+            self.assertFalse(item.get_item() is didl)
+        return d.addCallback(check)
+
+    def test_item_cache_size(self):
+        store, d = self.create_store(MediaServer(), item_cache_size=2)
+        album = self.content.child('album')
+        def check(store):
+            a, b, c = [self.get_item(store, path) for path in
+                       (self.content.child('a.mp3').path,
+                        album.child('b.mp3').path, album.child('c.mp3').path)]
+            a.get_item()
+            b.get_item()
+            """ a is used again, so b is the one to go """
+            a.get_item()
+            c.get_item()
+            self.assertEqual(store.item_cache.keys(), [a.get_id(), c.get_id()])
+            self.assertEqual(b._item, None)
+            self.assertNotEqual(a._item, None)
+            """ a removed item leaves the cache """
+            store.remove(c.get_id())
+            self.assertEqual(store.item_cache.keys(), [a.get_id()])
+        return d.addCallback(check)
+
+    def test_compact(self):
+        """ everything an item holds is in its slots """
+        self.content.child('movie.mp4').setContent('movie')
+        self.content.child('movie.srt').setContent('1\n')
+        self.content.child('album').child('cover.jpg').setContent('jpg')
+        store, d = self.create_store(MediaServer())
+        def check(store):
+            for item in store.store.values():
+                item.get_item()
+                item.get_children()
+                item.caption
+                self.assertEqual(vars(item), {})
+        return d.addCallback(check)
+
+    def test_attachment_key(self):
+        """ the caption url stays the same when
+            the DIDL-Lite object is created again
+        """
+        self.content.child('movie.mp4').setContent('movie')
+        self.content.child('movie.srt').setContent('1\n')
+        store, d = self.create_store(MediaServer())
+        def check(store):
+            item = self.get_item(store, self.content.child('movie.mp4').path)
+            caption = item.caption
+            self.assertNotEqual(caption, None)
+            key = caption.split('?attachment=')[1]
+            self.assertEqual(key, fs_storage._attachment_key(self.content.child('movie.srt').path))
+            attachments = item.get_item().attachments
+            self.assertEqual(attachments.keys(), [key])
+            item.forget_item()
+            self.assertEqual(item.get_item().attachments.keys(), [key])
+            self.assertEqual(item.caption, caption)
+        return d.addCallback(check)
+
+
+class TestFSIndex(FSStoreTestMixin, unittest.TestCase):
+
+    if not fs_storage.haz_sqlite:
+        skip = "sqlite3 is not available"
+
+    def setUp(self):
+        FSStoreTestMixin.setUp(self)
+        self.index_file = self.tmp.child('index.db').path
+
+    def test_round_trip(self):
+        store, d = self.create_store(index_file=self.index_file)
+        def restart(store):
+            self.ids_before = self.ids(store)
+            self.assertEqual(len(self.ids_before), 5)
+            store, d = self.restart(store, index_file=self.index_file)
+            """ the tree is there before anything was walked """
+            self.assertEqual(self.ids(store), self.ids_before)
+            return d
+        def check(store):
+            self.assertEqual(self.ids(store), self.ids_before)
+        d.addCallback(restart)
+        d.addCallback(check)
+        return d
+
+    def test_reconcile(self):
+        store, d = self.create_store(index_file=self.index_file)
+        album = self.content.child('album')
+        def restart(store):
+            self.ids_before = self.ids(store)
+            self.content.child('a.mp3').remove()
+            album.child('c.mp3').setContent('changed content')
+            album.child('d.mp3').setContent('d.mp3')
+            store, d = self.restart(store, index_file=self.index_file)
+            return d
+        def check(store):
+            ids = self.ids(store)
+            self.assertFalse(self.content.child('a.mp3').path in ids)
+            for name in ('b.mp3', 'c.mp3'):
+                path = album.child(name).path
+                self.assertEqual(ids[path], self.ids_before[path])
+            self.assertEqual(store.store[ids[album.child('c.mp3').path]].size,
+                             len('changed content'))
+            self.assertFalse(ids[album.child('d.mp3').path] in self.ids_before.values())
+            self.assertEqual(len(ids), 5)
+            """ and all of that went into the index """
+            store, d = self.restart(store, index_file=self.index_file)
+            self.assertEqual(self.ids(store), ids)
+            return d
+        d.addCallback(restart)
+        d.addCallback(check)
+        return d
+
+    def test_id_in_use(self):
+        """ a root container takes the id the content folder
+            had before, only the folder gets a new one
+        """
+        store, d = self.create_store(index_file=self.index_file)
+        def restart(store):
+            self.ids_before = self.ids(store)
+            store, d = self.restart(store, index_file=self.index_file, create_root='yes')
+            ids = self.ids(store)
+            self.assertEqual(store.store['1000'].mimetype, 'root')
+            self.assertNotEqual(ids[self.content.path], self.ids_before[self.content.path])
+            for path in self.ids_before:
+                if path != self.content.path:
+                    self.assertEqual(ids[path], self.ids_before[path])
+            self.assertEqual(len(ids), 5)
+            return d
+        def check(store):
+            ids = self.ids(store)
+            store, d = self.restart(store, index_file=self.index_file, create_root='yes')
+            self.assertEqual(self.ids(store), ids)
+            return d
+        d.addCallback(restart)
+        d.addCallback(check)
+        return d
+
+    def test_not_an_index(self):
+        FilePath(self.index_file).setContent('this is no sqlite file' * 100)
+        store, d = self.create_store(index_file=self.index_file)
+        self.assertEqual(store.index, None)
+        d.addCallback(lambda store: self.assertEqual(len(self.ids(store)), 5))
+        return d
+
+    def test_index_of_another_version(self):
+        import sqlite3
+        db = sqlite3.connect(self.index_file)
+        db.execute('CREATE TABLE items (path TEXT, something TEXT)')
+        db.execute("INSERT INTO items VALUES ('/nowhere', 'else')")
+        db.execute('PRAGMA user_version = 99')
+        db.commit()
+        db.close()
+        store, d = self.create_store(index_file=self.index_file)
+        def restart(store):
+            self.ids_before = self.ids(store)
+            self.assertEqual(len(self.ids_before), 5)
+            store, d = self.restart(store, index_file=self.index_file)
+            self.assertEqual(self.ids(store), self.ids_before)
+            return d
+        return d.addCallback(restart)
@@ -23,9 +23,11 @@ from coherence import log
 from coherence.upnp.core.ssdp import SSDPServer
 from coherence.upnp.core.msearch import MSearch
 from coherence.upnp.core.device import Device, RootDevice
+from coherence.upnp.core.device_registry import DeviceRegistry
 from coherence.upnp.core.utils import parse_xml, get_ip_address, get_host_address
 
 from coherence.upnp.core.utils import Site
+from coherence.upnp.core import http_pool
 
 from coherence.upnp.devices.control_point import ControlPoint
 from coherence.upnp.devices.media_server import MediaServer
@@ -236,7 +238,8 @@ class Coherence(log.Loggable):
     def setup(self, config={}):
         self.mirabeau = None
 
-        self.devices = []
+        self.registry = DeviceRegistry()
+        self.devices = self.registry.devices
         self.children = {}
         self._callbacks = {}
         self.active_backends = {}
@@ -249,6 +252,14 @@ class Coherence(log.Loggable):
 
         self.web_server_port = int(config.get('serverport', 0))
 
+        """ the keep-alive connections to the devices we talk to,
+            connections per device, seconds an idle connection is
+            kept open and requests pipelined on a connection
+        """
+        http_pool.configure(max_connections=config.get('http_max_connections', 2),
+                            idle_timeout=config.get('http_idle_timeout', 10),
+                            pipelining=config.get('http_pipelining', 1))
+
         """ initializes logsystem
             a COHERENCE_DEBUG environment variable overwrites
             all level settings here
@@ -325,6 +336,7 @@ class Coherence(log.Loggable):
         self.ssdp_server = SSDPServer(test=unittest,interface=self.hostname)
         louie.connect( self.create_device, 'Coherence.UPnP.SSDP.new_device', louie.Any)
         louie.connect( self.remove_device, 'Coherence.UPnP.SSDP.removed_device', louie.Any)
+        louie.connect( self.remove_devices, 'Coherence.UPnP.SSDP.removed_devices', louie.Any)
         louie.connect( self.add_device, 'Coherence.UPnP.RootDevice.detection_completed', louie.Any)
         #louie.connect( self.receiver, 'Coherence.UPnP.Service.detection_completed', louie.Any)
 
@@ -566,10 +578,12 @@ class Coherence(log.Loggable):
                 """anything left over"""
                 louie.disconnect( self.create_device, 'Coherence.UPnP.SSDP.new_device', louie.Any)
                 louie.disconnect( self.remove_device, 'Coherence.UPnP.SSDP.removed_device', louie.Any)
+                louie.disconnect( self.remove_devices, 'Coherence.UPnP.SSDP.removed_devices', louie.Any)
                 louie.disconnect( self.add_device, 'Coherence.UPnP.RootDevice.detection_completed', louie.Any)
                 self.ssdp_server.shutdown()
                 if self.ctrl:
                     self.ctrl.shutdown()
+                http_pool.get_pool().close()
                 self.warning('Coherence UPnP framework shutdown')
                 return result
 
@@ -605,39 +619,32 @@ class Coherence(log.Loggable):
             callback(*args)
 
     def get_device_by_host(self, host):
-        found = []
-        for device in self.devices:
-            if device.get_host() == host:
-                found.append(device)
-        return found
+        return self.registry.get_by_host(host)
 
     def get_device_with_usn(self, usn):
-        found = None
-        for device in self.devices:
-            if device.get_usn() == usn:
-                found = device
-                break
-        return found
+        return self.registry.get_by_usn(usn)
 
     def get_device_with_id(self, device_id):
-        found = None
-        for device in self.devices:
-            id = device.get_id()
-            if device_id[:5] != 'uuid:':
-                id = id[5:]
-            if id == device_id:
-                found = device
-                break
-        return found
+        """ device_id is an UDN, with or without its 'uuid:',
+            of a root or of an embedded device
+        """
+        return self.registry.get_by_udn(device_id)
 
     def get_devices(self):
         return self.devices
 
+    def get_devices_by_type(self, device_type):
+        """ device_type is either the full one, like
+            'urn:schemas-upnp-org:device:MediaServer:1',
+            or the friendly one, like 'MediaServer'
+        """
+        return self.registry.get_by_type(device_type)
+
     def get_local_devices(self):
-        return [d for d in self.devices if d.manifestation == 'local']
+        return self.registry.get_by_manifestation('local')
 
     def get_nonlocal_devices(self):
-        return [d for d in self.devices if d.manifestation == 'remote']
+        return self.registry.get_by_manifestation('remote')
 
     def create_device(self, device_type, infos):
         self.info("creating ", infos['ST'],infos['USN'])
@@ -656,19 +663,24 @@ class Coherence(log.Loggable):
 
     def add_device(self, device):
         self.info("adding device",device.get_id(),device.get_usn(),device.friendly_device_type)
-        self.devices.append(device)
+        self.registry.add(device)
 
     def remove_device(self, device_type, infos):
         self.info("removed device",infos['ST'],infos['USN'])
         device = self.get_device_with_usn(infos['USN'])
         if device:
             louie.send('Coherence.UPnP.Device.removed', None, usn=infos['USN'])
-            self.devices.remove(device)
+            self.registry.remove(device)
             device.remove()
             if infos['ST'] == 'upnp:rootdevice':
                 louie.send('Coherence.UPnP.RootDevice.removed', None, usn=infos['USN'])
                 self.callback("removed_device", infos['ST'], infos['USN'])
 
+    def remove_devices(self, infos):
+        """ the SSDP server expired several root devices at once """
+        for info in infos:
+            self.remove_device(info['ST'], info)
+
 
     def add_web_resource(self, name, sub):
         self.children[name] = sub
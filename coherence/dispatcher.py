@@ -1,5 +1,9 @@
 
+import weakref
+from collections import deque
+
 from twisted.internet import defer
+from twisted.python import failure, log
 
 class Receiver(object):
     def __init__(self, signal, callback, args, kwargs):
@@ -16,6 +20,9 @@ class Receiver(object):
             kw.update(kwargs)
         return self.callback(*args, **kw)
 
+    def matches(self, callback):
+        return self.callback is callback or self.callback == callback
+
     def __repr__(self):
         return "<Receiver %s for %s: %s (%s, %s)>" % (id(self),
                 self.signal,
@@ -28,6 +35,44 @@ class Receiver(object):
                         )
                 )
 
+class WeakReceiver(Receiver):
+    """ a Receiver for a bound method, which doesn't keep the
+        object of the method alive, on_dead is called with the
+        receiver once the object is gone
+    """
+
+    def __init__(self, signal, callback, args, kwargs, on_dead=None):
+        self.signal = signal
+        self.function = callback.im_func
+        self.arguments = args
+        self.keywords = kwargs
+        if on_dead is not None:
+            self.obj = weakref.ref(callback.im_self, lambda ref: on_dead(self))
+        else:
+            self.obj = weakref.ref(callback.im_self)
+
+    @property
+    def callback(self):
+        obj = self.obj()
+        if obj is None:
+            return None
+        return self.function.__get__(obj, obj.__class__)
+
+    def __call__(self, *args, **kwargs):
+        callback = self.callback
+        if callback is None:
+            return None
+        args = args + self.arguments
+        if self.keywords:
+            kw = self.keywords.copy()
+            kw.update(kwargs)
+            kwargs = kw
+        return callback(*args, **kwargs)
+
+    def matches(self, callback):
+        return (getattr(callback, 'im_func', None) is self.function and
+                callback.im_self is self.obj())
+
 class UnknownSignal(Exception): pass
 
 class Dispatcher(object):
@@ -109,6 +154,168 @@ class Dispatcher(object):
             raise UnknownSignal(signal)
 
 
+class SignalDispatcher(object):
+    """
+    Dispatches signals of any name, to the receivers connected to them
+    for any sender and to those connected for the sender of the signal.
+
+    The receivers are kept by signal and by sender, a delivery looks up
+    just the receivers it goes to. A send is delivered on the next
+    mainloop iteration, together with all the other sends since the last
+    one, in the order they were sent, to the receivers connected then.
+
+    The receivers for a sender are kept by its id, like louie does, and
+    are dropped with the sender, so another object getting the same id
+    later doesn't get them. A bound method connected weak is disconnected
+    once its object is gone. The lists of receivers are never changed in
+    place, only replaced, so a delivery can walk them while receivers
+    connect and disconnect.
+    """
+
+    def __init__(self):
+        # signal -> {None or id(sender) -> [receivers]}
+        self.receivers = {}
+        # id(sender) -> weak reference to the sender
+        self.senders = {}
+        self.pending = deque()
+        self.flush_call = None
+        self.sent = 0
+        self.skipped = 0
+
+    def _key(self, sender):
+        if sender is None:
+            return None
+        return id(sender)
+
+    def _track(self, sender):
+        """ drop the receivers for sender when it is gone,
+            a sender that can't be weakly referenced, like a
+            string, is kept by its id only
+        """
+        key = id(sender)
+        if key in self.senders:
+            return
+        try:
+            self.senders[key] = weakref.ref(sender, lambda ref: self._sender_gone(key))
+        except TypeError:
+            pass
+
+    def _sender_gone(self, key):
+        self.senders.pop(key, None)
+        for signal, senders in self.receivers.items():
+            if key in senders:
+                del senders[key]
+                if not senders:
+                    del self.receivers[signal]
+
+    def connect(self, signal, callback, sender=None, weak=True, *args, **kw):
+        """ sender None connects to the signal from any sender,
+            connecting the same callback twice connects it once
+        """
+        key = self._key(sender)
+        if key is not None:
+            self._track(sender)
+        senders = self.receivers.setdefault(signal, {})
+        receivers = senders.get(key, [])
+        for receiver in receivers:
+            if receiver.matches(callback):
+                return receiver
+        if weak and getattr(callback, 'im_self', None) is not None:
+            receiver = WeakReceiver(signal, callback, args, kw,
+                            on_dead=lambda r: self._remove(signal, key, r))
+        else:
+            receiver = Receiver(signal, callback, args, kw)
+        senders[key] = receivers + [receiver]
+        return receiver
+
+    def disconnect(self, signal, callback, sender=None):
+        """ sender None disconnects the callback from
+            the signal for whatever sender it was connected
+        """
+        senders = self.receivers.get(signal)
+        if not senders:
+            return
+        if sender is None:
+            keys = senders.keys()
+        else:
+            keys = [self._key(sender)]
+        for key in keys:
+            for receiver in senders.get(key, ()):
+                if receiver.matches(callback):
+                    self._remove(signal, key, receiver)
+
+    def _remove(self, signal, key, receiver):
+        senders = self.receivers.get(signal)
+        if senders is None or receiver not in senders.get(key, ()):
+            return
+        receivers = [r for r in senders[key] if r is not receiver]
+        if receivers:
+            senders[key] = receivers
+        else:
+            del senders[key]
+            if not senders:
+                del self.receivers[signal]
+
+    def has_receivers(self, signal, sender=None):
+        senders = self.receivers.get(signal)
+        if not senders:
+            return False
+        if None in senders:
+            return True
+        return sender is not None and id(sender) in senders
+
+    def send(self, signal, sender=None, *args, **kwargs):
+        """ the receivers are looked up on delivery, so one
+            connected later in this iteration gets the signal too
+        """
+        self.sent += 1
+        self.pending.append((signal, sender, args, kwargs))
+        if self.flush_call is None:
+            from twisted.internet import reactor
+            self.flush_call = reactor.callLater(0, self.flush)
+
+    def flush(self):
+        """ deliver what was sent until now, what is sent
+            meanwhile waits for the next iteration
+        """
+        self.flush_call = None
+        for i in xrange(len(self.pending)):
+            signal, sender, args, kwargs = self.pending.popleft()
+            self.deliver(signal, sender, args, kwargs)
+
+    def emit(self, signal, sender=None, *args, **kwargs):
+        """ deliver right away """
+        self.deliver(signal, sender, args, kwargs)
+
+    def deliver(self, signal, sender, args, kwargs):
+        senders = self.receivers.get(signal)
+        if not senders:
+            self.skipped += 1
+            return
+        receivers = senders.get(None, [])
+        if sender is not None:
+            receivers = senders.get(id(sender), []) + receivers
+        if not receivers:
+            self.skipped += 1
+            return
+        for receiver in receivers:
+            try:
+                result = receiver(*args, **kwargs)
+            except Exception:
+                log.err(failure.Failure(), "error in %r" % receiver)
+            else:
+                if isinstance(result, defer.Deferred):
+                    result.addErrback(log.err, "error in %r" % receiver)
+
+    def reset(self):
+        if self.flush_call is not None and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+        self.pending.clear()
+        self.receivers = {}
+        self.senders = {}
+
+
 class SignalingProperty(object):
     """
     Does emit self.signal when the value has changed but only if HAS changed
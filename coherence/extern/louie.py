@@ -2,14 +2,13 @@
     Wrapper module for the louie implementation
 """
 
-import warnings
-from coherence.dispatcher import Dispatcher
+from coherence.dispatcher import SignalDispatcher
 
 class Any(object): pass
 class All(object): pass
 class Anonymous(object): pass
 
-# fake the API 
+# fake the API
 class Dummy(object): pass
 signal = Dummy()
 sender = Dummy()
@@ -21,54 +20,32 @@ sender.Any = Any
 #signals
 signal.All = All
 
-# a slightly less raise-y-ish implementation as louie was not so picky, too
-class GlobalDispatcher(Dispatcher):
-
-    def connect(self, signal, callback, *args, **kw):
-        if not signal in self.receivers:
-            # ugly hack
-            self.receivers[signal] = []
-        return Dispatcher.connect(self, signal, callback, *args, **kw)
-
-    def _get_receivers(self, signal):
-        try:
-            return self.receivers[signal]
-        except KeyError:
-            return []
-
 global _global_dispatcher
-_global_dispatcher = GlobalDispatcher()
-_global_receivers_pool = {}
+_global_dispatcher = SignalDispatcher()
 
-def _display_deprecation_warning():
-    warnings.warn("extern.louie will soon be deprecated in favor of coherence.dispatcher.")
+def _sender(sender):
+    """ the dispatcher knows only None for
+        any sender or no sender in particular
+    """
+    if sender in (Any, All, Anonymous):
+        return None
+    return sender
 
 def connect(receiver, signal=All, sender=Any, weak=True):
-    callback = receiver
     if signal in (Any, All):
         raise NotImplemented("This is not allowed. Signal HAS to be something")
-    if sender not in (Any, All):
-        _display_deprecation_warning()
-    receiver = _global_dispatcher.connect(signal, callback)
-    _global_receivers_pool[(callback, signal)] = receiver
-    return receiver
+    return _global_dispatcher.connect(signal, receiver, _sender(sender), weak)
 
 def disconnect(receiver, signal=All, sender=Any, weak=True):
-    callback = receiver
     if signal in (Any, All):
         raise NotImplemented("This is not allowed. Signal HAS to be something")
-    if sender not in (Any, All):
-        _display_deprecation_warning()
-    receiver = _global_receivers_pool.pop((callback, signal))
-    return _global_dispatcher.disconnect(receiver)
+    return _global_dispatcher.disconnect(signal, receiver, _sender(sender))
 
 def send(signal=All, sender=Anonymous, *arguments, **named):
     if signal in (Any, All):
         raise NotImplemented("This is not allowed. Signal HAS to be something")
-    if sender not in (Anonymous, None):
-        _display_deprecation_warning()
-    # the first value of the callback shall always be the signal:
-    return _global_dispatcher.save_emit(signal, *arguments, **named)
+    # the receivers get only the arguments, neither the signal nor the sender
+    return _global_dispatcher.send(signal, _sender(sender), *arguments, **named)
 
 def send_minimal(signal=All, sender=Anonymous, *arguments, **named):
     return send(signal, sender, *arguments, **named)
@@ -79,4 +56,6 @@ def send_exact(signal=All, sender=Anonymous, *arguments, **named):
 def send_robust(signal=All, sender=Anonymous, *arguments, **named):
     return send(signal, sender, *arguments, **named)
 
-
+def reset():
+    """ disconnect everything, drop what wasn't delivered yet """
+    _global_dispatcher.reset()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{backend.SortedChildren}
+"""
+
+from twisted.trial import unittest
+
+from coherence.backend import SortedChildren
+
+
+class Child(object):
+
+    def __init__(self, name, path=None):
+        self.name = name
+        self.path = path or '/' + name
+
+    def __repr__(self):
+        return self.name
+
+
+def by_name(child):
+    return child.name
+
+def by_path(child):
+    return child.path
+
+
+class TestSortedChildren(unittest.TestCase):
+
+    def setUp(self):
+        self.children = SortedChildren(by_name, by_path)
+        self.c, self.a, self.b = [Child(name) for name in 'cab']
+        for child in (self.c, self.a, self.b):
+            self.children.append(child)
+
+    def names(self):
+        return ''.join([child.name for child in self.children])
+
+    def test_append_and_lookup(self):
+        self.assertEqual(self.names(), 'abc')
+        self.assertEqual(len(self.children), 3)
+        self.assertEqual(self.children[1:], [self.b, self.c])
+        self.assertTrue(self.children.get('/b') is self.b)
+        self.assertTrue(self.b in self.children)
+        self.assertEqual(self.children.index(self.c), 2)
+        self.assertEqual(self.children.count(self.a), 1)
+
+    def test_equal_keys_keep_their_order(self):
+        first, second = Child('b', '/1'), Child('b', '/2')
+        self.children.extend([first, second])
+        self.assertEqual(list(self.children), [self.a, self.b, first, second, self.c])
+
+    def test_remove(self):
+        self.children.remove(self.b)
+        self.assertEqual(self.names(), 'ac')
+        self.assertEqual(self.children.get('/b'), None)
+        self.assertRaises(ValueError, self.children.remove, self.b)
+        self.assertRaises(ValueError, self.children.index, self.b)
+
+    def test_list_api(self):
+        self.children.insert(0, Child('d'))
+        self.assertEqual(self.names(), 'abcd')
+        self.assertTrue(self.children.pop() is not None)
+        self.assertTrue(self.children.pop(0) is self.a)
+        self.assertEqual(self.names(), 'bc')
+        self.children[0] = Child('e')
+        self.assertEqual(self.names(), 'ce')
+        self.assertEqual(self.children.get('/b'), None)
+        self.children[0:1] = [Child('f'), Child('a')]
+        self.assertEqual(self.names(), 'aef')
+        del self.children[-1]
+        del self.children[:1]
+        self.assertEqual(self.names(), 'e')
+        self.children.pop()
+        self.assertRaises(IndexError, self.children.pop)
+
+    def test_sort(self):
+        self.children.sort(reverse=True, key=by_name)
+        self.assertEqual(self.names(), 'cba')
+        self.children.append(Child('bb'))
+        self.assertEqual(self.names(), 'cbbba')
+        self.children.sort(cmp=lambda x, y: cmp(x.name, y.name))
+        self.assertEqual(self.names(), 'abbbc')
+        self.assertTrue(self.a in self.children)
+
+    def test_update(self):
+        """ a new title, and path, moves the child """
+        self.a.name = 'z'
+        self.a.path = '/z'
+        self.assertEqual(self.names(), 'zbc')
+        self.assertTrue(self.a in self.children)
+        self.children.update(self.a)
+        self.assertEqual(self.names(), 'bcz')
+        self.assertTrue(self.children.get('/z') is self.a)
+        self.assertEqual(self.children.get('/a'), None)
+        self.children.remove(self.a)
+        self.assertEqual(self.names(), 'bc')
@@ -1,8 +1,11 @@
 
+import gc
+
 from twisted.trial import unittest
 from twisted.internet import defer
 from coherence.dispatcher import Dispatcher, UnknownSignal, Receiver, \
-        SignalingProperty, ChangedSignalingProperty, CustomSignalingProperty
+        SignalingProperty, ChangedSignalingProperty, CustomSignalingProperty, \
+        SignalDispatcher
 
 class TestDispatcher(Dispatcher):
     __signals__ = {'test': 'Test signal'}
@@ -469,3 +472,103 @@ class TestStayInObjectSignaling(unittest.TestCase):
 
         self.assertEquals(self.foo.emitted[0][1][0], 'A')
         self.assertEquals(self.bar.emitted[0][1][0], 'B')
+
+class Listener(object):
+
+    def __init__(self):
+        self.received = []
+
+    def callback(self, *args, **kwargs):
+        self.received.append((args, kwargs))
+
+class TestSignalDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = SignalDispatcher()
+        self.any = Listener()
+        self.one = Listener()
+        self.sender = object()
+
+    def tearDown(self):
+        self.dispatcher.reset()
+
+    def test_senders(self):
+        self.dispatcher.connect('test', self.any.callback)
+        self.dispatcher.connect('test', self.one.callback, self.sender)
+        self.dispatcher.send('test', None, 1)
+        self.dispatcher.send('test', self.sender, 2, key='a')
+        self.dispatcher.send('test', object(), 3)
+        self.assertEquals(self.any.received, [])
+        self.dispatcher.flush()
+        self.assertEquals(self.any.received, [((1,), {}), ((2,), {'key': 'a'}), ((3,), {})])
+        self.assertEquals(self.one.received, [((2,), {'key': 'a'})])
+
+    def test_batched(self):
+        """ one delivery for everything sent
+            in a mainloop iteration
+        """
+        self.dispatcher.connect('test', self.any.callback)
+        self.dispatcher.send('test', None, 1)
+        call = self.dispatcher.flush_call
+        self.dispatcher.send('test', None, 2)
+        self.assertTrue(self.dispatcher.flush_call is call)
+        self.assertEquals(len(self.dispatcher.pending), 2)
+
+    def test_no_receivers(self):
+        self.dispatcher.connect('test', self.one.callback, self.sender)
+        self.dispatcher.send('other', None, 1)
+        self.dispatcher.send('test', None, 1)
+        self.dispatcher.send('test', object(), 1)
+        self.dispatcher.flush()
+        self.assertEquals(self.one.received, [])
+        self.assertEquals((self.dispatcher.sent, self.dispatcher.skipped), (3, 3))
+
+    def test_connected_after_send(self):
+        """ the receivers are the ones connected on delivery """
+        self.dispatcher.send('test', self.sender, 1)
+        self.dispatcher.connect('test', self.one.callback, self.sender)
+        self.dispatcher.flush()
+        self.assertEquals(self.one.received, [((1,), {})])
+
+    def test_sender_gone(self):
+        """ the receivers for a sender go with it, and
+            don't get the signals of an object that
+            gets its id later on
+        """
+        sender = Listener()
+        key = id(sender)
+        self.dispatcher.connect('test', self.one.callback, sender)
+        self.assertEquals(self.dispatcher.receivers['test'].keys(), [key])
+        del sender
+        gc.collect()
+        self.assertEquals(self.dispatcher.receivers, {})
+        self.assertEquals(self.dispatcher.senders, {})
+
+    def test_connect_twice(self):
+        self.dispatcher.connect('test', self.any.callback)
+        self.dispatcher.connect('test', self.any.callback)
+        self.dispatcher.connect('test', self.any.callback, self.sender)
+        self.dispatcher.emit('test', self.sender)
+        self.assertEquals(len(self.any.received), 2)
+        """ without a sender from all of them """
+        self.dispatcher.disconnect('test', self.any.callback)
+        self.assertEquals(self.dispatcher.receivers, {})
+
+    def test_weak(self):
+        self.dispatcher.connect('test', self.one.callback, self.sender)
+        self.dispatcher.connect('test', self.any.callback, weak=False)
+        self.dispatcher.send('test', self.sender)
+        del self.one
+        gc.collect()
+        self.dispatcher.flush()
+        self.assertEquals(len(self.any.received), 1)
+        self.assertEquals(self.dispatcher.receivers['test'].keys(), [None])
+
+    def test_failing_receiver(self):
+        def fail():
+            raise TypeError(':(')
+        self.dispatcher.connect('test', fail)
+        self.dispatcher.connect('test', self.any.callback)
+        self.dispatcher.emit('test')
+        self.assertEquals(len(self.any.received), 1)
+        self.assertEquals(len(self.flushLoggedErrors(TypeError)), 1)
@@ -1,12 +1,20 @@
 # -*- coding: utf-8 -*-
 
+import os
+import sys
+from collections import deque
+
 from twisted.trial.unittest import TestCase
+from twisted.internet import reactor, defer, task
+from twisted.python.filepath import FilePath
 
 from coherence.transcoder import TranscoderManager, get_transcoder_name
 
 from coherence.transcoder import (PCMTranscoder, WAVTranscoder, MP3Transcoder,
         MP4Transcoder, MP2TSTranscoder, ThumbTranscoder, GStreamerTranscoder,
-        ExternalProcessPipeline)
+        ExternalProcessPipeline, ExternalProcessProducer, TranscodeCache,
+        TranscodeStream, TranscodeHead)
+from coherence.upnp.core.utils import StaticFile
 
 known_transcoders = [PCMTranscoder, WAVTranscoder, MP3Transcoder, MP4Transcoder,
         MP2TSTranscoder, ThumbTranscoder]
@@ -151,4 +159,298 @@ class TestTranscoderAutoloading(TranscoderTestMixin, TestCase):
         self.assertNotEquals(id(transcoder_a), id(transcoder_b))
 
 
+class SlowRequest(object):
+    """ a request whose client reads nothing,
+        as long as it is stalled
+    """
+
+    def __init__(self):
+        self.producer = None
+        self.data = []
+        self.written = 0
+        self.stalled = True
+        self.finished = False
+        self.finish_deferred = defer.Deferred()
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def notifyFinish(self):
+        return self.finish_deferred
+
+    def write(self, data):
+        self.data.append(data)
+        self.written += len(data)
+        if self.stalled:
+            self.producer.pauseProducing()
+
+    def finish(self):
+        self.finished = True
+        self.finish_deferred.callback(None)
+
+    def catch_up(self):
+        self.stalled = False
+        self.producer.resumeProducing()
 
+
+class TestExternalProcessProducer(TestCase):
+    """ the process writes 64 lines of 64k """
+
+    def setUp(self):
+        script = FilePath(self.mktemp())
+        script.setContent("import sys\n"
+                          "for i in range(64):\n"
+                          "    sys.stdout.write('%02d' % i + 'x' * 65533 + '\\n')\n")
+        self.pipeline = '%s -u %s' % (sys.executable, script.path)
+        self.request = SlowRequest()
+
+    def test_backpressure(self):
+        producer = ExternalProcessProducer(self.pipeline, self.request,
+                                           high_water=256 * 1024, low_water=64 * 1024)
+        def stalled():
+            """ the process is blocked, not ended """
+            self.assertFalse(producer.reading)
+            self.assertFalse(producer.ended)
+            self.assertTrue(producer.buffered > producer.high_water)
+            self.assertTrue(producer.buffered < producer.high_water + 128 * 1024)
+            self.assertEqual(self.request.written, len(self.request.data[0]))
+            self.request.catch_up()
+            return self.request.notifyFinish()
+        def check(_):
+            self.assertTrue(self.request.finished)
+            self.assertEqual(self.request.written, 64 * 65536)
+            data = ''.join(self.request.data)
+            self.assertEqual([data[i * 65536:i * 65536 + 2] for i in range(64)],
+                             ['%02d' % i for i in range(64)])
+            return producer.deferred
+        d = task.deferLater(reactor, 0.5, stalled)
+        d.addCallback(check)
+        return d
+
+    def test_client_gone(self):
+        producer = ExternalProcessProducer(self.pipeline, self.request)
+        def gone():
+            self.request.finish_deferred.errback(Exception('connection lost'))
+            return producer.deferred
+        def check(status):
+            self.assertFalse(self.request.finished)
+            self.assertNotEqual(status.exitCode, 0)
+            self.assertEqual(producer.waiting, deque())
+        d = task.deferLater(reactor, 0.2, gone)
+        d.addCallback(check)
+        return d
+
+
+class Client(object):
+    """ a request whose client reads everything right away,
+        unless it is stalled
+    """
+
+    stalled = False
+
+    def __init__(self, method='GET'):
+        self.method = method
+        self.producer = None
+        self.headers = {}
+        self.data = []
+        self.finish_deferreds = []
+        self.transport = self
+
+    def setResponseCode(self, code, message=None):
+        self.code = code
+
+    def setHeader(self, name, value):
+        self.headers[name.lower()] = value
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        reactor.callLater(0, producer.resumeProducing)
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def notifyFinish(self):
+        d = defer.Deferred()
+        self.finish_deferreds.append(d)
+        return d
+
+    def write(self, data):
+        self.data.append(data)
+        if not self.stalled:
+            reactor.callLater(0, self.producer.resumeProducing)
+
+    def catch_up(self):
+        self.stalled = False
+        reactor.callLater(0, self.producer.resumeProducing)
+
+    def finish(self):
+        for d in self.finish_deferreds:
+            d.callback(''.join(self.data))
+
+    def connection_lost(self):
+        for d in self.finish_deferreds:
+            d.errback(Exception('connection lost'))
+
+    def loseConnection(self):
+        self.connection_lost()
+
+
+class TestTranscodeSessions(TestCase):
+    """ the process writes the source 64 times in upper case,
+        and counts its runs in a file next to it
+    """
+
+    def setUp(self):
+        directory = FilePath(self.mktemp())
+        directory.makedirs()
+        self.source = directory.child('source.txt')
+        self.source.setContent('a' * 65535 + '\n')
+        script = directory.child('upper.py')
+        script.setContent("import sys\n"
+                          "open(sys.argv[1] + '.runs', 'a').write('.')\n"
+                          "data = open(sys.argv[1]).read().upper()\n"
+                          "for i in range(64):\n"
+                          "    sys.stdout.write(data)\n"
+                          "    if i == 8 and len(sys.argv) > 2:\n"
+                          "        sys.exit(1)\n")
+        self.cache = directory.child('cache')
+        pipeline = '%s -u %s %%s' % (sys.executable, script.path)
+        self.config = {'transcoder': [
+                            {'name': 'upper', 'type': 'process', 'target': 'text/plain',
+                             'pipeline': pipeline},
+                            {'name': 'broken', 'type': 'process', 'target': 'text/plain',
+                             'pipeline': pipeline + ' fail'}],
+                       'transcoder_cache': self.cache.path}
+        self.manager = TranscoderManager(TestTranscoderAutoloading.CoherenceStump(**self.config))
+
+    def tearDown(self):
+        TranscoderManager._instance_ = None
+
+    def render(self, resource, stalled=False):
+        client = Client()
+        client.stalled = stalled
+        resource.render(client)
+        return client
+
+    def test_shared(self):
+        first = self.render(self.manager.transcode('upper', self.source.path))
+        second = self.render(self.manager.transcode('upper', self.source.path))
+        self.assertEqual(len(self.manager.sessions), 1)
+        self.assertEqual(second.headers['content-type'], 'text/plain')
+        def check(results):
+            for data in results:
+                self.assertEqual(data, ('A' * 65535 + '\n') * 64)
+            self.assertEqual(FilePath(self.source.path + '.runs').getContent(), '.')
+            self.assertEqual(self.manager.sessions, {})
+            """ now it is served from the cache """
+            cached = self.manager.transcode('upper', self.source.path)
+            self.assertTrue(isinstance(cached, StaticFile))
+            self.assertEqual(cached.getFileSize(), 64 * 65536)
+            self.assertEqual(self.cache.listdir(), [self.manager.cache.get_name(
+                    (self.source.path, self.source.getModificationTime(), 'upper'))])
+            """ unless the source was changed """
+            mtime = self.source.getModificationTime() + 10
+            os.utime(self.source.path, (mtime, mtime))
+            stream = self.manager.transcode('upper', self.source.path)
+            self.assertTrue(isinstance(stream, TranscodeStream))
+            producer = stream.session.producer
+            self.render(stream).connection_lost()
+            return producer.deferred
+        d = defer.gatherResults([first.notifyFinish(), second.notifyFinish()])
+        d.addCallback(check)
+        return d
+
+    def test_all_clients_gone(self):
+        client = self.render(self.manager.transcode('upper', self.source.path))
+        session = self.manager.sessions.values()[0]
+        producer = session.producer
+        client.connection_lost()
+        self.assertEqual(self.manager.sessions, {})
+        self.assertEqual(self.cache.listdir(), [])
+        def check(status):
+            self.assertNotEqual(status.exitCode, 0)
+        return producer.deferred.addCallback(check)
+
+    def test_failed(self):
+        """ the process exits with 1 after 9 of the 64 """
+        client = self.render(self.manager.transcode('broken', self.source.path))
+        def check(failure):
+            self.assertEqual(len(''.join(client.data)), 9 * 65536)
+            self.assertEqual(self.manager.sessions, {})
+            self.assertEqual(self.cache.listdir(), [])
+        d = client.notifyFinish()
+        d.addCallbacks(lambda _: self.fail("finished"), check)
+        return d
+
+    def test_head(self):
+        head = self.manager.transcode('upper', self.source.path, 'HEAD')
+        self.assertTrue(isinstance(head, TranscodeHead))
+        client = Client('HEAD')
+        self.assertEqual(head.render(client), '')
+        self.assertEqual(client.headers['content-type'], 'text/plain')
+        self.assertEqual(self.manager.sessions, {})
+        self.assertFalse(os.path.exists(self.source.path + '.runs'))
+
+    def test_not_a_file(self):
+        """ maybe a live stream, not shared and not cached """
+        transcoder = self.manager.transcode('upper', 'http://host/stream')
+        self.assertTrue(isinstance(transcoder, ExternalProcessPipeline))
+        self.assertEqual(self.manager.sessions, {})
+
+    def test_larger_than_the_cache(self):
+        TranscoderManager._instance_ = None
+        self.config['transcoder_cache_size'] = 1
+        self.manager = TranscoderManager(TestTranscoderAutoloading.CoherenceStump(**self.config))
+        first = self.render(self.manager.transcode('upper', self.source.path), stalled=True)
+        second = self.render(self.manager.transcode('upper', self.source.path))
+        session = self.manager.sessions.values()[0]
+        """ a third client asks while the first is still reading
+            the file, it gets a session and a file of its own
+        """
+        third = []
+        overflow = session.overflow
+        def overflowed():
+            overflow()
+            third.append(self.render(self.manager.transcode('upper', self.source.path)))
+            self.assertNotIdentical(third[0].producer.session, session)
+            first.catch_up()
+        session.overflow = overflowed
+        def wait(results):
+            return third[0].notifyFinish().addCallback(lambda data: results + [data])
+        def check(results):
+            self.assertEqual(len(results), 3)
+            for data in results:
+                self.assertEqual(data, ('A' * 65535 + '\n') * 64)
+            self.assertTrue(session.overflowed)
+            self.assertEqual(FilePath(self.source.path + '.runs').getContent(), '..')
+            self.assertEqual(self.manager.sessions, {})
+            self.assertEqual(self.cache.listdir(), [])
+        d = defer.gatherResults([first.notifyFinish(), second.notifyFinish()])
+        d.addCallback(wait)
+        d.addCallback(check)
+        return d
+
+
+class TestTranscodeCache(TestCase):
+
+    def test_eviction(self):
+        directory = FilePath(self.mktemp())
+        cache = TranscodeCache(directory.path, 250)
+        for key in ('a', 'b', 'c'):
+            FilePath(cache.get_partial_path(key)).setContent(key * 100)
+            cache.add(key)
+            """ a is used again, so b is the one to go """
+            cache.get('a')
+        self.assertEqual(cache.size, 200)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(sorted(directory.listdir()),
+                         sorted([cache.get_name('a'), cache.get_name('c')]))
+        """ what is left over is found again, a partial file is removed """
+        FilePath(cache.get_partial_path('d')).setContent('d')
+        cache = TranscodeCache(directory.path, 250)
+        self.assertEqual(cache.size, 200)
+        self.assertEqual(FilePath(cache.get('c')).getContent(), 'c' * 100)
+        self.assertEqual(len(directory.listdir()), 2)
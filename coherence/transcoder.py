@@ -18,11 +18,16 @@ import gst
 import gobject
 gobject.threads_init()
 
+import os
 import os.path
 import urllib
+import hashlib
+import getpass
+import tempfile
+from collections import deque, OrderedDict
 
 from twisted.web import resource, server
-from twisted.internet import protocol
+from twisted.internet import protocol, defer, error
 
 from coherence import log
 
@@ -31,6 +36,15 @@ import struct
 def get_transcoder_name(transcoder):
     return transcoder.name
 
+def abort_request(request, reason):
+    """ ends a response without finishing it, the connection
+        is closed, so the client can tell it didn't get all
+    """
+    if hasattr(request, 'abort'):
+        request.abort(reason)
+    else:
+        request.transport.loseConnection()
+
 class InternalTranscoder(object):
     """ just a class to inherit from and
         which we can look for upon creating our
@@ -318,6 +332,9 @@ class BaseTranscoder(resource.Resource, log.Loggable):
             pass
 
         self.start(request)
+        bus = self.pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect('message', self.on_message, request)
         return server.NOT_DONE_YET
 
     def render_HEAD(self, request):
@@ -334,13 +351,16 @@ class BaseTranscoder(resource.Resource, log.Loggable):
         #reactor.callLater(0, self.pipeline.set_state, gst.STATE_NULL)
         gobject.idle_add(self.cleanup)
 
-    def on_message(self, bus, message):
+    def on_message(self, bus, message, request=None):
         t = message.type
-        print "on_message", t
+        self.debug("on_message %r", t)
         if t == gst.MESSAGE_ERROR:
-            #err, debug = message.parse_error()
-            #print "Error: %s" % err, debug
+            err, debug = message.parse_error()
+            self.warning("error %s, %s", err, debug)
             self.cleanup()
+            """ there won't be an EOS, and what was sent is incomplete """
+            if request is not None:
+                abort_request(request, err)
         elif t == gst.MESSAGE_EOS:
             self.cleanup()
 
@@ -530,87 +550,142 @@ class ExternalProcessProtocol(protocol.ProcessProtocol):
         self.caller = caller
 
     def connectionMade(self):
-        print "pp connection made"
+        self.caller.debug("process started")
 
     def outReceived(self, data):
-        #print "outReceived with %d bytes!" % len(data)
         self.caller.write_data(data)
 
     def errReceived(self, data):
-        #print "errReceived! with %d bytes!" % len(data)
-        print "pp (err):", data.strip()
+        self.caller.debug("process (err): %s", data.strip())
 
-    def inConnectionLost(self):
-        #print "inConnectionLost! stdin is closed! (we probably did it)"
-        pass
+    def processEnded(self, status_object):
+        self.caller.process_ended(status_object.value)
 
-    def outConnectionLost(self):
-        #print "outConnectionLost! The child closed their stdout!"
-        pass
 
-    def errConnectionLost(self):
-        #print "errConnectionLost! The child closed their stderr."
-        pass
+class ExternalProcessProducer(log.Loggable):
+    """ feeds what an external process writes to its stdout
+        into a http response
 
-    def processEnded(self, status_object):
-        print "processEnded, status %d" % status_object.value.exitCode
-        print "processEnded quitting"
-        self.caller.ended = True
-        self.caller.write_data('')
+        we are a push producer for the request, when the client
+        can't keep up, the transport pauses us, and we keep what
+        the process writes meanwhile, until there are more than
+        high_water bytes waiting, then we stop reading from the
+        process, which makes the process block on its next write
 
+        once the client caught up and less than low_water bytes
+        are waiting, we read from the process again
 
-class ExternalProcessProducer(object):
+        when the client goes away the process is killed, when the
+        process fails the response is aborted, not finished
+    """
     logCategory = 'externalprocess'
 
-    def __init__(self, pipeline, request):
+    high_water = 1024 * 1024
+    low_water = 256 * 1024
+
+    def __init__(self, pipeline, request, high_water=None, low_water=None):
         self.pipeline = pipeline
         self.request = request
+        if high_water is not None:
+            self.high_water = int(high_water)
+        if low_water is not None:
+            self.low_water = int(low_water)
         self.process = None
         self.written = 0
-        self.data = ''
+        self.waiting = deque()
+        self.buffered = 0
+        self.paused = False
+        self.reading = True
         self.ended = False
-        request.registerProducer(self, 0)
+        self.failed = None
+        """ fires with the exit status of the process """
+        self.deferred = defer.Deferred()
+        request.registerProducer(self, True)
+        request.notifyFinish().addErrback(lambda _: self.stopProducing())
+        self.start()
+
+    def start(self):
+        argv = self.pipeline.split()
+        executable = argv[0]
+        argv[0] = os.path.basename(argv[0])
+        from twisted.internet import reactor
+        self.process = reactor.spawnProcess(ExternalProcessProtocol(self),
+                executable, argv, {})
 
     def write_data(self, data):
-        if data:
-            #print "write %d bytes of data" % len(data)
+        if self.request is None:
+            return
+        self.waiting.append(data)
+        self.buffered += len(data)
+        self.flush()
+        if self.reading and self.buffered > self.high_water:
+            self.debug("pause reading, %d bytes waiting", self.buffered)
+            self.reading = False
+            self.process.pauseProducing()
+
+    def flush(self):
+        while self.waiting and not self.paused and self.request is not None:
+            data = self.waiting.popleft()
+            self.buffered -= len(data)
             self.written += len(data)
-            # this .write will spin the reactor, calling .doWrite and then
-            # .resumeProducing again, so be prepared for a re-entrant call
+            # this may call pauseProducing already
             self.request.write(data)
-        if self.request and self.ended:
-            print "closing"
-            self.request.unregisterProducer()
-            self.request.finish()
+        if self.request is None:
+            return
+        if not self.reading and not self.ended and self.buffered <= self.low_water:
+            self.debug("resume reading, %d bytes waiting", self.buffered)
+            self.reading = True
+            self.process.resumeProducing()
+        if self.ended and not self.waiting:
+            self.debug("finished, %d bytes written", self.written)
+            request = self.request
             self.request = None
+            request.unregisterProducer()
+            if self.failed is None:
+                request.finish()
+            else:
+                self.warning("process failed: %s", self.failed)
+                abort_request(request, self.failed)
+
+    def process_ended(self, status):
+        self.debug("process ended %r", status)
+        if not isinstance(status, error.ProcessDone):
+            self.failed = status
+        self.ended = True
+        self.process = None
+        self.flush()
+        self.deferred.callback(status)
 
     def resumeProducing(self):
-        #print "resumeProducing", self.request
-        if not self.request:
-            return
-        if self.process is None:
-            argv = self.pipeline.split()
-            executable = argv[0]
-            argv[0] = os.path.basename(argv[0])
-            from twisted.internet import reactor
-            self.process = reactor.spawnProcess(ExternalProcessProtocol(self),
-                    executable, argv, {})
+        self.paused = False
+        self.flush()
 
     def pauseProducing(self):
-        pass
+        self.paused = True
 
     def stopProducing(self):
-        print "stopProducing", self.request
-        self.request.unregisterProducer()
-        self.process.loseConnection()
-        self.request.finish()
+        """ the client is gone, and so should be the process """
+        if self.request is None:
+            return
+        self.debug("stopProducing %r", self.request)
         self.request = None
+        self.waiting.clear()
+        self.buffered = 0
+        if self.process is not None:
+            self.process.loseConnection()
+            try:
+                self.process.signalProcess('TERM')
+            except error.ProcessExitedAlready:
+                pass
 
 
 class ExternalProcessPipeline(resource.Resource, log.Loggable):
     logCategory = 'externalprocess'
     addSlash = False
 
+    high_water = None
+    low_water = None
+
     def __init__(self, uri):
         self.uri = uri
 
@@ -618,25 +693,417 @@ class ExternalProcessPipeline(resource.Resource, log.Loggable):
         return self
 
     def render(self, request):
-        print "ExternalProcessPipeline render"
+        self.debug("ExternalProcessPipeline render")
         try:
             if self.contentType:
                 request.setHeader('Content-Type', self.contentType)
         except AttributeError:
             pass
 
-        ExternalProcessProducer(self.pipeline_description % self.uri, request)
+        ExternalProcessProducer(self.pipeline_description % self.uri, request,
+                                self.high_water, self.low_water)
         return server.NOT_DONE_YET
 
-def transcoder_class_wrapper(klass, content_type, pipeline):
+def transcoder_class_wrapper(klass, content_type, pipeline, **settings):
     def create_object(uri):
         transcoder = klass(uri)
         transcoder.contentType = content_type
         transcoder.pipeline_description = pipeline
+        for name, value in settings.items():
+            setattr(transcoder, name, value)
         return transcoder
+    create_object.contentType = content_type
     return create_object
 
 
+class TranscodeCache(log.Loggable):
+    """ the finished transcodes, one file each in directory
+
+        together they take at most max_size bytes, when a new
+        one doesn't fit anymore the ones not asked for the
+        longest time are removed
+
+        a transcode still running is written into a .partial
+        file next to them, these are left over only when we
+        were stopped in the middle of one, and are removed
+    """
+    logCategory = 'transcoder_cache'
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        """ file name -> size, least recently used first """
+        self.files = OrderedDict()
+        self.size = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        found = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith('.partial'):
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            found.append((stat.st_mtime, name, stat.st_size))
+        for mtime, name, size in sorted(found):
+            self.files[name] = size
+            self.size += size
+        self.evict()
+
+    def get_name(self, key):
+        return hashlib.sha1(repr(key)).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.directory, self.get_name(key))
+
+    def get_partial_path(self, key):
+        return self.get_path(key) + '.partial'
+
+    def get(self, key):
+        """ the path of the finished transcode for key, or None """
+        name = self.get_name(key)
+        if name not in self.files:
+            return None
+        self.files[name] = self.files.pop(name)
+        path = os.path.join(self.directory, name)
+        try:
+            """ so the order survives a restart """
+            os.utime(path, None)
+        except OSError:
+            self.remove(name)
+            return None
+        return path
+
+    def add(self, key):
+        """ the partial file for key is complete """
+        name = self.get_name(key)
+        path = os.path.join(self.directory, name)
+        os.rename(path + '.partial', path)
+        if name in self.files:
+            self.size -= self.files.pop(name)
+        self.files[name] = os.path.getsize(path)
+        self.size += self.files[name]
+        self.evict()
+
+    def remove(self, name):
+        self.size -= self.files.pop(name)
+        self.unlink(name)
+
+    def unlink(self, name):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def evict(self):
+        while self.size > self.max_size and len(self.files) > 0:
+            name, size = self.files.popitem(last=False)
+            self.info("removing %s, %d bytes", name, size)
+            self.size -= size
+            self.unlink(name)
+
+
+class TranscodeReader(log.Loggable):
+    """ sends what a TranscodeSession has written so far to one
+        client, reading it back from the file of the session,
+        so every client is served at its own pace
+
+        what the session didn't write to its file anymore is
+        pushed to us, and kept until the client wants it
+    """
+    logCategory = 'transcoder_session'
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, session, request):
+        self.session = session
+        self.request = request
+        self.file = open(session.path, 'rb')
+        self.written = 0
+        self.waiting = False
+        self.queue = deque()
+        self.queued = 0
+        request.notifyFinish().addBoth(self.requestFinished)
+        request.registerProducer(self, False)
+
+    def data_available(self):
+        if self.waiting:
+            self.waiting = False
+            self.resumeProducing()
+
+    def push(self, data):
+        self.queue.append(data)
+        self.queued += len(data)
+        self.data_available()
+
+    def resumeProducing(self):
+        if self.request is None:
+            return
+        data = ''
+        if self.file is not None:
+            """ the seek gets us past an end of the file read before """
+            self.file.seek(self.written)
+            data = self.file.read(self.chunk_size)
+            if not data and self.session.overflowed:
+                """ all of the file is sent, the rest is pushed """
+                self.file.close()
+                self.file = None
+        if not data and self.queue:
+            data = self.queue.popleft()
+            self.queued -= len(data)
+            self.session.check_queues()
+        if data:
+            self.written += len(data)
+            self.request.write(data)
+        elif self.session.complete:
+            self.debug("finished, %d bytes written", self.written)
+            request = self.request
+            request.unregisterProducer()
+            request.finish()
+        else:
+            self.waiting = True
+
+    def pauseProducing(self):
+        pass
+
+    def stopProducing(self):
+        pass
+
+    def abort(self, reason):
+        if self.request is None:
+            return
+        request = self.request
+        request.unregisterProducer()
+        abort_request(request, reason)
+
+    def requestFinished(self, result):
+        self.request = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.session.remove_reader(self)
+
+
+class TranscodeSession(log.Loggable):
+    """ one transcode of a source into a format, shared by all
+        the clients asking for it while it is running
+
+        the session is the request the transcoder renders into,
+        what it gets is written into a file in the TranscodeCache,
+        and from there each client gets it by its TranscodeReader,
+        a client joining late starts at the beginning as well
+
+        a transcode getting larger than max_size wouldn't stay in
+        the cache anyway, so the file is removed, the clients we
+        have keep reading what is in it and get the rest directly, and clients
+        asking later get a transcode of their own, while one of
+        ours is more than high_water bytes behind, the transcoder
+        is paused, until all are below low_water again
+
+        when the last client is gone before the transcode is
+        complete, the transcoder is stopped and the file removed,
+        the same when the transcoder fails, the clients still
+        there are disconnected then
+    """
+    logCategory = 'transcoder_session'
+
+    method = 'GET'
+
+    high_water = 1024 * 1024
+    low_water = 256 * 1024
+
+    def __init__(self, manager, key, transcoder, path, max_size=None):
+        self.manager = manager
+        self.key = key
+        self.transcoder = transcoder
+        self.path = path
+        self.max_size = max_size
+        self.uri = key[0]
+        self.args = {}
+        self.code = 200
+        self.contentType = getattr(transcoder, 'contentType', None)
+        self.file = open(path, 'wb')
+        self.size = 0
+        self.readers = []
+        self.finish_deferreds = []
+        self.producer = None
+        self.paused = False
+        self.complete = False
+        self.overflowed = False
+        self.stopped = False
+
+    def start(self):
+        self.transcoder.render(self)
+
+    def add_reader(self, request):
+        if self.stopped or self.overflowed:
+            """ too late to get all of it from us """
+            abort_request(request, Exception("transcode not available"))
+            return
+        self.readers.append(TranscodeReader(self, request))
+
+    def remove_reader(self, reader):
+        self.readers.remove(reader)
+        if not self.readers and not self.complete:
+            self.stop()
+        else:
+            self.check_queues()
+
+    def check_queues(self):
+        if self.producer is None:
+            return
+        queued = max([reader.queued for reader in self.readers] or [0])
+        if not self.paused and queued > self.high_water:
+            self.debug("pausing, a client is %d bytes behind", queued)
+            self.paused = True
+            self.producer.pauseProducing()
+        elif self.paused and queued <= self.low_water:
+            self.debug("resuming")
+            self.paused = False
+            self.producer.resumeProducing()
+
+    def overflow(self):
+        self.info("transcode of %r exceeds %d bytes, not caching it",
+                  self.key, self.max_size)
+        self.overflowed = True
+        self.file.close()
+        """ our readers have it open already, a new session for
+            the key starts a file of its own there
+        """
+        self.remove_file()
+        self.manager.session_ended(self)
+
+    def remove_file(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def abort(self, reason):
+        """ the transcoder failed, what we got is incomplete """
+        self.warning("transcode of %r failed after %d bytes: %s",
+                     self.key, self.size, reason)
+        self.stop(reason)
+
+    def stop(self, reason=None):
+        """ all clients are gone, the transcode isn't needed anymore,
+            or it failed with reason
+        """
+        if self.stopped:
+            return
+        self.info("stopping %r after %d bytes", self.key, self.size)
+        self.stopped = True
+        if self.producer is not None:
+            self.producer.stopProducing()
+            self.producer = None
+        if reason is None:
+            reason = Exception("all clients are gone")
+        finish_deferreds, self.finish_deferreds = self.finish_deferreds, []
+        for d in finish_deferreds:
+            d.errback(reason)
+        self.file.close()
+        if not self.overflowed:
+            self.remove_file()
+        self.manager.session_ended(self)
+        for reader in self.readers[:]:
+            reader.abort(reason)
+
+    """ what the transcoder expects of a request """
+
+    def setResponseCode(self, code, message=None):
+        self.code = code
+
+    def setHeader(self, name, value):
+        if name.lower() == 'content-type':
+            self.contentType = value
+
+    def getHeader(self, name):
+        return None
+
+    def getAllHeaders(self):
+        return {}
+
+    def write(self, data):
+        if self.stopped or self.complete or not data:
+            return
+        if (not self.overflowed and self.max_size is not None and
+            self.size + len(data) > self.max_size):
+            self.overflow()
+        self.size += len(data)
+        if self.overflowed:
+            for reader in self.readers[:]:
+                reader.push(data)
+            self.check_queues()
+            return
+        self.file.write(data)
+        self.file.flush()
+        for reader in self.readers[:]:
+            reader.data_available()
+
+    def finish(self):
+        if self.stopped or self.complete:
+            return
+        self.info("transcode of %r complete, %d bytes", self.key, self.size)
+        self.file.close()
+        self.complete = True
+        finish_deferreds, self.finish_deferreds = self.finish_deferreds, []
+        for d in finish_deferreds:
+            d.callback(None)
+        self.manager.session_ended(self)
+        for reader in self.readers[:]:
+            reader.data_available()
+
+    def notifyFinish(self):
+        d = defer.Deferred()
+        self.finish_deferreds.append(d)
+        return d
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        if not streaming:
+            producer.resumeProducing()
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+class TranscodeStream(resource.Resource, log.Loggable):
+    """ the response to a client of a running TranscodeSession,
+        as the size isn't known yet, without a Content-Length
+        and always from the start
+    """
+    logCategory = 'transcoder_session'
+    isLeaf = True
+
+    def __init__(self, session):
+        resource.Resource.__init__(self)
+        self.session = session
+
+    def render(self, request):
+        request.setResponseCode(200)
+        if self.session.contentType:
+            request.setHeader('Content-Type', self.session.contentType)
+        if request.method == 'HEAD':
+            return ''
+        self.session.add_reader(request)
+        return server.NOT_DONE_YET
+
+
+class TranscodeHead(resource.Resource):
+    """ the response to a HEAD for a transcode not in the cache,
+        just the headers, nothing is started for it
+    """
+    isLeaf = True
+
+    def __init__(self, content_type):
+        resource.Resource.__init__(self)
+        self.contentType = content_type
+
+    def render(self, request):
+        request.setResponseCode(200)
+        request.setHeader('Content-Type', self.contentType)
+        return ''
+
 
 class TranscoderManager(log.Loggable):
 
@@ -665,6 +1132,10 @@ class TranscoderManager(log.Loggable):
                                            our sink -->
           <type>gstreamer</type>      <!-- could be gstreamer or process -->
           <name>mpegts</name>
+          <high_water>1048576</high_water> <!-- optional, for a process, the bytes waiting
+                                                for a slow client before we stop reading
+                                                from the process, and until we read again -->
+          <low_water>262144</low_water>
           <target>video/mpeg</target>
           <fourth_field>              <!-- value for the 4th field of the protocolInfo phalanx,
                                            default is '*' -->
@@ -675,6 +1146,9 @@ class TranscoderManager(log.Loggable):
     logCategory = 'transcoder_manager'
     _instance_ = None  # Singleton
 
+    initialized = False
+    cache = None
+
     def __new__(cls, *args, **kwargs):
         """ creates the singleton """
         if cls._instance_ is None:
@@ -688,7 +1162,15 @@ class TranscoderManager(log.Loggable):
             it should be called at least once
             with the main coherence class passed as an argument,
             so we have access to the config
+
+            later calls with the same or without a coherence
+            leave everything as it is
         """
+        if self.initialized and coherence in (None, getattr(self, 'coherence', None)):
+            return
+        self.initialized = True
+        self.cache = None
+        self.sessions = {}
         self.transcoders = {}
         for transcoder in InternalTranscoder.__subclasses__():
             self.transcoders[get_transcoder_name(transcoder)] = transcoder
@@ -726,8 +1208,15 @@ class TranscoderManager(log.Loggable):
                     wrapped = transcoder_class_wrapper(GStreamerTranscoder,
                             transcoder['target'], transcoder['pipeline'])
                 elif transcoder_type == 'process':
+                    """ the bytes we keep for a client that can't keep up,
+                        before, and until, we stop reading from the process
+                    """
+                    settings = {}
+                    for key in ('high_water', 'low_water'):
+                        if transcoder.get(key) is not None:
+                            settings[key] = int(transcoder[key])
                     wrapped = transcoder_class_wrapper(ExternalProcessPipeline,
-                            transcoder['target'], transcoder['pipeline'])
+                            transcoder['target'], transcoder['pipeline'], **settings)
                 else:
                     self.warning("unknown transcoder type %r", transcoder_type)
                     continue
@@ -752,5 +1241,79 @@ class TranscoderManager(log.Loggable):
         transcoder = self.transcoders[name](uri)
         return transcoder
 
+    def get_cache(self):
+        """ the TranscodeCache, in the directory given as
+            transcoder_cache in the config, and with at most
+            transcoder_cache_size MB in it
+
+            None if we can't have one there
+        """
+        if self.cache is None:
+            config = getattr(getattr(self, 'coherence', None), 'config', {})
+            directory = config.get('transcoder_cache',
+                    os.path.join(tempfile.gettempdir(),
+                                 'coherence-transcodes-%s' % getpass.getuser()))
+            max_size = int(config.get('transcoder_cache_size', 512)) * 1024 * 1024
+            try:
+                self.cache = TranscodeCache(directory, max_size)
+            except (IOError, OSError), msg:
+                self.warning("can't use %r as transcoder cache: %s", directory, msg)
+        return self.cache
+
+    def transcode(self, name, uri, method='GET'):
+        """ a resource with uri transcoded into name
+
+            a transcode that is complete and still in the cache is
+            served from there, with its size and for byte ranges,
+            clients asking for a transcode that is already running
+            share that one
+
+            a source we can't get the modification time of, like a
+            http one that might be a live stream, is transcoded for
+            each client on its own and not cached
+
+            for a HEAD nothing is transcoded, it gets the headers only
+        """
+        from coherence.upnp.core.utils import StaticFile
+
+        content_type = getattr(self.transcoders[name], 'contentType',
+                               'application/octet-stream')
+        cache = self.get_cache()
+        mtime = None
+        if cache is not None:
+            try:
+                mtime = os.path.getmtime(uri)
+            except (OSError, TypeError):
+                pass
+        key = (uri, mtime, name)
+
+        if mtime is not None:
+            path = cache.get(key)
+            if path is not None:
+                self.info("%r from the cache", key)
+                return StaticFile(path, defaultType=content_type)
+
+        if method == 'HEAD':
+            return TranscodeHead(content_type)
+        if mtime is None:
+            return self.select(name, uri)
+
+        session = self.sessions.get(key)
+        if session is None:
+            transcoder = self.select(name, uri)
+            session = TranscodeSession(self, key, transcoder,
+                    cache.get_partial_path(key), cache.max_size)
+            self.sessions[key] = session
+            session.start()
+        else:
+            self.info("joining the transcode of %r", key)
+        return TranscodeStream(session)
+
+    def session_ended(self, session):
+        if self.sessions.get(session.key) is session:
+            del self.sessions[session.key]
+        if session.complete and not session.overflowed:
+            self.cache.add(session.key)
+
 if __name__ == '__main__':
     t = Transcoder(None)
@@ -49,6 +49,7 @@ class TubeServiceControl(UPnPPublisher, log.Loggable):
     logCategory = 'mirabeau'
 
     def __init__(self, server):
+        UPnPPublisher.__init__(self)
         self.service = server
         self.variables = server.get_variables()
         self.actions = server.get_actions()
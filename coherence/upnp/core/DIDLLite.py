@@ -14,6 +14,7 @@ import os
 import string
 import urllib
 from datetime import datetime
+from StringIO import StringIO
 
 DC_NS = 'http://purl.org/dc/elements/1.1/'
 UPNP_NS = 'urn:schemas-upnp-org:metadata-1-0/upnp/'
@@ -21,7 +22,7 @@ UPNP_NS = 'urn:schemas-upnp-org:metadata-1-0/upnp/'
 my_namespaces = { DC_NS: 'dc',
                  UPNP_NS: 'upnp'
                  }
-from coherence.extern.et import ET, namespace_map_update, ElementInterface
+from coherence.extern.et import ET, namespace_map_update, ElementInterface, elementtree
 namespace_map_update(my_namespaces)
 
 from coherence.upnp.core import utils
@@ -37,6 +38,124 @@ def qname(tag,ns=''):
     return "{%s}%s" % (ns,tag)
 
 
+def _wrapped_start_tag(wrapper):
+    """ the start tag of a throw-away parent, carrying
+        the namespace declarations ET had to put there
+    """
+    data = ET.tostring(wrapper,encoding='utf-8')
+    return data, data.index('>')+1
+
+_plain_wrapper_start = None
+
+def element_to_fragment(element):
+    """ serialize an ET element the way it shows up
+        as a child of a DIDL-Lite root element
+
+        depending on the ElementTree version the namespace
+        declarations end up on the root or on the element itself,
+        so we let ET decide by wrapping it into a throw-away parent
+
+        returns None if the element needs namespace declarations
+        on the root beyond the ones of a plain DIDL-Lite object,
+        e.g. elements we parsed from another server
+    """
+    global _plain_wrapper_start
+    if _plain_wrapper_start == None:
+        probe = ET.Element('r')
+        ET.SubElement(probe, qname('title',DC_NS))
+        ET.SubElement(probe, qname('class',UPNP_NS))
+        data, start = _wrapped_start_tag(probe)
+        _plain_wrapper_start = data[:start]
+    wrapper = ET.Element('r')
+    wrapper.append(element)
+    data, start = _wrapped_start_tag(wrapper)
+    if data[:start] not in (_plain_wrapper_start, '<r>'):
+        return None
+    return data[start:-len('</r>')]
+
+
+""" the direct serialization of our DIDL-Lite objects,
+    bypassing the creation of an ElementTree and producing
+    exactly the output of ElementTree 1.3
+
+    we rely on its escape functions for that, with older
+    ElementTree versions we stay with ET.tostring
+"""
+_ElementTree = elementtree.ElementTree
+can_write_directly = (getattr(_ElementTree,'VERSION','') >= '1.3' and
+                      hasattr(_ElementTree,'_escape_cdata') and
+                      hasattr(_ElementTree,'_escape_attrib'))
+
+_written_names = {}
+
+def _write_name(name, namespaces):
+    if name[:1] != '{':
+        return name
+    try:
+        written, prefix, uri = _written_names[name]
+    except KeyError:
+        uri, local = name[1:].split('}',1)
+        prefix = _ElementTree._namespace_map[uri]
+        written = ':'.join((prefix,local))
+        _written_names[name] = written, prefix, uri
+    if prefix != 'xml':
+        namespaces[prefix] = uri
+    return written
+
+def _write_attributes(attributes, namespaces):
+    if len(attributes) == 0:
+        return ''
+    escape = _ElementTree._escape_attrib
+    return ''.join([' %s="%s"' % (_write_name(k,namespaces),escape(v,'utf-8'))
+                    for k,v in sorted(attributes.items())])
+
+def write_element(tag, attributes, elements, declare_namespaces=False):
+    """ serialize an element with the given attributes
+        and the (tag, text, attributes) tuples of its sub-elements
+
+        without declare_namespaces the result is a fragment
+        to be placed into a DIDL-Lite document, which declares
+        the dc and upnp namespaces for it
+
+        returns None if the element uses a namespace we don't
+        have a prefix for, that's better left to ElementTree
+    """
+    escape = _ElementTree._escape_cdata
+    namespaces = {}
+    try:
+        data = []
+        for child_tag, text, attrib in elements:
+            child_tag = _write_name(child_tag, namespaces)
+            if len(attrib) > 0:
+                data.append('<' + child_tag + _write_attributes(attrib, namespaces))
+            else:
+                data.append('<' + child_tag)
+            if text:
+                data.append('>' + escape(text,'utf-8') + '</' + child_tag + '>')
+            else:
+                data.append(' />')
+        tag = _write_name(tag, namespaces)
+        start = ['<' + tag]
+        if declare_namespaces == True:
+            for prefix, uri in sorted(namespaces.items()):
+                start.append(' xmlns:%s="%s"' % (prefix,_ElementTree._escape_attrib(uri,'utf-8')))
+        elif len([p for p in namespaces if p not in ('dc','upnp')]) > 0:
+            return None
+        start.append(_write_attributes(attributes, namespaces))
+    except KeyError:
+        return None
+    if len(data) == 0:
+        return ''.join(start) + ' />'
+    return ''.join(start + ['>'] + data + ['</', tag, '>'])
+
+def build_element(tag, attributes, elements):
+    """ the ElementTree counterpart of write_element """
+    root = ET.Element(tag, attributes)
+    for child_tag, text, attrib in elements:
+        ET.SubElement(root, child_tag, attrib).text = text
+    return root
+
+
 def is_audio(mimetype):
     """ checks for type audio,
         expects a mimetype or an UPnP
@@ -247,44 +366,50 @@ class Resource(object):
         additional_info = ';'.join(a_list)
         return additional_info
 
-    def toElement(self,**kwargs):
-        root = ET.Element('res')
+    def get_attributes(self,**kwargs):
+        """ the attributes of our res element """
+        attributes = {}
+        protocol,network,content_format,additional_info = self.protocolInfo.split(':')
         if kwargs.get('upnp_client','') in ('XBox',):
-            protocol,network,content_format,additional_info = self.protocolInfo.split(':')
             if content_format in ['video/divx','video/x-msvideo']:
                 content_format = 'video/avi'
             if content_format == 'audio/x-wav':
                 content_format = 'audio/wav'
-            additional_info = self.get_additional_info(upnp_client=kwargs.get('upnp_client',''))
-            root.attrib['protocolInfo'] = ':'.join((protocol,network,content_format,additional_info))
         else:
-            protocol,network,content_format,additional_info = self.protocolInfo.split(':')
             if content_format == 'video/x-msvideo':
                 content_format = 'video/divx'
-            additional_info = self.get_additional_info(upnp_client=kwargs.get('upnp_client',''))
-            root.attrib['protocolInfo'] = ':'.join((protocol,network,content_format,additional_info))
-
-        root.text = self.data
+        additional_info = self.get_additional_info(upnp_client=kwargs.get('upnp_client',''))
+        attributes['protocolInfo'] = ':'.join((protocol,network,content_format,additional_info))
 
         if self.bitrate is not None:
-            root.attrib['bitrate'] = str(self.bitrate)
+            attributes['bitrate'] = str(self.bitrate)
 
         if self.size is not None:
-            root.attrib['size'] = str(self.size)
+            attributes['size'] = str(self.size)
 
         if self.duration is not None:
-            root.attrib['duration'] = self.duration
+            attributes['duration'] = self.duration
 
         if self.nrAudioChannels is not None:
-            root.attrib['nrAudioChannels'] = self.nrAudioChannels
+            attributes['nrAudioChannels'] = self.nrAudioChannels
 
         if self.resolution is not None:
-            root.attrib['resolution'] = self.resolution
+            attributes['resolution'] = self.resolution
 
         if self.importUri is not None:
-            root.attrib['importUri'] = self.importUri
+            attributes['importUri'] = self.importUri
+
+        return attributes
 
+    def get_element(self,**kwargs):
+        """ our res element as a (tag, text, attributes) tuple,
+            to be placed within the element of its DIDL-Lite object
+        """
+        return ('res', self.data, self.get_attributes(**kwargs))
 
+    def toElement(self,**kwargs):
+        root = ET.Element('res', self.get_attributes(**kwargs))
+        root.text = self.data
         return root
 
     def fromElement(self, elt):
@@ -406,125 +531,148 @@ class Object(log.Loggable):
     def checkUpdate(self):
         return self
 
-    def toElement(self,**kwargs):
+    def get_element_data(self,**kwargs):
+        """ returns the attributes of our element and
+            a list of its sub-elements as (tag, text, attributes) tuples
+
+            that's all toElement and the direct serialization
+            in toString/toFragment are build from
+        """
 
-        root = ET.Element(self.elementName)
+        attributes = {}
+        elements = []
 
         #if self.id == 1000:
-        #    root.attrib['id'] = '0'
-        #    ET.SubElement(root, 'dc:title').text = 'root'
+        #    attributes['id'] = '0'
+        #    elements.append((qname('title',DC_NS), 'root', {}))
         #else:
-        #    root.attrib['id'] = str(self.id)
-        #    ET.SubElement(root, 'dc:title').text = self.title
+        #    attributes['id'] = str(self.id)
+        #    elements.append((qname('title',DC_NS), self.title, {}))
 
-        root.attrib['id'] = str(self.id)
-        ET.SubElement(root, qname('title',DC_NS)).text = self.title
-
-        #if self.title != None:
-        #    ET.SubElement(root, 'dc:title').text = self.title
-        #else:
-        #    ET.SubElement(root, 'dc:title').text = 'root'
+        attributes['id'] = str(self.id)
+        title = self.title
 
-        root.attrib['parentID'] = str(self.parentID)
+        attributes['parentID'] = str(self.parentID)
 
         if(kwargs.get('upnp_client','') != 'XBox'):
             if self.refID:
-                root.attrib['refID'] = str(self.refID)
+                attributes['refID'] = str(self.refID)
 
         if kwargs.get('requested_id',None):
             if kwargs.get('requested_id') == '0':
-                t = root.find(qname('title',DC_NS))
-                t.text = 'root'
-            #if kwargs.get('requested_id') != '0' and kwargs.get('requested_id') != root.attrib['id']:
-            if kwargs.get('requested_id') != root.attrib['id']:
+                title = 'root'
+            #if kwargs.get('requested_id') != '0' and kwargs.get('requested_id') != attributes['id']:
+            if kwargs.get('requested_id') != attributes['id']:
                 if(kwargs.get('upnp_client','') != 'XBox'):
-                    root.attrib['refID'] = root.attrib['id']
+                    attributes['refID'] = attributes['id']
                 r_id = kwargs.get('requested_id')
-                root.attrib['id'] = r_id
+                attributes['id'] = r_id
                 r_id = r_id.split('@',1)
                 try:
-                    root.attrib['parentID'] = r_id[1]
+                    attributes['parentID'] = r_id[1]
                 except IndexError:
                     pass
                 if(kwargs.get('upnp_client','') != 'XBox'):
-                    self.info("Changing ID from %r to %r, with parentID %r", root.attrib['refID'], root.attrib['id'], root.attrib['parentID'])
+                    self.info("Changing ID from %r to %r, with parentID %r", attributes['refID'], attributes['id'], attributes['parentID'])
                 else:
-                    self.info("Changing ID from %r to %r, with parentID %r", self.id, root.attrib['id'], root.attrib['parentID'])
+                    self.info("Changing ID from %r to %r, with parentID %r", self.id, attributes['id'], attributes['parentID'])
         elif kwargs.get('parent_container',None):
             if(kwargs.get('parent_container') != '0' and
-               kwargs.get('parent_container') != root.attrib['parentID']):
+               kwargs.get('parent_container') != attributes['parentID']):
                 if(kwargs.get('upnp_client','') != 'XBox'):
-                    root.attrib['refID'] = root.attrib['id']
-                root.attrib['id'] = '@'.join((root.attrib['id'],kwargs.get('parent_container')))
-                root.attrib['parentID'] = kwargs.get('parent_container')
+                    attributes['refID'] = attributes['id']
+                attributes['id'] = '@'.join((attributes['id'],kwargs.get('parent_container')))
+                attributes['parentID'] = kwargs.get('parent_container')
                 if(kwargs.get('upnp_client','') != 'XBox'):
-                    self.info("Changing ID from %r to %r, with parentID from %r to %r", root.attrib['refID'], root.attrib['id'], self.parentID, root.attrib['parentID'])
+                    self.info("Changing ID from %r to %r, with parentID from %r to %r", attributes['refID'], attributes['id'], self.parentID, attributes['parentID'])
                 else:
-                    self.info("Changing ID from %r to %r, with parentID from %r to %r", self.id, root.attrib['id'], self.parentID, root.attrib['parentID'])
+                    self.info("Changing ID from %r to %r, with parentID from %r to %r", self.id, attributes['id'], self.parentID, attributes['parentID'])
 
-        ET.SubElement(root, qname('class',UPNP_NS)).text = self.upnp_class
+        elements.append((qname('title',DC_NS), title, {}))
 
+        upnp_class = self.upnp_class
         if kwargs.get('upnp_client','') == 'XBox':
-            u = root.find(qname('class',UPNP_NS))
             if(kwargs.get('parent_container',None) != None and
-                u.text.startswith('object.container')):
+                upnp_class.startswith('object.container')):
                 if kwargs.get('parent_container') in ('14','15','16'):
-                    u.text = 'object.container.storageFolder'
+                    upnp_class = 'object.container.storageFolder'
             if self.upnp_class == 'object.container':
-                u.text = 'object.container.storageFolder'
-
+                upnp_class = 'object.container.storageFolder'
+        elements.append((qname('class',UPNP_NS), upnp_class, {}))
 
         if self.restricted:
-            root.attrib['restricted'] = '1'
+            attributes['restricted'] = '1'
         else:
-            root.attrib['restricted'] = '0'
+            attributes['restricted'] = '0'
 
         if self.creator is not None:
-            ET.SubElement(root, qname('creator',DC_NS)).text = self.creator
+            elements.append((qname('creator',DC_NS), self.creator, {}))
 
         if self.writeStatus is not None:
-            ET.SubElement(root, qname('writeStatus',UPNP_NS)).text = self.writeStatus
+            elements.append((qname('writeStatus',UPNP_NS), self.writeStatus, {}))
 
         if self.date is not None:
             if isinstance(self.date, datetime):
-                ET.SubElement(root, qname('date',DC_NS)).text = self.date.isoformat()
+                elements.append((qname('date',DC_NS), self.date.isoformat(), {}))
             else:
-                ET.SubElement(root, qname('date',DC_NS)).text = self.date
+                elements.append((qname('date',DC_NS), self.date, {}))
         else:
-            ET.SubElement(root, qname('date',DC_NS)).text = utils.datefaker().isoformat()
+            elements.append((qname('date',DC_NS), utils.datefaker().isoformat(), {}))
 
         if self.albumArtURI is not None:
-            e = ET.SubElement(root, qname('albumArtURI',UPNP_NS))
-            e.text = self.albumArtURI
-            e.attrib['xmlns:dlna'] = 'urn:schemas-dlna-org:metadata-1-0'
-            e.attrib['dlna:profileID'] = 'JPEG_TN'
+            elements.append((qname('albumArtURI',UPNP_NS), self.albumArtURI,
+                             {'xmlns:dlna': 'urn:schemas-dlna-org:metadata-1-0',
+                              'dlna:profileID': 'JPEG_TN'}))
 
         if self.artist is not None:
-            ET.SubElement(root, qname('artist',UPNP_NS)).text = self.artist
+            elements.append((qname('artist',UPNP_NS), self.artist, {}))
 
         if self.genre is not None:
-            ET.SubElement(root, qname('genre',UPNP_NS)).text = self.genre
+            elements.append((qname('genre',UPNP_NS), self.genre, {}))
 
         if self.genres is not None:
             for genre in self.genres:
-                ET.SubElement(root, qname('genre',UPNP_NS)).text = genre
+                elements.append((qname('genre',UPNP_NS), genre, {}))
 
         if self.originalTrackNumber is not None:
-            ET.SubElement(root, qname('originalTrackNumber',UPNP_NS)).text = str(self.originalTrackNumber)
+            elements.append((qname('originalTrackNumber',UPNP_NS), str(self.originalTrackNumber), {}))
 
         if self.description is not None:
-            ET.SubElement(root, qname('description',DC_NS)).text = self.description
+            elements.append((qname('description',DC_NS), self.description, {}))
 
         if self.longDescription is not None:
-            ET.SubElement(root, qname('longDescription',UPNP_NS)).text = self.longDescription
+            elements.append((qname('longDescription',UPNP_NS), self.longDescription, {}))
 
         if self.server_uuid is not None:
-            ET.SubElement(root, qname('server_uuid',UPNP_NS)).text = self.server_uuid
+            elements.append((qname('server_uuid',UPNP_NS), self.server_uuid, {}))
 
-        return root
+        return attributes, elements
+
+    def toElement(self,**kwargs):
+        attributes, elements = self.get_element_data(**kwargs)
+        return build_element(self.elementName, attributes, elements)
 
     def toString(self,**kwargs):
-        return ET.tostring(self.toElement(**kwargs),encoding='utf-8')
+        attributes, elements = self.get_element_data(**kwargs)
+        if can_write_directly:
+            data = write_element(self.elementName, attributes, elements,
+                                 declare_namespaces=True)
+            if data != None:
+                return data
+        root = build_element(self.elementName, attributes, elements)
+        return ET.tostring(root,encoding='utf-8')
+
+    def toFragment(self,**kwargs):
+        """ returns the serialized element, ready to be
+            placed into a DIDL-Lite document via DIDLElement.addFragment
+        """
+        attributes, elements = self.get_element_data(**kwargs)
+        if can_write_directly:
+            data = write_element(self.elementName, attributes, elements)
+            if data != None:
+                return data
+        root = build_element(self.elementName, attributes, elements)
+        return element_to_fragment(root)
 
     def fromElement(self, elt):
         """
@@ -597,22 +745,22 @@ class Item(Object):
     def __init__(self, *args, **kwargs):
         Object.__init__(self, *args, **kwargs)
 
-    def toElement(self,**kwargs):
+    def get_element_data(self,**kwargs):
 
-        root = Object.toElement(self,**kwargs)
+        attributes, elements = Object.get_element_data(self,**kwargs)
 
         if self.director is not None:
-            ET.SubElement(root, qname('director',UPNP_NS)).text = self.director
+            elements.append((qname('director',UPNP_NS), self.director, {}))
 
         if self.refID is not None:
-            ET.SubElement(root, 'refID').text = self.refID
+            elements.append(('refID', self.refID, {}))
 
         if self.actors is not None:
             for actor in self.actors:
-                ET.SubElement(root, qname('actor',DC_NS)).text = actor
+                elements.append((qname('actor',DC_NS), actor, {}))
 
         #if self.language is not None:
-        #    ET.SubElement(root, qname('language',DC_NS)).text = self.language
+        #    elements.append((qname('language',DC_NS), self.language, {}))
 
         if kwargs.get('transcoding',False) == True:
             res = self.res.get_matching(['*:*:*:*'], protocol_type='http-get')
@@ -621,30 +769,30 @@ class Item(Object):
                 if(kwargs.get('upnp_client','') == 'XBox'):
                     transcoded_res = old_res.transcoded('mp3')
                     if transcoded_res != None:
-                        root.append(transcoded_res.toElement(**kwargs))
+                        elements.append(transcoded_res.get_element(**kwargs))
                     else:
-                        root.append(old_res.toElement(**kwargs))
+                        elements.append(old_res.get_element(**kwargs))
                 else:
                     for res in self.res:
-                        root.append(res.toElement(**kwargs))
+                        elements.append(res.get_element(**kwargs))
                     transcoded_res = old_res.transcoded('lpcm')
                     if transcoded_res != None:
-                        root.append(transcoded_res.toElement(**kwargs))
+                        elements.append(transcoded_res.get_element(**kwargs))
             elif len(res) > 0 and is_video(res[0].protocolInfo):
                 old_res = res[0]
                 for res in self.res:
-                    root.append(res.toElement(**kwargs))
+                    elements.append(res.get_element(**kwargs))
                 transcoded_res = old_res.transcoded('mpegts')
                 if transcoded_res != None:
-                    root.append(transcoded_res.toElement(**kwargs))
+                    elements.append(transcoded_res.get_element(**kwargs))
             else:
                 for res in self.res:
-                    root.append(res.toElement(**kwargs))
+                    elements.append(res.get_element(**kwargs))
         else:
             for res in self.res:
-                root.append(res.toElement(**kwargs))
+                elements.append(res.get_element(**kwargs))
 
-        return root
+        return attributes, elements
 
     def fromElement(self, elt):
         Object.fromElement(self, elt)
@@ -663,32 +811,32 @@ class ImageItem(Item):
     publisher = None
     rights = None
 
-    def toElement(self,**kwargs):
-        root = Item.toElement(self,**kwargs)
+    def get_element_data(self,**kwargs):
+        attributes, elements = Item.get_element_data(self,**kwargs)
 
         if self.rating is not None:
-            ET.SubElement(root, qname('rating',UPNP_NS)).text = str(self.rating)
+            elements.append((qname('rating',UPNP_NS), str(self.rating), {}))
 
         if self.storageMedium is not None:
-            ET.SubElement(root, qname('storageMedium',UPNP_NS)).text = self.storageMedium
+            elements.append((qname('storageMedium',UPNP_NS), self.storageMedium, {}))
 
         if self.publisher is not None:
-            ET.SubElement(root, qname('publisher',DC_NS)).text = self.contributor
+            elements.append((qname('publisher',DC_NS), self.contributor, {}))
 
         if self.rights is not None:
-            ET.SubElement(root, qname('rights',DC_NS)).text = self.rights
+            elements.append((qname('rights',DC_NS), self.rights, {}))
 
-        return root
+        return attributes, elements
 
 class Photo(ImageItem):
     upnp_class = ImageItem.upnp_class + '.photo'
     album = None
 
-    def toElement(self,**kwargs):
-        root = ImageItem.toElement(self,**kwargs)
+    def get_element_data(self,**kwargs):
+        attributes, elements = ImageItem.get_element_data(self,**kwargs)
         if self.album is not None:
-            ET.SubElement(root, qname('album',UPNP_NS)).text = self.album
-        return root
+            elements.append((qname('album',UPNP_NS), self.album, {}))
+        return attributes, elements
 
 class AudioItem(Item):
     """A piece of content that when rendered generates some audio."""
@@ -704,23 +852,23 @@ class AudioItem(Item):
                   'language', 'relation', 'rights', 'albumArtURI']
 
     #@dlna.AudioItem
-    def toElement(self,**kwargs):
+    def get_element_data(self,**kwargs):
 
-        root = Item.toElement(self,**kwargs)
+        attributes, elements = Item.get_element_data(self,**kwargs)
 
         if self.publisher is not None:
-            ET.SubElement(root, qname('publisher',DC_NS)).text = self.publisher
+            elements.append((qname('publisher',DC_NS), self.publisher, {}))
 
         if self.language is not None:
-            ET.SubElement(root, qname('language',DC_NS)).text = self.language
+            elements.append((qname('language',DC_NS), self.language, {}))
 
         if self.relation is not None:
-            ET.SubElement(root, qname('relation',DC_NS)).text = self.relation
+            elements.append((qname('relation',DC_NS), self.relation, {}))
 
         if self.rights is not None:
-            ET.SubElement(root, qname('rights',DC_NS)).text = self.rights
+            elements.append((qname('rights',DC_NS), self.rights, {}))
 
-        return root
+        return attributes, elements
 
     def fromElement(self, elt):
         Item.fromElement(self, elt)
@@ -741,23 +889,23 @@ class MusicTrack(AudioItem):
     storageMedium = None
     contributor = None
 
-    def toElement(self,**kwargs):
+    def get_element_data(self,**kwargs):
 
-        root = AudioItem.toElement(self,**kwargs)
+        attributes, elements = AudioItem.get_element_data(self,**kwargs)
 
         if self.album is not None:
-            ET.SubElement(root, qname('album',UPNP_NS)).text = self.album
+            elements.append((qname('album',UPNP_NS), self.album, {}))
 
         if self.playlist is not None:
-            ET.SubElement(root, qname('playlist',UPNP_NS)).text = self.playlist
+            elements.append((qname('playlist',UPNP_NS), self.playlist, {}))
 
         if self.storageMedium is not None:
-            ET.SubElement(root, qname('storageMedium',UPNP_NS)).text = self.storageMedium
+            elements.append((qname('storageMedium',UPNP_NS), self.storageMedium, {}))
 
         if self.contributor is not None:
-            ET.SubElement(root, qname('contributor',DC_NS)).text = self.contributor
+            elements.append((qname('contributor',DC_NS), self.contributor, {}))
 
-        return root
+        return attributes, elements
 
 class AudioBroadcast(AudioItem):
     upnp_class = AudioItem.upnp_class + '.audioBroadcast'
@@ -773,15 +921,15 @@ class VideoItem(Item):
                        description=DC_NS, publisher=DC_NS, language=DC_NS,
                        relation=DC_NS)
 
-    def toElement(self,**kwargs):
-        root = Item.toElement(self,**kwargs)
+    def get_element_data(self,**kwargs):
+        attributes, elements = Item.get_element_data(self,**kwargs)
 
         for attr_name, ns in self.valid_attrs.iteritems():
             value = getattr(self, attr_name, None)
             if value:
-                ET.SubElement(root, qname(attr_name, ns)).text = value
+                elements.append((qname(attr_name, ns), value, {}))
 
-        return root
+        return attributes, elements
 
     def fromElement(self, elt):
         Item.fromElement(self, elt)
@@ -827,32 +975,30 @@ class Container(Object):
         Object.__init__(self, id, parentID, title, restricted, creator)
         self.searchClass = []
 
-    def toElement(self,**kwargs):
+    def get_element_data(self,**kwargs):
 
-        root = Object.toElement(self,**kwargs)
+        attributes, elements = Object.get_element_data(self,**kwargs)
 
         if self.childCount is not None:
-            root.attrib['childCount'] = str(self.childCount)
+            attributes['childCount'] = str(self.childCount)
 
         if self.createClass is not None:
-            ET.SubElement(root, qname('createclass',UPNP_NS)).text = self.createClass
+            elements.append((qname('createclass',UPNP_NS), self.createClass, {}))
 
         if not isinstance(self.searchClass, (list, tuple)):
             self.searchClass = [self.searchClass]
         for i in self.searchClass:
-            sc = ET.SubElement(root, qname('searchClass',UPNP_NS))
-            sc.attrib['includeDerived'] = '1'
-            sc.text = i
+            elements.append((qname('searchClass',UPNP_NS), i, {'includeDerived': '1'}))
 
         if self.searchable is not None:
             if self.searchable in (1, '1', True, 'true', 'True'):
-                root.attrib['searchable'] = '1'
+                attributes['searchable'] = '1'
             else:
-                root.attrib['searchable'] = '0'
+                attributes['searchable'] = '0'
 
         for res in self.res:
-            root.append(res.toElement(**kwargs))
-        return root
+            elements.append(res.get_element(**kwargs))
+        return attributes, elements
 
     def fromElement(self, elt):
         Object.fromElement(self, elt)
@@ -931,43 +1077,90 @@ class DIDLElement(ElementInterface,log.Loggable):
         self.attrib['xmlns:dlna'] = 'urn:schemas-dlna-org:metadata-1-0'
         self.attrib['xmlns:pv'] = 'http://www.pv.com/pvns/'
         self._items = []
+        self._fragments = []
         self.upnp_client = upnp_client
         self.parent_container = parent_container
         self.requested_id = requested_id
         self.transcoding = transcoding
 
+    def get_serialization_args(self):
+        """ the arguments our items get serialized with,
+            e.g. to be passed to Object.toFragment
+        """
+        return {'upnp_client': self.upnp_client,
+                'parent_container': self.parent_container,
+                'requested_id': self.requested_id,
+                'transcoding': self.transcoding}
 
     def addContainer(self, id, parentID, title, restricted = False):
         e = Container(id, parentID, title, restricted, creator = '')
         self.append(e.toElement())
 
     def addItem(self, item):
-        self.append(item.toElement(upnp_client=self.upnp_client,
-                                   parent_container=self.parent_container,
-                                   requested_id=self.requested_id,
-                                   transcoding=self.transcoding))
+        self.addFragment(item, item.toFragment(**self.get_serialization_args()))
+
+    def addFragment(self, item, fragment):
+        """ add an item we already have serialized,
+            fragment has to be the result of item.toFragment()
+            called with our serialization args
+        """
+        if fragment != None and len(self) > 0:
+            """ keep the order of what has been added so far """
+            fragments = [element_to_fragment(e) for e in self]
+            if None in fragments:
+                fragment = None
+            else:
+                self._fragments = fragments
+                self._children = []
         self._items.append(item)
+        if fragment == None:
+            """ can't be placed as a fragment,
+                so that's a plain ElementTree again
+            """
+            if len(self._fragments) > 0:
+                self.rebuild()
+            else:
+                self.append(item.toElement(**self.get_serialization_args()))
+        else:
+            self._fragments.append(fragment)
 
     def rebuild(self):
         self._children = []
+        self._fragments = []
         for item in self._items:
-            self.append(item.toElement(upnp_client=self.upnp_client,
-                                       parent_container=self.parent_container,
-                                       requested_id=self.requested_id,
-                                       transcoding=self.transcoding))
+            self.append(item.toElement(**self.get_serialization_args()))
 
     def numItems(self):
-        return len(self)
+        return len(self) + len(self._fragments)
 
     def getItems(self):
         return self._items
 
+    _start_tags = {}
+
+    def _start_tag(self):
+        """ our start tag, as ET writes it for
+            a DIDL-Lite document with items in it
+        """
+        key = tuple(sorted(self.attrib.items()))
+        try:
+            return self._start_tags[key]
+        except KeyError:
+            probe = ET.Element('DIDL-Lite', self.attrib)
+            ET.SubElement(probe, qname('title',DC_NS))
+            ET.SubElement(probe, qname('class',UPNP_NS))
+            data = ET.tostring(probe,encoding='utf-8')
+            self._start_tags[key] = data[:data.index('>')+1]
+            return self._start_tags[key]
+
     def toString(self):
         """ sigh - having that optional preamble here
             breaks some of the older ContentDirectoryClients
         """
         #preamble = """<?xml version="1.0" encoding="utf-8"?>"""
         #return preamble + ET.tostring(self,encoding='utf-8')
+        if len(self._fragments) > 0:
+            return ''.join([self._start_tag()] + self._fragments + ['</DIDL-Lite>'])
         return ET.tostring(self,encoding='utf-8')
 
     def get_upnp_class(self,name):
@@ -999,6 +1192,95 @@ class DIDLElement(ElementInterface,log.Loggable):
         return instance
 
 
+""" the fields iter_items() can decode, mapped to
+    the property to put into a Browse Filter for them
+"""
+ITEM_FIELDS = {'id': None,
+               'parent_id': None,
+               'upnp_class': 'upnp:class',
+               'title': 'dc:title',
+               'child_count': '@childCount',
+               'date': 'dc:date',
+               'album': 'upnp:album',
+               'artist': 'upnp:artist',
+               'album_art_uri': 'upnp:albumArtURI',
+               'resources': 'res'}
+
+_item_field_tags = {'title': 'title',
+                    'class': 'upnp_class',
+                    'date': 'date',
+                    'album': 'album',
+                    'artist': 'artist',
+                    'albumArtURI': 'album_art_uri',
+                    'res': 'resources'}
+
+
+def browse_filter(fields=None):
+    """ the Filter for a Browse or Search action
+        that returns just the fields we want
+    """
+    if fields is None:
+        return '*'
+    properties = [ITEM_FIELDS[f] for f in fields if ITEM_FIELDS.get(f)]
+    return ','.join(sorted(set(properties)))
+
+
+def iter_items(data, fields=None):
+    """ decode a DIDL-Lite document incrementally
+
+        yields a dict per item or container, with the keys
+        from ITEM_FIELDS, as soon as its end tag is parsed,
+        without building the whole tree or DIDLLite objects
+
+        fields - only decode these keys, None for all of them,
+                 'id' is always there
+    """
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    data = data.replace('\x00','')
+    if fields is not None:
+        fields = set(fields)
+        fields.add('id')
+    def wanted(key):
+        return fields is None or key in fields
+
+    depth = 0
+    root = None
+    item = None
+    for event, elt in ET.iterparse(StringIO(data), events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 1:
+                root = elt
+            elif depth == 2:
+                item = {'id': elt.get('id')}
+                if wanted('parent_id'):
+                    item['parent_id'] = elt.get('parentID')
+                if wanted('child_count') and elt.get('childCount') is not None:
+                    item['child_count'] = elt.get('childCount')
+                if wanted('title'):
+                    item['title'] = None
+            continue
+
+        depth -= 1
+        if depth == 2:
+            key = _item_field_tags.get(elt.tag.split('}')[-1])
+            if key is None or not wanted(key):
+                continue
+            if key == 'resources':
+                if elt.text:
+                    item.setdefault('resources', {})[elt.text.strip()] = elt.get('protocolInfo')
+            elif key in ('title', 'upnp_class'):
+                item[key] = elt.text
+            elif elt.text and key not in item:
+                item[key] = elt.text
+        elif depth == 1:
+            yield item
+            item = None
+            """ drop what we have parsed so far """
+            root.clear()
+
+
 def element_to_didl(item):
     """ a helper method to create a DIDLElement out of one ET element
         or XML fragment string
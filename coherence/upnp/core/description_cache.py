@@ -0,0 +1,206 @@
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+""" the device descriptions and service SCPDs we have seen
+
+    before a discovered device can be used its description has to be
+    downloaded, and the SCPD of each of its services, a device that
+    reboots or re-announces itself makes us do that all over again,
+    and 20 devices of the same model send us 20 times the same SCPDs
+
+    the DescriptionCache
+
+     - downloads over the http_pool, at most max_fetches at a time,
+       and a document that is already on its way isn't asked for twice
+
+     - parses each distinct document only once, what it parsed is
+       kept by the content hash of the document, so devices with the
+       same SCPD share one table of actions and state variables
+
+     - keeps the SCPDs by their URL plus the content hash of the device
+       description they are listed in, as long as a device announces
+       the same description again, its SCPDs aren't downloaded again
+
+    it also keeps count of how long it took from a root device
+    being announced until it and all its services were detected
+"""
+
+import hashlib
+from collections import OrderedDict
+
+from twisted.internet import defer
+
+from coherence.upnp.core import utils
+from coherence import log
+
+ns = "urn:schemas-upnp-org:service-1-0"
+
+
+def parse_scpd(data):
+    """ the actions and state variables of an SCPD, as
+
+        ([(name, [(argument name, direction, related state variable)])],
+         [(name, sendEvents, data type, (allowed values))])
+    """
+    tree = utils.parse_xml(data, 'utf-8').getroot()
+    actions = []
+    for action_node in tree.findall('.//{%s}action' % ns):
+        arguments = []
+        for argument in action_node.findall('.//{%s}argument' % ns):
+            arguments.append((argument.findtext('{%s}name' % ns),
+                              argument.findtext('{%s}direction' % ns),
+                              argument.findtext('{%s}relatedStateVariable' % ns)))
+        actions.append((action_node.findtext('{%s}name' % ns), tuple(arguments)))
+    variables = []
+    for var_node in tree.findall('.//{%s}stateVariable' % ns):
+        variables.append((var_node.findtext('{%s}name' % ns),
+                          var_node.attrib.get('sendEvents', 'yes'),
+                          var_node.findtext('{%s}dataType' % ns),
+                          tuple([allowed.text for allowed in
+                                 var_node.findall('.//{%s}allowedValue' % ns)])))
+    return tuple(actions), tuple(variables)
+
+def parse_description(data):
+    return utils.parse_xml(data, 'utf-8').getroot()
+
+def content_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+class LRU(OrderedDict):
+    """ forgets what was used least recently
+        when it holds more than size entries
+    """
+
+    def __init__(self, size):
+        OrderedDict.__init__(self)
+        self.size = size
+
+    def get(self, key, default=None):
+        try:
+            value = self.pop(key)
+        except KeyError:
+            return default
+        self[key] = value
+        return value
+
+    def put(self, key, value):
+        self.pop(key, None)
+        self[key] = value
+        while len(self) > self.size:
+            self.popitem(last=False)
+
+
+class DescriptionCache(log.Loggable):
+    logCategory = 'description_cache'
+
+    def __init__(self, max_fetches=4, size=256):
+        self.max_fetches = max_fetches
+        self.semaphore = defer.DeferredSemaphore(max_fetches)
+        self.fetching = {}
+        """ content hash -> (document, what was parsed from it) """
+        self.parsed = LRU(size)
+        """ (SCPD URL, description content hash) -> SCPD content hash """
+        self.scpds = LRU(size)
+        self.stats = {'fetched': 0, 'joined': 0, 'parsed': 0, 'shared': 0,
+                      'cached': 0, 'failed': 0}
+        self.detections = 0
+        self.detection_time = 0.0
+        self.max_detection_time = 0.0
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['detections'] = self.detections
+        stats['max_detection_time'] = self.max_detection_time
+        if self.detections > 0:
+            stats['detection_time'] = self.detection_time / self.detections
+        else:
+            stats['detection_time'] = 0.0
+        return stats
+
+    def fetch(self, url):
+        """ the document at url, a request for an url
+            which is already on its way joins that one
+        """
+        d = defer.Deferred()
+        if url in self.fetching:
+            self.stats['joined'] += 1
+            self.fetching[url].append(d)
+            return d
+        self.fetching[url] = [d]
+
+        def done(result):
+            self.stats['fetched'] += 1
+            for waiting in self.fetching.pop(url):
+                waiting.callback(result[0])
+
+        def failed(failure):
+            self.stats['failed'] += 1
+            for waiting in self.fetching.pop(url):
+                waiting.errback(failure)
+
+        self.semaphore.run(utils.getPage, url, persistent=True).addCallbacks(done, failed)
+        return d
+
+    def parse(self, data, parser):
+        """ (content hash, what parser made of data),
+            parsed only if the same document wasn't before
+        """
+        key = content_hash(data)
+        found = self.parsed.get(key)
+        if found is not None:
+            self.stats['shared'] += 1
+            return key, found[1]
+        result = parser(data)
+        self.stats['parsed'] += 1
+        self.parsed.put(key, (data, result))
+        return key, result
+
+    def get_description(self, url):
+        """ fires with the content hash of the device
+            description at url and its parsed root element,
+            the description itself is always fetched, as that
+            tells us whether anything changed on the device
+        """
+        d = self.fetch(url)
+        d.addCallback(self.parse, parse_description)
+        return d
+
+    def get_scpd(self, url, description_hash=None):
+        """ fires with the SCPD at url and its (actions, variables)
+            table, taken from the cache when it was listed in
+            the same device description before
+        """
+        key = (url, description_hash)
+        if description_hash is not None:
+            found = self.parsed.get(self.scpds.get(key))
+            if found is not None:
+                self.stats['cached'] += 1
+                return defer.succeed(found)
+
+        def parsed(result, data):
+            scpd_hash, table = result
+            if description_hash is not None:
+                self.scpds.put(key, scpd_hash)
+            return data, table
+
+        d = self.fetch(url)
+        d.addCallback(lambda data: parsed(self.parse(data, parse_scpd), data))
+        return d
+
+    def detection_completed(self, seconds):
+        """ a root device with all its embedded devices and
+            services was detected, seconds after it was announced
+        """
+        self.detections += 1
+        self.detection_time += seconds
+        self.max_detection_time = max(self.max_detection_time, seconds)
+
+
+_cache = None
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = DescriptionCache()
+    return _cache
@@ -7,10 +7,10 @@
 import urllib2
 import time
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 
 from coherence.upnp.core.service import Service
-from coherence.upnp.core import utils
+from coherence.upnp.core import description_cache
 from coherence import log
 
 import coherence.extern.louie as louie
@@ -309,6 +309,9 @@ class Device(log.Loggable):
     def get_location(self):
         return self.parent.get_location()
 
+    def get_description_hash(self):
+        return self.parent.get_description_hash()
+
     def get_usn(self):
         return self.parent.get_usn()
 
@@ -453,6 +456,9 @@ class RootDevice(Device):
         self.manifestation = infos['MANIFESTATION']
         self.host = infos['HOST']
         self.root_detection_completed = False
+        self.description_hash = None
+        self.created = reactor.seconds()
+        self.detection_time = None
         Device.__init__(self, None)
         louie.connect( self.device_detect, 'Coherence.UPnP.Device.detection_completed', self)
         # we need to handle root device completion
@@ -476,6 +482,9 @@ class RootDevice(Device):
     def get_location(self):
         return self.location
 
+    def get_description_hash(self):
+        return self.description_hash
+
     def get_upnp_version(self):
         return self.upnp_version
 
@@ -514,6 +523,8 @@ class RootDevice(Device):
                 return
         # now must be done, so notify root done
         self.root_detection_completed = True
+        self.detection_time = reactor.seconds() - self.created
+        description_cache.get_cache().detection_completed(self.detection_time)
         self.info("rootdevice %r %r %r initialized, manifestation %r" % (self.friendly_name,self.st,self.host,self.manifestation))
         louie.send('Coherence.UPnP.RootDevice.detection_completed', None, device=self)
 
@@ -527,40 +538,31 @@ class RootDevice(Device):
 
     def parse_description(self):
 
-        def gotPage(x):
+        def gotDescription(result):
             self.debug("got device description from %r" % self.location)
-            data, headers = x
-            xml_data = None
+            self.description_hash, tree = result
+            major = tree.findtext('./{%s}specVersion/{%s}major' % (ns,ns))
+            minor = tree.findtext('./{%s}specVersion/{%s}minor' % (ns,ns))
+            try:
+                self.upnp_version = '.'.join((major,minor))
+            except:
+                self.upnp_version = 'n/a'
             try:
-                xml_data = utils.parse_xml(data, 'utf-8')
+                self.urlbase = tree.findtext('./{%s}URLBase' % ns)
             except:
-                self.warning("Invalid device description received from %r", self.location)
                 import traceback
                 self.debug(traceback.format_exc())
-            
-            if xml_data is not None:
-                tree = xml_data.getroot()
-                major = tree.findtext('./{%s}specVersion/{%s}major' % (ns,ns))
-                minor = tree.findtext('./{%s}specVersion/{%s}minor' % (ns,ns))
-                try:
-                    self.upnp_version = '.'.join((major,minor))
-                except:
-                    self.upnp_version = 'n/a'
-                try:
-                    self.urlbase = tree.findtext('./{%s}URLBase' % ns)
-                except:
-                    import traceback
-                    self.debug(traceback.format_exc())
-    
-                d = tree.find('./{%s}device' % ns)
-                if d is not None:
-                    self.parse_device(d) # root device
+
+            d = tree.find('./{%s}device' % ns)
+            if d is not None:
+                self.parse_device(d) # root device
 
         def gotError(failure, url):
             self.warning("error getting device description from %r", url)
             self.info(failure)
 
-        utils.getPage(self.location).addCallbacks(gotPage, gotError, None, None, [self.location], None)
+        d = description_cache.get_cache().get_description(self.location)
+        d.addCallbacks(gotDescription, gotError, None, None, [self.location], None)
 
     def make_fullyqualified(self,url):
         if url.startswith('http://'):
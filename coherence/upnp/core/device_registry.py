@@ -0,0 +1,122 @@
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+""" the root devices we know about, with their embedded ones
+
+    lookups by USN, UDN, host, device type and manifestation
+    happen for every SSDP announce, every GENA event and every
+    playcontainer URI, so instead of scanning a list each time
+    the DeviceRegistry keeps a hash index for each of them
+
+    the UDN index holds the root devices and all their embedded
+    ones, keyed by the UDN without its 'uuid:' prefix, the USN
+    and host indexes hold only the root devices, as an embedded
+    device shares both with its root, the type index holds every
+    device under its full device type as well as under its
+    friendly one, e.g. both 'urn:schemas-upnp-org:device:MediaServer:1'
+    and 'MediaServer'
+"""
+
+from coherence import log
+
+
+def normalize_udn(udn):
+    """ 'uuid:1234' and '1234' are the same device """
+    if udn is not None and udn[:5] == 'uuid:':
+        return udn[5:]
+    return udn
+
+
+class DeviceRegistry(log.Loggable):
+    logCategory = 'device_registry'
+
+    def __init__(self):
+        """ the root devices in the order they were added,
+            Coherence hands out this list as it is
+        """
+        self.devices = []
+        self.by_usn = {}
+        self.by_udn = {}
+        self.by_host = {}
+        self.by_type = {}
+        self.by_manifestation = {}
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __iter__(self):
+        return iter(self.devices)
+
+    def __contains__(self, device):
+        return self.by_usn.get(device.get_usn()) is device
+
+    def _tree(self, device):
+        """ the device and its embedded devices, depth first """
+        yield device
+        for embedded in device.devices:
+            for d in self._tree(embedded):
+                yield d
+
+    def _types(self, device):
+        return [t for t in (device.get_device_type(),
+                            device.get_friendly_device_type()) if t is not None]
+
+    def add(self, device):
+        usn = device.get_usn()
+        if self.by_usn.get(usn) is device:
+            return
+        if usn in self.by_usn:
+            self.warning("replacing %r with %r", self.by_usn[usn], device)
+            self.remove(self.by_usn[usn])
+        self.devices.append(device)
+        self.by_usn[usn] = device
+        self.by_host.setdefault(device.get_host(), []).append(device)
+        self.by_manifestation.setdefault(device.manifestation, []).append(device)
+        for d in self._tree(device):
+            self.by_udn[normalize_udn(d.get_id())] = d
+            for t in self._types(d):
+                self.by_type.setdefault(t, []).append(d)
+
+    def remove(self, device):
+        """ has to be called before device.remove(),
+            which throws away the embedded devices
+        """
+        usn = device.get_usn()
+        if self.by_usn.get(usn) is not device:
+            return
+        self.devices.remove(device)
+        del self.by_usn[usn]
+        self._unindex(self.by_host, device.get_host(), device)
+        self._unindex(self.by_manifestation, device.manifestation, device)
+        for d in self._tree(device):
+            udn = normalize_udn(d.get_id())
+            if self.by_udn.get(udn) is d:
+                del self.by_udn[udn]
+            for t in self._types(d):
+                self._unindex(self.by_type, t, d)
+
+    def _unindex(self, index, key, device):
+        devices = index.get(key)
+        if devices is None:
+            return
+        try:
+            devices.remove(device)
+        except ValueError:
+            return
+        if len(devices) == 0:
+            del index[key]
+
+    def get_by_usn(self, usn):
+        return self.by_usn.get(usn)
+
+    def get_by_udn(self, udn):
+        return self.by_udn.get(normalize_udn(udn))
+
+    def get_by_host(self, host):
+        return list(self.by_host.get(host, ()))
+
+    def get_by_type(self, device_type):
+        return list(self.by_type.get(device_type, ()))
+
+    def get_by_manifestation(self, manifestation):
+        return list(self.by_manifestation.get(manifestation, ()))
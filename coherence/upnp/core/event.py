@@ -5,16 +5,19 @@
 # Copyright 2006,2007,2008,2009 Frank Scholz <coherence@beebits.net>
 
 import time
+import heapq
 from urlparse import urlsplit
+from collections import OrderedDict
 
 from twisted.internet import reactor, defer
 from twisted.web import resource, server
 from twisted.web.http import datetimeToString
-from twisted.internet.protocol import Protocol, ClientCreator, _InstanceFactory
 from twisted.python import failure
 
 from coherence import log, SERVER_ID
+from coherence.extern.et import ET
 from coherence.upnp.core import utils
+from coherence.upnp.core import http_pool
 
 import coherence.extern.louie as louie
 
@@ -65,6 +68,110 @@ class EventServer(resource.Resource, log.Loggable):
         return ""
 
 
+def parse_subscription_timeout(timeout):
+    """ the seconds of a TIMEOUT header like 'Second-1800',
+        a day for 'infinite' or anything we don't understand
+    """
+    try:
+        if timeout.lower().startswith('second-'):
+            return int(timeout[len('Second-'):])
+    except (AttributeError, ValueError):
+        pass
+    return 86400
+
+
+class Subscribers(dict, log.Loggable):
+    """
+    the subscribers of a service, by their SID
+
+    a subscriber is removed when its subscription runs out,
+    the subscriptions wait for that in a heap ordered by their
+    deadline, and when the deliveries to it failed max_failures
+    times in a row
+
+    stats counts what happened to the subscriptions so far
+    """
+    logCategory = 'event_subscription_server'
+
+    max_failures = 5
+
+    def __init__(self):
+        dict.__init__(self)
+        self.expiry_heap = []
+        self.expiry_call = None
+        self.stats = {'subscribed': 0,
+                      'renewed': 0,
+                      'unsubscribed': 0,
+                      'expired': 0,
+                      'failed': 0}
+
+    def get_stats(self):
+        stats = self.stats.copy()
+        stats['active'] = len(self)
+        return stats
+
+    def add(self, subscriber):
+        self[subscriber['sid']] = subscriber
+        self.stats['subscribed'] += 1
+        self.schedule(subscriber)
+
+    def renew(self, sid, timeout):
+        s = self[sid]
+        s['timeout'] = timeout
+        s['created'] = reactor.seconds()
+        self.stats['renewed'] += 1
+        self.schedule(s)
+
+    def remove(self, sid, reason='unsubscribed'):
+        s = self.pop(sid, None)
+        if s is None:
+            return None
+        self.info("removing subscriber %r, %s", sid, reason)
+        self.stats[reason] += 1
+        queue = s.get('queue')
+        if queue is not None:
+            queue.disconnect()
+        return s
+
+    def delivery_failed(self, sid):
+        s = self.get(sid)
+        if s is None:
+            return
+        queue = s.get('queue')
+        if queue is not None and queue.failures >= self.max_failures:
+            self.remove(sid, 'failed')
+
+    def schedule(self, s):
+        s['expires'] = s['created'] + parse_subscription_timeout(s['timeout'])
+        heapq.heappush(self.expiry_heap, (s['expires'], s['sid']))
+        if self.expiry_call is not None and self.expiry_call.active():
+            if self.expiry_call.getTime() <= self.expiry_heap[0][0]:
+                return
+            self.expiry_call.cancel()
+        self.expiry_call = reactor.callLater(max(0, self.expiry_heap[0][0] - reactor.seconds()),
+                                             self.check)
+
+    def check(self):
+        """ remove the subscribers whose subscription ran out,
+            entries for renewed or removed ones are dropped
+        """
+        self.expiry_call = None
+        now = reactor.seconds()
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            expires, sid = heapq.heappop(self.expiry_heap)
+            s = self.get(sid)
+            if s is not None and s.get('expires') == expires:
+                self.remove(sid, 'expired')
+        if self.expiry_heap:
+            self.expiry_call = reactor.callLater(max(0, self.expiry_heap[0][0] - now),
+                                                 self.check)
+
+    def stop(self):
+        if self.expiry_call is not None and self.expiry_call.active():
+            self.expiry_call.cancel()
+        self.expiry_call = None
+
+
 class EventSubscriptionServer(resource.Resource, log.Loggable):
     """
     This class ist the server part on the device side. It listens to subscribe
@@ -122,8 +229,7 @@ class EventSubscriptionServer(resource.Resource, log.Loggable):
                 #print headers['sid']
                 if self.subscribers.has_key(headers['sid']):
                     s = self.subscribers[headers['sid']]
-                    s['timeout'] = headers['timeout']
-                    s['created'] = time.time()
+                    self.subscribers.renew(headers['sid'], headers['timeout'])
                 elif not headers.has_key('callback'):
                     request.setResponseCode(404)
                     request.setHeader('SERVER', SERVER_ID)
@@ -136,7 +242,7 @@ class EventSubscriptionServer(resource.Resource, log.Loggable):
                       'callback' : headers['callback'][1:len(headers['callback'])-1],
                       'seq' : 0}
                 s['timeout'] = headers['timeout']
-                s['created'] = time.time()
+                s['created'] = reactor.seconds()
                 self.service.new_subscriber(s)
 
             request.setHeader('SID', s['sid'])
@@ -163,7 +269,7 @@ class EventSubscriptionServer(resource.Resource, log.Loggable):
         else:
             headers = request.getAllHeaders()
             try:
-                del self.subscribers[headers['sid']]
+                self.subscribers.remove(headers['sid'])
             except:
                 """ XXX if not found set right error code """
                 pass
@@ -205,57 +311,6 @@ class Event(dict, log.Loggable):
 
 
 
-class EventProtocol(Protocol, log.Loggable):
-
-    logCategory = 'event_protocol'
-
-    def __init__(self, service, action):
-        self.service = service
-        self.action = action
-
-    def teardown(self):
-        self.transport.loseConnection()
-        self.service.event_connection = None
-
-    def connectionMade(self):
-        self.timeout_checker = reactor.callLater(30, self.teardown)
-
-    def dataReceived(self, data):
-        try:
-            self.timeout_checker.cancel()
-        except:
-            pass
-        self.info("response received from the Service Events HTTP server ")
-        #self.debug(data)
-        cmd, headers = utils.parse_http_response(data)
-        self.debug("%r %r", cmd, headers)
-        if int(cmd[1]) != 200:
-            self.warning("response with error code %r received upon our %r request", cmd[1], self.action)
-            # XXX get around devices that return an error on our event subscribe request
-            self.service.process_event({})
-        else:
-            try:
-                self.service.set_sid(headers['sid'])
-                timeout = headers['timeout']
-                self.debug("%r %r", headers['sid'], headers['timeout'])
-                if timeout == 'infinite':
-                    self.service.set_timeout(time.time() + 4294967296) # FIXME: that's lame
-                elif timeout.startswith('Second-'):
-                    timeout = int(timeout[len('Second-'):])
-                    self.service.set_timeout(timeout)
-            except:
-                #print headers
-                pass
-        self.teardown()
-
-    def connectionLost( self, reason):
-        try:
-            self.timeout_checker.cancel()
-        except:
-            pass
-        self.debug( "connection closed %r from the Service Events HTTP server", reason)
-
-
 def unsubscribe(service, action='unsubscribe'):
     return subscribe(service, action)
 
@@ -263,6 +318,9 @@ def subscribe(service, action='subscribe'):
     """
     send a subscribe/renewal/unsubscribe request to a service
     return the device response
+
+    the request goes over a keep-alive connection from the
+    http_pool, the one we use for the SOAP actions of that device
     """
     log_category = "event_protocol"
     log.info(log_category, "event.subscribe, action: %r", action)
@@ -275,168 +333,270 @@ def subscribe(service, action='subscribe'):
         host = host_port
         port = 80
 
-    def send_request(p, action):
-        log.info(log_category, "event.subscribe.send_request %r, action: %r %r",
-                 p, action, service.get_event_sub_url())
-        _,_,event_path,_,_ = urlsplit(service.get_event_sub_url())
-        if action == 'subscribe':
-            timeout = service.timeout
-            if timeout == 0:
-                timeout = 1800
-            request = ["SUBSCRIBE %s HTTP/1.1" % event_path,
-                        "HOST: %s:%d" % (host, port),
-                        "TIMEOUT: Second-%d" % timeout,
-                        ]
-            service.event_connection = p
-        else:
-            request = ["UNSUBSCRIBE %s HTTP/1.1" % event_path,
-                        "HOST: %s:%d" % (host, port),
-                        ]
+    _,_,event_path,_,_ = urlsplit(service.get_event_sub_url())
+    headers = {}
+    if action == 'subscribe':
+        method = 'SUBSCRIBE'
+        timeout = service.timeout
+        if timeout == 0:
+            timeout = 1800
+        headers['TIMEOUT'] = 'Second-%d' % timeout
+    else:
+        method = 'UNSUBSCRIBE'
 
-        if service.get_sid():
-            request.append("SID: %s" % service.get_sid())
-        else:
-            # XXX use address and port set in the coherence instance
-            #ip_address = p.transport.getHost().host
-            global hostname, web_server_port
-            #print hostname, web_server_port
-            url = 'http://%s:%d/events' % (hostname, web_server_port)
-            request.append("CALLBACK: <%s>" % url)
-            request.append("NT: upnp:event")
-
-        request.append('Date: %s' % datetimeToString())
-        request.append( "Content-Length: 0")
-        request.append( "")
-        request.append( "")
-        request = '\r\n'.join(request)
-        log.debug(log_category, "event.subscribe.send_request %r %r", request, p)
+    if service.get_sid():
+        headers['SID'] = service.get_sid()
+    else:
+        # XXX use address and port set in the coherence instance
+        global hostname, web_server_port
+        url = 'http://%s:%d/events' % (hostname, web_server_port)
+        headers['CALLBACK'] = '<%s>' % url
+        headers['NT'] = 'upnp:event'
+
+    headers['Date'] = datetimeToString()
+
+    def got_response(response):
+        log.info(log_category, "response received from the Service Events HTTP server")
+        log.debug(log_category, "%r %r", response, response.headers)
+        if response.status != 200:
+            log.warning(log_category, "response with error code %r received upon our %r request",
+                        response.status, action)
+            # XXX get around devices that return an error on our event subscribe request
+            service.process_event({})
+            return
         try:
-            p.transport.writeSomeData(request)
-        except AttributeError:
-            log.info(log_category, "transport for event %r already gone", action)
-       # print "event.subscribe.send_request", d
-        #return d
+            service.set_sid(response.get_header('sid'))
+            timeout = response.get_header('timeout')
+            log.debug(log_category, "%r %r", response.get_header('sid'), timeout)
+            if timeout == 'infinite':
+                service.set_timeout(time.time() + 4294967296) # FIXME: that's lame
+            elif timeout.startswith('Second-'):
+                timeout = int(timeout[len('Second-'):])
+                service.set_timeout(timeout)
+        except:
+            pass
 
     def got_error(failure, action):
         log.info(log_category, "error on %s request with %s" % (action,service.get_base_url()))
         log.debug(log_category, failure)
 
-    def teardown_connection(c, d):
-        log.info(log_category, "event.subscribe.teardown_connection")
-        del d
-        del c
-
-    def prepare_connection( service, action):
-        log.info(log_category, "event.subscribe.prepare_connection action: %r %r",
-                 action, service.event_connection)
-        if service.event_connection == None:
-            c = ClientCreator(reactor, EventProtocol, service=service, action=action)
-            log.info(log_category, "event.subscribe.prepare_connection: %r %r",
-                     host, port)
-            d = c.connectTCP(host, port)
-            d.addCallback(send_request, action=action)
-            d.addErrback(got_error, action)
-            #reactor.callLater(3, teardown_connection, c, d)
-        else:
-            d = defer.Deferred()
-            d.addCallback(send_request, action=action)
-            d.callback(service.event_connection)
-            #send_request(service.event_connection, action)
-        return d
-
     """ FIXME:
         we need to find a way to be sure that our unsubscribe calls get through
         on shutdown
         reactor.addSystemEventTrigger( 'before', 'shutdown', prepare_connection, service, action)
     """
 
-    return prepare_connection(service, action)
-    #print "event.subscribe finished"
-
+    d = http_pool.get_pool().request(host, port, method, event_path,
+                                     headers=headers, timeout=30)
+    d.addCallbacks(got_response, got_error, None, None, [action], None)
+    return d
 
-class NotificationProtocol(Protocol, log.Loggable):
 
-    logCategory = "notification_protocol"
-
-    def connectionMade(self):
-        self.timeout_checker = reactor.callLater(30, lambda : self.transport.loseConnection())
+def merge_propertysets(messages):
+    """
+    merge event messages into one, with the latest
+    value of each property
 
-    def dataReceived(self, data):
-        try:
-            self.timeout_checker.cancel()
-        except:
-            pass
-        cmd, headers = utils.parse_http_response(data)
-        self.debug( "notification response received %r %r", cmd, headers)
-        try:
-            if int(cmd[1]) != 200:
-                self.warning("response with error code %r received upon our notification", cmd[1])
-        except:
-            self.debug("response without error code received upon our notification")
-        self.transport.loseConnection()
+    the LastChange events are merged as well, with the
+    latest value of each variable per instance and channel
+    """
+    properties = OrderedDict()
+    last_change = None
+    for xml in messages:
+        for prop in utils.parse_xml(xml).getroot():
+            for var in prop:
+                if var.tag == 'LastChange' and var.text:
+                    if last_change is None:
+                        last_change = OrderedDict()
+                    properties[var.tag] = last_change
+                    event = utils.parse_xml(var.text).getroot()
+                    ns = event.tag[1:event.tag.find('}')]
+                    for instance in event:
+                        variables = last_change.setdefault((ns, instance.get('val')), OrderedDict())
+                        for v in instance:
+                            variables[(v.tag, v.get('channel'))] = v
+                else:
+                    properties[var.tag] = var.text or ''
+
+    root = ET.Element('e:propertyset')
+    root.attrib['xmlns:e']='urn:schemas-upnp-org:event-1-0'
+    for name, value in properties.items():
+        e = ET.SubElement(root, 'e:property')
+        if value is last_change:
+            event = None
+            for (ns, instance), variables in last_change.items():
+                if event is None:
+                    event = ET.Element('Event')
+                    event.attrib['xmlns'] = ns
+                i = ET.SubElement(event, 'InstanceID')
+                i.attrib['val'] = instance
+                for v in variables.values():
+                    ET.SubElement(i, v.tag[v.tag.find('}') + 1:], v.attrib)
+            value = ET.tostring(event, encoding='utf-8')
+        ET.SubElement(e, name).text = value
+    return ET.tostring(root, encoding='utf-8')
+
+
+class NotificationQueue(log.Loggable):
+    """
+    delivers the event messages for one subscriber
 
-    def connectionLost( self, reason):
-        try:
-            self.timeout_checker.cancel()
-        except:
-            pass
-        self.debug("connection closed %r", reason)
+    the messages go out one after the other over a keep-alive
+    connection from the http_pool, each with the next SEQ of the
+    subscriber, so they arrive in the order they were sent
 
+    while one is on its way the next ones wait, when more than
+    max_waiting pile up because the subscriber is slow they are
+    merged into one with just the latest values
 
-def send_notification(s, xml):
-    """
-    send a notification a subscriber
-    return its response
+    a failed delivery is tried again after each of retry_delays,
+    after that the message and the ones waiting are dropped
     """
-    log_category = "notification_protocol"
+    logCategory = "notification_protocol"
 
-    _,host_port,path,_,_ = urlsplit(s['callback'])
-    if path == '':
-        path = '/'
-    if host_port.find(':') != -1:
-        host,port = tuple(host_port.split(':'))
-        port = int(port)
-    else:
-        host = host_port
-        port = 80
+    max_waiting = 2
+    retry_delays = (2, 10)
+    timeout = 30
 
-    def send_request(p,port_item):
-        request = ['NOTIFY %s HTTP/1.1' % path,
-                    'HOST:  %s:%d' % (host, port),
-                    'SEQ:  %d' % s['seq'],
-                    'CONTENT-TYPE:  text/xml;charset="utf-8"',
-                    'SID:  %s' % s['sid'],
-                    'NTS:  upnp:propchange',
-                    'NT:  upnp:event',
-                    'Content-Length: %d' % len(xml),
-                    '',
-                    xml]
-
-        request = '\r\n'.join(request)
-        log.info(log_category, "send_notification.send_request to %r %r",
-                 s['sid'], s['callback'])
-        log.debug(log_category, "request: %r", request)
+    def __init__(self, subscriber):
+        log.Loggable.__init__(self)
+        self.subscriber = subscriber
+        _,host_port,path,query,_ = urlsplit(subscriber['callback'])
+        if path == '':
+            path = '/'
+        if query:
+            path = '?'.join((path, query))
+        self.path = path
+        if host_port.find(':') != -1:
+            host,port = tuple(host_port.split(':'))
+            self.host, self.port = host, int(port)
+        else:
+            self.host, self.port = host_port, 80
+
+        self.waiting = []
+        self.sending = None
+        self.retry_call = None
+        self.failures = 0
+        self.dropped = 0
+        self.closed = False
+
+    def send(self, xml):
+        d = defer.Deferred()
+        if self.closed:
+            d.errback(failure.Failure(defer.CancelledError()))
+            return d
+        self.waiting.append((xml, [d]))
+        if len(self.waiting) > self.max_waiting:
+            self.coalesce()
+        self.next()
+        return d
+
+    def coalesce(self):
+        try:
+            xml = merge_propertysets([m for m, _ in self.waiting])
+        except Exception, e:
+            self.warning("can't merge the event messages for %r: %r",
+                         self.subscriber['sid'], e)
+            return
+        deferreds = []
+        for _, ds in self.waiting:
+            deferreds.extend(ds)
+        self.debug("merged %d event messages for %r",
+                   len(self.waiting), self.subscriber['sid'])
+        self.waiting = [(xml, deferreds)]
+
+    def next(self):
+        if(self.closed or self.sending is not None or
+           len(self.waiting) == 0):
+            return
+        xml, deferreds = self.waiting.pop(0)
+        s = self.subscriber
+        self.sending = (s['seq'], xml, deferreds)
         s['seq'] += 1
         if s['seq'] > 0xffffffff:
             s['seq'] = 1
-        p.transport.write(request)
-        port_item.disconnect()
-        #return p.transport.write(request)
-
-    def got_error(failure,port_item):
-        port_item.disconnect()
-        log.info(log_category, "error sending notification to %r %r",
-                 s['sid'], s['callback'])
-        log.debug(log_category, failure)
+        self.deliver()
+
+    def deliver(self):
+        self.retry_call = None
+        seq, xml, _ = self.sending
+        s = self.subscriber
+        self.info("send_notification to %r %r, seq %d", s['sid'], s['callback'], seq)
+        headers = {'SEQ': str(seq),
+                   'CONTENT-TYPE': 'text/xml;charset="utf-8"',
+                   'SID': s['sid'],
+                   'NTS': 'upnp:propchange',
+                   'NT': 'upnp:event'}
+        d = http_pool.get_pool().request(self.host, self.port, 'NOTIFY', self.path,
+                                         headers=headers, body=xml, timeout=self.timeout)
+        d.addCallbacks(self.delivered, self.failed)
+
+    def delivered(self, response):
+        if self.closed:
+            return
+        if response.status != 200:
+            self.warning("response with error code %r received upon our notification",
+                         response.status)
+        _, _, deferreds = self.sending
+        self.sending = None
+        self.failures = 0
+        for d in deferreds:
+            d.callback(response)
+        self.next()
+
+    def failed(self, reason):
+        if self.closed:
+            return
+        s = self.subscriber
+        self.failures += 1
+        if self.failures <= len(self.retry_delays):
+            self.info("error sending notification to %r %r, trying again",
+                      s['sid'], s['callback'])
+            self.debug(reason)
+            self.retry_call = reactor.callLater(self.retry_delays[self.failures - 1],
+                                                self.deliver)
+            return
+        """ no luck, what's waiting would most likely fail as well,
+            until a delivery works again new messages get one try
+        """
+        self.info("error sending notification to %r %r, dropping %d messages",
+                  s['sid'], s['callback'], len(self.waiting) + 1)
+        deferreds = self.sending[2]
+        for _, ds in self.waiting:
+            deferreds.extend(ds)
+        self.dropped += len(self.waiting) + 1
+        self.sending = None
+        self.waiting = []
+        for d in deferreds:
+            d.errback(reason)
+
+    def disconnect(self):
+        """ stop delivering, what's waiting is cancelled """
+        if self.closed:
+            return
+        self.closed = True
+        if self.retry_call is not None and self.retry_call.active():
+            self.retry_call.cancel()
+        self.retry_call = None
+        deferreds = []
+        if self.sending is not None:
+            deferreds.extend(self.sending[2])
+        for _, ds in self.waiting:
+            deferreds.extend(ds)
+        self.sending = None
+        self.waiting = []
+        for d in deferreds:
+            d.errback(failure.Failure(defer.CancelledError()))
 
-    #c = ClientCreator(reactor, NotificationProtocol)
-    #d = c.connectTCP(host, port)
 
-    d = defer.Deferred()
-    f = _InstanceFactory(reactor, NotificationProtocol(), d)
-    port_item = reactor.connectTCP(host, port, f, timeout=30, bindAddress=None)
-
-    d.addCallback(send_request, port_item)
-    d.addErrback(got_error, port_item)
+def send_notification(s, xml):
+    """
+    queue a notification for a subscriber
 
-    return d,port_item
+    returns a Deferred for its response, and the
+    NotificationQueue of the subscriber
+    """
+    queue = s.get('queue')
+    if queue is None:
+        queue = s['queue'] = NotificationQueue(s)
+    return queue.send(xml), queue
@@ -0,0 +1,441 @@
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+""" persistent HTTP/1.1 connections to the devices we control
+
+    a control point talks to the same few hosts over and over again,
+    SOAP actions, description and SCPD downloads, GENA subscriptions,
+    so instead of a fresh TCP connection per request, we keep a small
+    number of keep-alive connections per host and port around
+
+    HTTPConnectionPool.request() queues a request for a host,
+    sends it on an idle connection, or opens a new one as long
+    as there are less than max_connections to that host
+
+    idempotent requests (GET, HEAD, SUBSCRIBE, UNSUBSCRIBE) may be
+    pipelined up to a depth of pipelining behind each other on a
+    connection and are sent again on a fresh connection if a reused
+    one was closed before the first byte of their response came in,
+    which is what happens when a device drops an idle connection
+    just when we start to use it
+
+    POST requests, our SOAP actions, are never pipelined and never
+    repeated, they might have changed the state of the device already
+"""
+
+from collections import deque
+
+from twisted.internet import reactor, protocol, defer
+from twisted.protocols import basic
+from twisted.python import failure
+
+from coherence import log
+
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'SUBSCRIBE', 'UNSUBSCRIBE')
+NO_BODY_STATUS = (204, 304)
+
+
+class HTTPResponse(object):
+    """ status, headers and body of a response,
+        header names are lowercased and map
+        to a list of their values
+    """
+
+    def __init__(self, version, status, message):
+        self.version = version
+        self.status = status
+        self.message = message
+        self.headers = {}
+        self.body = ''
+
+    def get_header(self, name, default=None):
+        values = self.headers.get(name.lower())
+        if values:
+            return values[-1]
+        return default
+
+    def __repr__(self):
+        return '<HTTPResponse %d %s>' % (self.status, self.message)
+
+
+class HTTPRequest(object):
+
+    def __init__(self, key, method, path, headers, body, timeout):
+        self.key = key
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+        self.timeout = timeout
+        self.deferred = defer.Deferred()
+        self.retried = False
+        self.timed_out = False
+        self.timeout_call = None
+
+    def idempotent(self):
+        return self.method in IDEMPOTENT_METHODS and not self.body
+
+    def to_string(self):
+        host, port = self.key
+        if port != 80:
+            host = '%s:%d' % (host, port)
+        lines = ['%s %s HTTP/1.1' % (self.method, self.path),
+                 'Host: %s' % host]
+        for name, value in self.headers.items():
+            if name.lower() in ('host', 'content-length', 'connection'):
+                continue
+            lines.append('%s: %s' % (name, value))
+        if self.body or self.method not in ('GET', 'HEAD'):
+            lines.append('Content-Length: %d' % len(self.body or ''))
+        lines.append('')
+        lines.append('')
+        return '\r\n'.join(lines) + (self.body or '')
+
+
+class PersistentHTTPClient(basic.LineReceiver, log.Loggable):
+    """ the client side of a keep-alive connection
+
+        responses come in the order the requests were sent,
+        self.requests holds the ones still waiting for theirs
+    """
+
+    logCategory = 'http_pool'
+    delimiter = '\n'
+    MAX_LENGTH = 64*1024
+
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+        self.requests = deque()
+        self.responses = 0
+        self.reusable = True
+        self.idle_call = None
+        self.reset()
+
+    def reset(self):
+        self.response = None
+        self.last_header = None
+        self.body = []
+        self.length = None
+        self.chunk_state = None
+        self.until_close = False
+        self.bytes_received = False
+
+    def connectionMade(self):
+        self.pool.connection_made(self)
+
+    def is_idle(self):
+        return self.reusable and not self.requests
+
+    def can_pipeline(self, request):
+        """ can request be sent right now on this connection? """
+        if not self.reusable:
+            return False
+        if not self.requests:
+            return True
+        if len(self.requests) >= self.pool.pipelining:
+            return False
+        return request.idempotent() and self.requests[-1].idempotent()
+
+    def send(self, request):
+        self.cancel_idle()
+        self.requests.append(request)
+        if request.timeout:
+            request.timeout_call = reactor.callLater(request.timeout, self.request_timed_out, request)
+        self.transport.write(request.to_string())
+
+    def request_timed_out(self, request):
+        request.timeout_call = None
+        request.timed_out = True
+        self.warning("%s %s to %r timed out", request.method, request.path, self.key)
+        """ the responses on this connection are out of step now """
+        self.close()
+
+    def close(self):
+        self.reusable = False
+        self.transport.loseConnection()
+
+    def start_idle(self):
+        self.cancel_idle()
+        if self.pool.idle_timeout:
+            self.idle_call = reactor.callLater(self.pool.idle_timeout, self.close)
+
+    def cancel_idle(self):
+        if self.idle_call is not None:
+            if self.idle_call.active():
+                self.idle_call.cancel()
+            self.idle_call = None
+
+    def lineReceived(self, line):
+        line = line.rstrip('\r')
+        if self.response is None:
+            if not line:
+                """ stray empty lines between responses """
+                return
+            self.bytes_received = True
+            self.status_received(line)
+        elif self.chunk_state is not None:
+            self.chunk_line_received(line)
+        elif not line:
+            self.headers_received()
+        elif line[0] in ' \t' and self.last_header is not None:
+            values = self.response.headers[self.last_header]
+            values[-1] = ' '.join((values[-1], line.strip()))
+        else:
+            name, _, value = line.partition(':')
+            name = name.strip().lower()
+            self.response.headers.setdefault(name, []).append(value.strip())
+            self.last_header = name
+
+    def status_received(self, line):
+        parts = line.split(None, 2)
+        try:
+            version = parts[0]
+            status = int(parts[1])
+        except (IndexError, ValueError):
+            version = None
+        if not self.requests or version is None or not version.startswith('HTTP/'):
+            self.warning("unexpected status line %r from %r", line, self.key)
+            self.close()
+            return
+        message = ''
+        if len(parts) > 2:
+            message = parts[2]
+        self.response = HTTPResponse(version, status, message)
+
+    def headers_received(self):
+        response = self.response
+        if 100 <= response.status < 200:
+            """ 100 Continue and friends, the real response follows """
+            self.response = None
+            return
+
+        connection = (response.get_header('connection') or '').lower()
+        if('close' in connection or
+           (response.version == 'HTTP/1.0' and 'keep-alive' not in connection)):
+            self.reusable = False
+
+        if(self.requests[0].method == 'HEAD' or
+           response.status in NO_BODY_STATUS):
+            self.response_received()
+            return
+
+        encoding = (response.get_header('transfer-encoding') or '').lower()
+        if encoding and encoding != 'identity':
+            self.chunk_state = 'size'
+            return
+
+        try:
+            self.length = int(response.get_header('content-length'))
+        except (TypeError, ValueError):
+            """ the body ends when the connection does """
+            self.until_close = True
+            self.reusable = False
+        if self.length == 0:
+            self.response_received()
+            return
+        self.setRawMode()
+
+    def chunk_line_received(self, line):
+        if self.chunk_state == 'size':
+            try:
+                self.length = int(line.split(';', 1)[0].strip(), 16)
+            except ValueError:
+                self.warning("malformed chunk size %r from %r", line, self.key)
+                self.close()
+                return
+            if self.length == 0:
+                self.chunk_state = 'trailer'
+            else:
+                self.chunk_state = 'data'
+                self.setRawMode()
+        elif self.chunk_state == 'crlf':
+            self.chunk_state = 'size'
+        elif not line:
+            """ end of the trailer """
+            self.response_received()
+
+    def rawDataReceived(self, data):
+        if self.until_close:
+            self.body.append(data)
+            return
+        data, rest = data[:self.length], data[self.length:]
+        self.body.append(data)
+        self.length -= len(data)
+        if self.length > 0:
+            return
+        if self.chunk_state == 'data':
+            self.chunk_state = 'crlf'
+        else:
+            self.response_received()
+        self.setLineMode(rest)
+
+    def response_received(self):
+        response = self.response
+        response.body = ''.join(self.body)
+        self.reset()
+        self.responses += 1
+        request = self.requests.popleft()
+        if request.timeout_call is not None:
+            request.timeout_call.cancel()
+            request.timeout_call = None
+        if not self.reusable:
+            """ whatever was pipelined behind this one won't get an answer """
+            self.transport.loseConnection()
+        request.deferred.callback(response)
+        self.pool.response_received(self)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        self.cancel_idle()
+        self.reusable = False
+        if self.response is not None and self.until_close:
+            self.response_received()
+        requests, self.requests = self.requests, deque()
+        retry = []
+        for i, request in enumerate(requests):
+            if request.timeout_call is not None:
+                request.timeout_call.cancel()
+                request.timeout_call = None
+            if request.timed_out:
+                request.deferred.errback(failure.Failure(defer.TimeoutError(
+                        "%s %s timed out" % (request.method, request.path))))
+            elif(request.idempotent() and not request.retried and
+                 (i > 0 or (self.responses > 0 and not self.bytes_received))):
+                """ the first one on a reused connection that was closed
+                    before it got any answer, or pipelined behind that
+                """
+                request.retried = True
+                retry.append(request)
+            else:
+                request.deferred.errback(reason)
+        self.pool.connection_lost(self, retry)
+
+
+class HTTPConnectionPool(log.Loggable):
+    """ keep-alive connections, grouped by host and port
+
+        max_connections - connections to a single host and port
+        idle_timeout - seconds an unused connection is kept open
+        pipelining - requests sent on a connection before
+                     the response to the first one came in
+    """
+
+    logCategory = 'http_pool'
+
+    def __init__(self, max_connections=2, idle_timeout=10, pipelining=1):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.pipelining = max(1, pipelining)
+        self.connections = {}
+        self.connecting = {}
+        self.pending = {}
+
+    def request(self, host, port, method, path, headers=None, body=None, timeout=0):
+        """ returns a Deferred that fires with an HTTPResponse """
+        key = (host, port)
+        request = HTTPRequest(key, method, path, headers or {}, body, timeout)
+        self.pending.setdefault(key, deque()).append(request)
+        self.dispatch(key)
+        return request.deferred
+
+    def dispatch(self, key):
+        pending = self.pending.get(key)
+        while pending:
+            request = pending[0]
+            connection = self.get_connection(key, request)
+            if connection is None:
+                break
+            pending.popleft()
+            connection.send(request)
+        if not pending:
+            self.pending.pop(key, None)
+            return
+        if len(self.connections.get(key, ())) + self.connecting.get(key, 0) < self.max_connections:
+            self.connect(key)
+
+    def get_connection(self, key, request):
+        """ an idle connection, or one we can pipeline
+            the request on with the least requests
+            waiting ahead of it
+        """
+        best = None
+        for connection in self.connections.get(key, ()):
+            if connection.is_idle():
+                return connection
+            if connection.can_pipeline(request):
+                if best is None or len(connection.requests) < len(best.requests):
+                    best = connection
+        return best
+
+    def connect(self, key):
+        self.connecting[key] = self.connecting.get(key, 0) + 1
+        host, port = key
+        c = protocol.ClientCreator(reactor, PersistentHTTPClient, self, key)
+        d = c.connectTCP(host, port, timeout=30)
+        d.addErrback(self.connection_failed, key)
+
+    def connection_made(self, connection):
+        key = connection.key
+        self.connecting[key] -= 1
+        if self.connecting[key] == 0:
+            del self.connecting[key]
+        self.connections.setdefault(key, []).append(connection)
+        self.dispatch(key)
+        if connection.is_idle():
+            connection.start_idle()
+
+    def connection_failed(self, reason, key):
+        self.connecting[key] -= 1
+        if self.connecting[key] == 0:
+            del self.connecting[key]
+        self.info("connecting to %r failed: %s", key, reason.getErrorMessage())
+        if key in self.connections or key in self.connecting:
+            """ the others might do better """
+            self.dispatch(key)
+            return
+        for request in self.pending.pop(key, ()):
+            request.deferred.errback(reason)
+
+    def response_received(self, connection):
+        self.dispatch(connection.key)
+        if connection.is_idle():
+            connection.start_idle()
+
+    def connection_lost(self, connection, retry):
+        key = connection.key
+        connections = self.connections.get(key, [])
+        if connection in connections:
+            connections.remove(connection)
+            if not connections:
+                del self.connections[key]
+        if retry:
+            self.debug("sending %d requests to %r again", len(retry), key)
+            self.pending.setdefault(key, deque()).extendleft(reversed(retry))
+        self.dispatch(key)
+
+    def close(self, key=None):
+        """ drop the connections, to all hosts or to key """
+        for k, connections in self.connections.items():
+            if key is None or k == key:
+                for connection in connections[:]:
+                    connection.close()
+
+
+_pool = None
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = HTTPConnectionPool()
+    return _pool
+
+def configure(max_connections=None, idle_timeout=None, pipelining=None):
+    pool = get_pool()
+    if max_connections is not None:
+        pool.max_connections = max(1, int(max_connections))
+    if idle_timeout is not None:
+        pool.idle_timeout = float(idle_timeout)
+    if pipelining is not None:
+        pool.pipelining = max(1, int(pipelining))
+    return pool
@@ -5,13 +5,12 @@
 # Copyright 2006, Frank Scholz <coherence@beebits.net>
 
 import socket
-import time
 
 from twisted.internet.protocol import DatagramProtocol
 from twisted.internet import reactor
 from twisted.internet import task
 
-from coherence.upnp.core import utils
+from coherence.upnp.core.ssdp import parse_message, SSDPParseError
 
 import coherence.extern.louie as louie
 
@@ -25,6 +24,7 @@ class MSearch(DatagramProtocol, log.Loggable):
 
     def __init__(self, ssdp_server, test=False):
         self.ssdp_server = ssdp_server
+        self.malformed = 0
         if test == False:
             self.port = reactor.listenUDP(0, self)
 
@@ -32,7 +32,16 @@ class MSearch(DatagramProtocol, log.Loggable):
             self.double_discover_loop.start(120.0)
 
     def datagramReceived(self, data, (host, port)):
-        cmd, headers = utils.parse_http_response(data)
+        try:
+            cmd, headers = parse_message(data)
+            if cmd[1] == '200':
+                for header in ('usn', 'st', 'location'):
+                    if header not in headers:
+                        raise SSDPParseError('missing %s' % header)
+        except SSDPParseError, err:
+            self.malformed += 1
+            self.info('dropping malformed response from %s:%d - %s', host, port, err)
+            return
         self.info('datagramReceived from %s:%d, protocol %s code %s' % (host, port, cmd[0], cmd[1]))
         if cmd[0].startswith('HTTP/1.') and cmd[1] == '200':
             self.msg('for %r', headers['usn'])
@@ -41,12 +50,11 @@ class MSearch(DatagramProtocol, log.Loggable):
                 self.ssdp_server.register('remote',
                                             headers['usn'], headers['st'],
                                             headers['location'],
-                                            headers['server'],
-                                            headers['cache-control'],
+                                            headers.get('server', ''),
+                                            headers.get('cache-control', 'max-age=1800'),
                                             host=host)
             else:
-                self.ssdp_server.known[headers['usn']]['last-seen'] = time.time()
-                self.debug('updating last-seen for %r' % headers['usn'])
+                self.ssdp_server.seen(headers['usn'])
 
         # make raw data available
         # send out the signal after we had a chance to register the device
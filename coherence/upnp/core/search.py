@@ -0,0 +1,543 @@
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+""" the SearchCriteria of a ContentDirectory Search action
+
+    parse() turns a criteria string, like
+
+        upnp:class derivedfrom "object.item.audioItem" and
+        (dc:title contains "love" or upnp:artist = "Madonna")
+
+    into a tree of expressions, which can tell if a DIDL-Lite
+    object matches, and which can ask SearchIndexes for the
+    ids of the matching objects, without looking at each of them
+
+    the grammar is the one of the UPnP ContentDirectory
+    specification, 'and' binds stronger than 'or', keywords
+    and string comparisons are case-insensitive
+"""
+
+import re
+from datetime import datetime
+
+class SearchCriteriaError(Exception):
+    """ the criteria string isn't valid """
+
+
+_tokens = re.compile(r'''\s*(?:
+                           (?P<paren>[()])|
+                           "(?P<string>(?:[^"\\]|\\.)*)"|
+                           (?P<relop>!=|<=|>=|=|<|>)|
+                           (?P<word>[^\s()"=<>!]+)
+                         )''', re.VERBOSE)
+
+RELATION_OPERATORS = ('=', '!=', '<', '<=', '>', '>=')
+STRING_OPERATORS = ('contains', 'doesnotcontain', 'derivedfrom', 'startswith')
+
+def tokenize(criteria):
+    """ returns the tokens of criteria as (type, value)
+        tuples, type is one of paren, string, relop and word
+    """
+    tokens = []
+    position = 0
+    criteria = criteria.rstrip()
+    while position < len(criteria):
+        match = _tokens.match(criteria, position)
+        if match is None:
+            raise SearchCriteriaError("unexpected %r at position %d" % (
+                                        criteria[position:position+10], position))
+        position = match.end()
+        for type in ('paren', 'string', 'relop', 'word'):
+            value = match.group(type)
+            if value is not None:
+                if type == 'string':
+                    value = re.sub(r'\\(.)', r'\1', value)
+                tokens.append((type, value))
+                break
+    return tokens
+
+
+def _text(value):
+    if isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, datetime):
+        return unicode(value.isoformat())
+    if isinstance(value, bool):
+        return value and u'1' or u'0'
+    return unicode(value)
+
+def normalize(value):
+    """ the form of a value we compare and index """
+    return _text(value).lower()
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+_words = re.compile(r'\w+', re.UNICODE)
+
+def words(value):
+    """ the words of a normalized value """
+    return _words.findall(value)
+
+
+""" the DIDL-Lite object attributes of the properties,
+    whatever isn't in here is looked up by the name of the
+    property without its namespace prefix
+"""
+_attributes = {'dc:title': 'title',
+               'dc:creator': 'creator',
+               'dc:date': 'date',
+               'dc:description': 'description',
+               'upnp:class': 'upnp_class',
+               'upnp:artist': 'artist',
+               'upnp:album': 'album',
+               'upnp:genre': 'genre',
+               'upnp:albumArtURI': 'albumArtURI',
+               'upnp:originalTrackNumber': 'originalTrackNumber',
+               'upnp:longDescription': 'longDescription',
+               '@id': 'id',
+               '@parentID': 'parentID',
+               '@refID': 'refID',
+               '@restricted': 'restricted',
+               '@childCount': 'childCount',
+               '@searchable': 'searchable'}
+
+""" what we announce as the SearchCapabilities of a
+    ContentDirectory, we can evaluate any property, but
+    these are the ones clients will look for
+"""
+SEARCH_CAPABILITIES = ('@id', '@parentID', '@refID', 'dc:title', 'dc:creator',
+                       'dc:date', 'upnp:class', 'upnp:artist', 'upnp:album',
+                       'upnp:genre', 'upnp:originalTrackNumber', 'res',
+                       'res@size', 'res@duration', 'res@protocolInfo')
+
+def get_values(obj, property):
+    """ returns the list of values property has for
+        the DIDL-Lite object obj, the empty list if
+        it doesn't have that property at all
+    """
+    if property == 'res' or property.startswith('res@'):
+        attribute = property[4:] or 'data'
+        values = [getattr(res, attribute, None) for res in (obj.res or [])]
+    else:
+        attribute = _attributes.get(property)
+        if attribute is None:
+            attribute = property.split(':')[-1].lstrip('@')
+        value = getattr(obj, attribute, None)
+        if property == 'upnp:genre' and getattr(obj, 'genres', None):
+            values = list(obj.genres)
+            if value is not None and value not in values:
+                values.insert(0, value)
+        elif isinstance(value, (list, tuple)):
+            values = list(value)
+        else:
+            values = [value]
+    return [v for v in values if v is not None]
+
+
+class Expression(object):
+    """ the base class of the parsed SearchCriteria """
+
+    def match(self, get_values):
+        """ returns True if the object get_values(property)
+            returns the values for matches
+        """
+        raise NotImplementedError
+
+    def matches(self, obj):
+        """ returns True if the DIDL-Lite object obj matches """
+        return self.match(lambda property: get_values(obj, property))
+
+    def candidates(self, indexes):
+        """ asks the indexes for the ids of the matching objects,
+            returns an (ids, exact) tuple
+
+            ids is None when we have no idea and need to look
+            at each object, with exact True when any object
+            matches, otherwise it is the set of ids of the
+            objects that can match, and exact tells if they
+            all do
+        """
+        return None, False
+
+
+class Everything(Expression):
+    """ the '*' criteria, or an empty one """
+
+    def match(self, get_values):
+        return True
+
+    def candidates(self, indexes):
+        return None, True
+
+    def __repr__(self):
+        return '*'
+
+
+class And(Expression):
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+    def match(self, get_values):
+        return self.left.match(get_values) and self.right.match(get_values)
+
+    def candidates(self, indexes):
+        left, left_exact = self.left.candidates(indexes)
+        right, right_exact = self.right.candidates(indexes)
+        exact = left_exact and right_exact
+        if left is None:
+            return right, exact
+        if right is None:
+            return left, exact
+        return left & right, exact
+
+    def __repr__(self):
+        return '(%r and %r)' % (self.left, self.right)
+
+
+class Or(Expression):
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+    def match(self, get_values):
+        return self.left.match(get_values) or self.right.match(get_values)
+
+    def candidates(self, indexes):
+        left, left_exact = self.left.candidates(indexes)
+        right, right_exact = self.right.candidates(indexes)
+        if left is None or right is None:
+            # anything can match, but maybe everything does
+            return None, ((left is None and left_exact) or
+                          (right is None and right_exact))
+        return left | right, left_exact and right_exact
+
+    def __repr__(self):
+        return '(%r or %r)' % (self.left, self.right)
+
+
+class Relation(Expression):
+    """ a property compared with a quoted value """
+
+    def __init__(self, property, operator, value):
+        self.property = property
+        self.operator = operator
+        self.value = value
+        self.normalized = normalize(value)
+
+    def compare(self, value):
+        """ compares a single, normalized, value of the
+            property with ours, the negating operators are
+            handled by match()
+        """
+        operator = self.operator
+        if operator in ('=', '!='):
+            return value == self.normalized
+        if operator in ('contains', 'doesnotcontain'):
+            return self.normalized in value
+        if operator == 'startswith':
+            return value.startswith(self.normalized)
+        if operator == 'derivedfrom':
+            return(value == self.normalized or
+                   value.startswith(self.normalized + '.'))
+        a = _number(value)
+        b = _number(self.normalized)
+        if a is None or b is None:
+            a = value
+            b = self.normalized
+        if operator == '<':
+            return a < b
+        if operator == '<=':
+            return a <= b
+        if operator == '>':
+            return a > b
+        return a >= b
+
+    def match(self, get_values):
+        values = get_values(self.property)
+        if not values:
+            # a relation on a property the object
+            # doesn't have is always False
+            return False
+        found = False
+        for value in values:
+            if self.compare(normalize(value)):
+                found = True
+                break
+        if self.operator in ('!=', 'doesnotcontain'):
+            return not found
+        return found
+
+    def candidates(self, indexes):
+        ids = indexes.lookup(self.property, self.operator, self.normalized)
+        if ids is None:
+            return None, False
+        return ids, True
+
+    def __repr__(self):
+        return '%s %s "%s"' % (self.property, self.operator, _text(self.value).encode('utf-8'))
+
+
+class Exists(Expression):
+
+    def __init__(self, property, exists):
+        self.property = property
+        self.exists = exists
+
+    def match(self, get_values):
+        return (len(get_values(self.property)) > 0) == self.exists
+
+    def candidates(self, indexes):
+        ids = indexes.lookup(self.property, 'exists', self.exists)
+        if ids is None:
+            return None, False
+        return ids, True
+
+    def __repr__(self):
+        return '%s exists %s' % (self.property, self.exists and 'true' or 'false')
+
+
+class _Parser(object):
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        try:
+            return self.tokens[self.position]
+        except IndexError:
+            return None, None
+
+    def next(self, what):
+        token = self.peek()
+        if token[0] is None:
+            raise SearchCriteriaError("unexpected end, %s expected" % what)
+        self.position += 1
+        return token
+
+    def keyword(self, *keywords):
+        """ consumes the next token if it is one of keywords """
+        type, value = self.peek()
+        if type == 'word' and value.lower() in keywords:
+            self.position += 1
+            return value.lower()
+        return None
+
+    def expression(self):
+        left = self.and_expression()
+        while self.keyword('or'):
+            left = Or(left, self.and_expression())
+        return left
+
+    def and_expression(self):
+        left = self.primary()
+        while self.keyword('and'):
+            left = And(left, self.primary())
+        return left
+
+    def primary(self):
+        type, value = self.next('an expression')
+        if (type, value) == ('paren', '('):
+            expression = self.expression()
+            if self.next("')'") != ('paren', ')'):
+                raise SearchCriteriaError("')' expected")
+            return expression
+        if type != 'word':
+            raise SearchCriteriaError("property expected, got %r" % value)
+        property = value
+
+        type, value = self.next('an operator')
+        if type == 'relop':
+            operator = value
+        elif type == 'word' and value.lower() in STRING_OPERATORS:
+            operator = value.lower()
+        elif type == 'word' and value.lower() == 'exists':
+            type, value = self.next("'true' or 'false'")
+            if type != 'word' or value.lower() not in ('true', 'false'):
+                raise SearchCriteriaError("'true' or 'false' expected, got %r" % value)
+            return Exists(property, value.lower() == 'true')
+        else:
+            raise SearchCriteriaError("operator expected, got %r" % value)
+
+        type, value = self.next('a quoted value')
+        if type != 'string':
+            raise SearchCriteriaError("quoted value expected, got %r" % value)
+        return Relation(property, operator, value)
+
+
+def parse(criteria):
+    """ returns the Expression for the SearchCriteria string,
+        raises a SearchCriteriaError if it isn't valid
+    """
+    if criteria is None or criteria.strip() in ('', '*'):
+        return Everything()
+    parser = _Parser(tokenize(criteria))
+    expression = parser.expression()
+    if parser.position != len(parser.tokens):
+        raise SearchCriteriaError("unexpected %r" % (parser.peek()[1],))
+    return expression
+
+
+class PropertyIndex(object):
+    """ an in-memory inverted index over the values of
+        one property
+
+        that's what SearchIndexes uses by default, another
+        index for a property has to provide the same add,
+        remove and lookup methods
+    """
+
+    def __init__(self, property):
+        self.property = property
+        self.values = {}    # id -> tuple of normalized values
+        self.by_value = {}  # normalized value -> set of ids
+        self.by_word = {}   # word -> set of ids
+
+    def add(self, id, values):
+        values = tuple(normalize(v) for v in values)
+        self.values[id] = values
+        for value in values:
+            self.by_value.setdefault(value, set()).add(id)
+            for word in words(value):
+                self.by_word.setdefault(word, set()).add(id)
+
+    def remove(self, id):
+        values = self.values.pop(id, ())
+        for value in values:
+            self._discard(self.by_value, value, id)
+            for word in words(value):
+                self._discard(self.by_word, word, id)
+
+    def _discard(self, index, key, id):
+        ids = index.get(key)
+        if ids is not None:
+            ids.discard(id)
+            if len(ids) == 0:
+                del index[key]
+
+    def _having(self, test):
+        """ the ids of all objects with a value test
+            returns True for
+        """
+        ids = set()
+        for value, value_ids in self.by_value.iteritems():
+            if test(value):
+                ids |= value_ids
+        return ids
+
+    def _containing(self, value):
+        """ the ids of all objects with a value that contains
+            value, we only check those with values that have
+            all of its words in them
+        """
+        candidates = None
+        for word in words(value):
+            ids = set()
+            for indexed_word, word_ids in self.by_word.iteritems():
+                if word in indexed_word:
+                    ids |= word_ids
+            if candidates is None:
+                candidates = ids
+            else:
+                candidates &= ids
+        if candidates is None:
+            # value has no words in it
+            return self._having(lambda v: value in v)
+        return set(id for id in candidates
+                   if [v for v in self.values[id] if value in v])
+
+    def lookup(self, operator, value):
+        """ returns the set of ids of the objects matching,
+            value is already normalized
+
+            the ids are owned by the caller, we don't keep
+            a reference to them
+        """
+        if operator == 'exists':
+            with_values = set(id for id, values in self.values.iteritems() if values)
+            if value == True:
+                return with_values
+            return set(self.values) - with_values
+        if operator == '=':
+            return set(self.by_value.get(value, ()))
+        if operator == 'contains':
+            return self._containing(value)
+        if operator == 'startswith':
+            return self._having(lambda v: v.startswith(value))
+        if operator == 'derivedfrom':
+            return self._having(lambda v: v == value or v.startswith(value + '.'))
+        if operator in ('!=', 'doesnotcontain'):
+            positive = operator == '!=' and '=' or 'contains'
+            with_values = set(id for id, values in self.values.iteritems() if values)
+            return with_values - self.lookup(positive, value)
+        relation = Relation(self.property, operator, value)
+        return self._having(relation.compare)
+
+
+class SearchIndexes(object):
+    """ the indexes of a store, one per property
+
+        the objects are added and removed with their id, and
+        the values of their properties are only collected
+        with the next lookup, as the store might not have
+        everything set up yet when it adds an object
+    """
+
+    def __init__(self, properties=(), index_factory=PropertyIndex):
+        self.indexes = {}
+        self.pending = set()
+        self.ids = {}   # id -> the order we got it in
+        self.counter = 0
+        for property in properties:
+            self.add_index(index_factory(property))
+
+    def add_index(self, index):
+        """ adds or replaces the index for index.property """
+        self.indexes[index.property] = index
+        # it needs to know about everything we have
+        self.pending.update(self.ids)
+
+    def add(self, id):
+        """ adds an object, or marks it as changed """
+        if id not in self.ids:
+            self.counter += 1
+            self.ids[id] = self.counter
+        self.pending.add(id)
+
+    def remove(self, id):
+        if self.ids.pop(id, None) is not None:
+            for index in self.indexes.values():
+                index.remove(id)
+        self.pending.discard(id)
+
+    def update(self, get_values):
+        """ indexes the pending objects,
+            get_values(id, property) returns the values
+            of the property for the object with id
+        """
+        pending = self.pending
+        self.pending = set()
+        for id in pending:
+            for property, index in self.indexes.iteritems():
+                index.remove(id)
+                index.add(id, get_values(id, property) or ())
+
+    def lookup(self, property, operator, value):
+        index = self.indexes.get(property)
+        if index is None:
+            return None
+        return index.lookup(operator, value)
+
+    def sorted(self, ids):
+        """ returns the ids in the order we got them """
+        order = self.ids
+        return sorted(ids, key=lambda id: order.get(id, 0))
@@ -13,6 +13,7 @@ from coherence.upnp.core import event
 from coherence.upnp.core import variable
 
 from coherence.upnp.core import utils
+from coherence.upnp.core import description_cache
 from coherence.upnp.core.soap_proxy import SOAPProxy
 from coherence.upnp.core.soap_service import errorCode
 from coherence.upnp.core.event import EventSubscriptionServer
@@ -22,6 +23,7 @@ from coherence.extern.et import ET
 from twisted.web import static
 from twisted.internet import defer, reactor
 from twisted.python import failure, util
+from twisted.python.util import OrderedDict
 from twisted.internet import task
 
 import coherence.extern.louie as louie
@@ -66,7 +68,6 @@ class Service(log.Loggable):
         self.subscription_id = None
         self.timeout = 0
 
-        self.event_connection = None
         self.last_time_updated = None
 
         self.client = None
@@ -152,8 +153,6 @@ class Service(log.Loggable):
             self.renew_subscription_call.cancel()
         except:
             pass
-        if self.event_connection != None:
-            self.event_connection.teardown()
         if self.subscription_id != None:
             self.unsubscribe()
         for name,action in self._actions.items():
@@ -323,40 +322,23 @@ class Service(log.Loggable):
 
     def parse_actions(self):
 
-        def gotPage(x):
-            #print "gotPage"
-            #print x
-            self.scpdXML, headers = x
-            tree = utils.parse_xml(self.scpdXML, 'utf-8').getroot()
-            ns = "urn:schemas-upnp-org:service-1-0"
-
-            for action_node in tree.findall('.//{%s}action' % ns):
-                name = action_node.findtext('{%s}name' % ns)
-                arguments = []
-                for argument in action_node.findall('.//{%s}argument' % ns):
-                    arg_name = argument.findtext('{%s}name' % ns)
-                    arg_direction = argument.findtext('{%s}direction' % ns)
-                    arg_state_var = argument.findtext('{%s}relatedStateVariable' % ns)
-                    arguments.append(action.Argument(arg_name, arg_direction,
-                                                     arg_state_var))
+        def gotTable(result):
+            """ the table of actions and variables
+                may be shared with other services
+            """
+            self.scpdXML, (actions, variables) = result
+
+            for name, arguments in actions:
+                arguments = [action.Argument(arg_name, arg_direction, arg_state_var)
+                             for arg_name, arg_direction, arg_state_var in arguments]
                 self._actions[name] = action.Action(self, name, 'n/a', arguments)
 
-            for var_node in tree.findall('.//{%s}stateVariable' % ns):
-                send_events = var_node.attrib.get('sendEvents','yes')
-                name = var_node.findtext('{%s}name' % ns)
-                data_type = var_node.findtext('{%s}dataType' % ns)
-                values = []
-                """ we need to ignore this, as there we don't get there our
-                    {urn:schemas-beebits-net:service-1-0}X_withVendorDefines
-                    attibute there
-                """
-                for allowed in var_node.findall('.//{%s}allowedValue' % ns):
-                    values.append(allowed.text)
+            for name, send_events, data_type, values in variables:
                 instance = 0
                 self._variables.get(instance)[name] = variable.StateVariable(self, name,
                                                                'n/a',
                                                                instance, send_events,
-                                                               data_type, values)
+                                                               data_type, list(values))
                 """ we need to do this here, as there we don't get there our
                     {urn:schemas-beebits-net:service-1-0}X_withVendorDefines
                     attibute there
@@ -381,8 +363,9 @@ class Service(log.Loggable):
             self.info('failure', failure)
             louie.send('Coherence.UPnP.Service.detection_failed', self.device, device=self.device)
 
-        #print 'getPage', self.get_scpd_url()
-        utils.getPage(self.get_scpd_url()).addCallbacks(gotPage, gotError, None, None, [self.get_scpd_url()], None)
+        url = self.get_scpd_url()
+        d = description_cache.get_cache().get_scpd(url, self.device.get_description_hash())
+        d.addCallbacks(gotTable, gotError, None, None, [url], None)
 
 moderated_variables = \
         {'urn:schemas-upnp-org:service:AVTransport:2':
@@ -404,6 +387,11 @@ moderated_variables = \
 class ServiceServer(log.Loggable):
     logCategory = 'service_server'
 
+    """ seconds between the events for the moderated variables,
+        the 'event_moderation_interval' of the config if set there
+    """
+    moderation_interval = 0.5
+
     def __init__(self, id, version, backend):
         self.id = id
         self.version = version
@@ -428,9 +416,13 @@ class ServiceServer(log.Loggable):
 
         self._actions = {}
         self._variables = {0: {}}
-        self._subscribers = {}
+        self._subscribers = event.Subscribers()
 
         self._pending_notifications = {}
+        self._container_update_ids = {}
+
+        """ the variables changed since the last LastChange event """
+        self._changed_variables = OrderedDict()
 
         self.last_change = None
         self.init_var_and_actions()
@@ -443,16 +435,18 @@ class ServiceServer(log.Loggable):
 
         self.putChild(self.subscription_url, EventSubscriptionServer(self))
 
-        self.check_subscribers_loop = task.LoopingCall(self.check_subscribers)
-        self.check_subscribers_loop.start(120.0, now=False)
-
         self.check_moderated_loop = None
         if moderated_variables.has_key(self.service_type):
+            interval = self.moderation_interval
+            try:
+                interval = float(self.device.coherence.config.get('event_moderation_interval', interval))
+            except (AttributeError, ValueError):
+                pass
             self.check_moderated_loop = task.LoopingCall(self.check_moderated_variables)
-            #self.check_moderated_loop.start(5.0, now=False)
-            self.check_moderated_loop.start(0.5, now=False)
+            self.check_moderated_loop.start(interval, now=False)
 
     def _release(self):
+        self._subscribers.stop()
         for p in self._pending_notifications.values():
             p.disconnect()
         self._pending_notifications = {}
@@ -475,6 +469,15 @@ class ServiceServer(log.Loggable):
     def rm_notification(self,result,d):
         del self._pending_notifications[d]
 
+    def send_notification(self, subscriber, xml):
+        d,p = event.send_notification(subscriber, xml)
+        self._pending_notifications[d] = p
+        d.addErrback(self.notification_failed, subscriber['sid'])
+        d.addBoth(self.rm_notification,d)
+
+    def notification_failed(self, failure, sid):
+        self._subscribers.delivery_failed(sid)
+
     def new_subscriber(self, subscriber):
         notify = []
         for vdict in self._variables.values():
@@ -503,10 +506,8 @@ class ServiceServer(log.Loggable):
 
         if evented_variables > 0:
             xml = ET.tostring( root, encoding='utf-8')
-            d,p = event.send_notification(subscriber, xml)
-            self._pending_notifications[d] = p
-            d.addBoth(self.rm_notification,d)
-        self._subscribers[subscriber['sid']] = subscriber
+            self.send_notification(subscriber, xml)
+        self._subscribers.add(subscriber)
 
     def get_id(self):
         return self.id
@@ -525,6 +526,7 @@ class ServiceServer(log.Loggable):
                                                                         v.data_type,
                                                                         v.allowed_values)
             self._variables[instance][v.name].has_vendor_values = v.has_vendor_values
+            self._variables[instance][v.name].never_evented = v.never_evented
             self._variables[instance][v.name].default_value = v.default_value
             #self._variables[instance][v.name].value = v.default_value # FIXME
             self._variables[instance][v.name].old_value = v.old_value
@@ -538,6 +540,16 @@ class ServiceServer(log.Loggable):
 
     def set_variable(self, instance, variable_name, value, default=False):
 
+        if(variable_name == 'ContainerUpdateIDs' and
+           isinstance(value, tuple) and
+           self.is_variable_moderated(variable_name)):
+            """ a (container id, update id) pair, we just remember the
+                latest update id of each container and hand them all
+                over as one value with the next moderation window
+            """
+            self._container_update_ids.setdefault(int(instance), {})[str(value[0])] = value[1]
+            return
+
         def process_value(result):
             variable.update(result)
             if default == True:
@@ -547,9 +559,7 @@ class ServiceServer(log.Loggable):
                 len(self._subscribers) > 0):
                 xml = self.build_single_notification(instance, variable_name, variable.value)
                 for s in self._subscribers.values():
-                    d,p = event.send_notification(s, xml)
-                    self._pending_notifications[d] = p
-                    d.addBoth(self.rm_notification,d)
+                    self.send_notification(s, xml)
         try:
             variable = self._variables[int(instance)][variable_name]
             if isinstance( value, defer.Deferred):
@@ -572,30 +582,44 @@ class ServiceServer(log.Loggable):
         s = ET.SubElement( e, variable_name).text = str(value)
         return ET.tostring( root, encoding='utf-8')
 
+    def variable_changed(self, variable):
+        self._changed_variables[(variable.instance, variable.name)] = variable
+
     def build_last_change_event(self, instance=0, force=False):
-        got_one = False
-        root = ET.Element('Event')
-        root.attrib['xmlns']=self.event_metadata
-        for instance, vdict in self._variables.items():
-            e = ET.SubElement( root, 'InstanceID')
-            e.attrib['val']=str(instance)
-            for variable in vdict.values():
-                if( variable.name != 'LastChange' and
-                    variable.name[0:11] != 'A_ARG_TYPE_' and
-                    variable.never_evented == False and
-                    (variable.updated == True or force == True)):
-                    s = ET.SubElement( e, variable.name)
-                    s.attrib['val'] = str(variable.value)
-                    variable.updated = False
-                    got_one = True
-                    if variable.dependant_variable != None:
-                        dependants = variable.dependant_variable.get_allowed_values()
-                        if dependants != None and len(dependants) > 0:
-                            s.attrib['channel']=dependants[0]
-        if got_one == True:
-            return ET.tostring( root, encoding='utf-8')
+        """ the LastChange event with the variables changed since
+            the last one, of all instances, or with all of them
+            when forced - for a new subscriber, that doesn't
+            take the changes from the others
+        """
+        if force == True:
+            variables = []
+            for i, vdict in sorted(self._variables.items()):
+                variables.extend(vdict.values())
         else:
+            variables = self._changed_variables.values()
+            self._changed_variables = OrderedDict()
+        instances = {}
+        for variable in variables:
+            if(variable.name == 'LastChange' or
+               variable.name[0:11] == 'A_ARG_TYPE_' or
+               variable.never_evented == True):
+                continue
+            if force == False:
+                if self._variables.get(variable.instance, {}).get(variable.name) is not variable:
+                    """ the instance is gone """
+                    continue
+                variable.updated = False
+            instances.setdefault(variable.instance, []).append(variable.get_last_change_fragment())
+        if len(instances) == 0:
             return None
+        xml = ["<?xml version='1.0' encoding='utf-8'?>\n",
+               '<Event xmlns="%s">' % self.event_metadata]
+        for i in sorted(instances):
+            xml.append('<InstanceID val="%s">' % i)
+            xml.extend(instances[i])
+            xml.append('</InstanceID>')
+        xml.append('</Event>')
+        return ''.join(xml)
 
     def propagate_notification(self, notify):
         #print "propagate_notification", notify
@@ -631,25 +655,40 @@ class ServiceServer(log.Loggable):
         xml = ET.tostring( root, encoding='utf-8')
         #print "propagate_notification", xml
         for s in self._subscribers.values():
-            d,p = event.send_notification(s,xml)
-            self._pending_notifications[d] = p
-            d.addBoth(self.rm_notification,d)
+            self.send_notification(s, xml)
 
     def check_subscribers(self):
-        for s in self._subscribers.values():
-            timeout = 86400
-            #print s
-            if s['timeout'].startswith('Second-'):
-                timeout = int(s['timeout'][len('Second-'):])
-            if time.time() > s['created'] + timeout:
-                del s
+        """ remove the subscribers whose subscription ran out,
+            Subscribers does that on its own when they are due
+        """
+        self._subscribers.check()
+
+    def flush_container_update_ids(self):
+        """ sets the ContainerUpdateIDs collected since the last
+            moderation window as one combined CSV value
+        """
+        pending = self._container_update_ids
+        self._container_update_ids = {}
+        for instance, update_ids in pending.items():
+            value = ','.join(['%s,%s' % (id, update_id) for id, update_id in update_ids.items()])
+            self.set_variable(instance, 'ContainerUpdateIDs', value)
 
     def check_moderated_variables(self):
         #print "check_moderated for %s" % self.id
         #print self._subscribers
+        if len(self._container_update_ids) > 0:
+            self.flush_container_update_ids()
+        variables = moderated_variables[self.get_type()]
         if len(self._subscribers) <= 0:
+            """ nobody to tell, but start the next window afresh,
+                otherwise ContainerUpdateIDs would grow forever
+            """
+            for v in variables:
+                for vdict in self._variables.values():
+                    if v in vdict:
+                        vdict[v].updated = False
+            self._changed_variables = OrderedDict()
             return
-        variables = moderated_variables[self.get_type()]
         notify = []
         for v in variables:
             #print self._variables[0][v].name, self._variables[0][v].updated
@@ -985,8 +1024,6 @@ class scpdXML(static.Data):
 
         return """<?xml version="1.0" encoding="utf-8"?>""" + ET.tostring( root, encoding='utf-8')
 
-from twisted.python.util import OrderedDict
-
 class ServiceControl:
 
     def get_action_results(self, result, action, instance):
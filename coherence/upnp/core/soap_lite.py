@@ -38,9 +38,15 @@ UPNPERRORS = {401:'Invalid Action',
               611:'Invalid Control URL',
               612:'No Such Session',}
 
+_errors = {}
+
 def build_soap_error(status,description='without words'):
     """ builds an UPnP SOAP error msg
     """
+    try:
+        return _errors[(status, description)]
+    except KeyError:
+        pass
     root = ET.Element('s:Fault')
     ET.SubElement(root,'faultcode').text='s:Client'
     ET.SubElement(root,'faultstring').text='UPnPError'
@@ -49,7 +55,51 @@ def build_soap_error(status,description='without words'):
     e.attrib['xmlns']='urn:schemas-upnp-org:control-1-0'
     ET.SubElement(e,'errorCode').text=str(status)
     ET.SubElement(e,'errorDescription').text=UPNPERRORS.get(status,description)
-    return build_soap_call(None, root, encoding=None)
+    error = _errors[(status, description)] = build_soap_call(None, root, encoding=None)
+    return error
+
+""" how build_soap_call turns the argument values into text """
+_converters = {str: lambda v: v,
+               unicode: lambda v: v.encode('utf-8'),
+               int: str,
+               float: str,
+               bool: lambda v: v and '1' or '0'}
+
+def escape(text):
+    """ what ElementTree escapes in the text of an element """
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+_ARGUMENTS = 'soap-lite-arguments'
+_envelopes = {}
+
+def _envelope(method, is_response, encoding, envelope_attrib):
+    """ the serialized envelope for a method, split into the
+        parts before and after the arguments, and the whole
+        message for when there are none
+
+        built once per method with the ElementTree encoder,
+        so they come out the same way as before
+    """
+    if envelope_attrib:
+        envelope_attrib = tuple([tuple(n) for n in envelope_attrib])
+    key = (method, is_response, encoding, envelope_attrib)
+    try:
+        return _envelopes[key]
+    except KeyError:
+        pass
+    marker = '<%s />' % _ARGUMENTS
+    data = _build_soap_call(method, ET.Element(_ARGUMENTS), is_response,
+                            encoding, envelope_attrib)
+    prefix, suffix = data.split(marker)
+    empty = _build_soap_call(method, {}, is_response, encoding, envelope_attrib)
+    _envelopes[key] = prefix, suffix, empty
+    return prefix, suffix, empty
 
 def build_soap_call(method, arguments, is_response=False,
                                        encoding=SOAP_ENCODING,
@@ -59,7 +109,35 @@ def build_soap_call(method, arguments, is_response=False,
         - set method to none to omitt the method element and
           add the arguments directly to the body (for an error msg)
         - arguments can be a dict or an ET.Element
+
+        a dict of arguments is written straight into the
+        precompiled envelope of the method
     """
+    if typed or not isinstance(arguments,(dict,OrderedDict)):
+        return _build_soap_call(method, arguments, is_response,
+                                encoding, envelope_attrib, typed)
+
+    prefix, suffix, empty = _envelope(method, is_response, encoding, envelope_attrib)
+    if len(arguments) == 0:
+        return empty
+    parts = [prefix]
+    for arg_name, arg_val in arguments.iteritems():
+        if '{' in arg_name:
+            return _build_soap_call(method, arguments, is_response,
+                                    encoding, envelope_attrib, typed)
+        arg_val = _converters[type(arg_val)](arg_val)
+        if arg_val:
+            parts.append('<%s>%s</%s>' % (arg_name, escape(arg_val), arg_name))
+        else:
+            parts.append('<%s />' % arg_name)
+    parts.append(suffix)
+    return ''.join(parts)
+
+def _build_soap_call(method, arguments, is_response=False,
+                                        encoding=SOAP_ENCODING,
+                                        envelope_attrib=None,
+                                        typed=None):
+    """ build_soap_call with ElementTree """
     envelope = ET.Element("s:Envelope")
     if envelope_attrib:
         for n in envelope_attrib:
@@ -115,3 +193,62 @@ def build_soap_call(method, arguments, is_response=False,
 
     preamble = """<?xml version="1.0" encoding="utf-8"?>"""
     return preamble + ET.tostring(envelope,'utf-8')
+
+
+class SOAPParseError(Exception):
+    pass
+
+_xsi_type = NS_XSI + 'type'
+
+def _decode_value(text, type):
+    """ like UPnPPublisher.decode_result """
+    if type is not None:
+        try:
+            prefix, local = type.split(":")
+            if prefix == 'xsd':
+                type = local
+        except ValueError:
+            pass
+
+    if type == "integer" or type == "int":
+        return int(text)
+    if type == "float" or type == "double":
+        return float(text)
+    if type == "boolean":
+        return text == "true"
+
+    return text or ""
+
+def parse_soap_call(data):
+    """ decode a SOAP request
+
+        returns the namespace and name of the method and its
+        arguments as a list of (name, value) tuples, with the
+        values decoded per their xsi:type
+
+        raises SOAPParseError on malformed data or a missing method
+    """
+    try:
+        parser = ET.XMLParser(encoding='utf-8')
+    except TypeError:
+        parser = ET.XMLParser()
+    try:
+        parser.feed(data.replace('\x00', ''))
+        envelope = parser.close()
+    except Exception, error:
+        raise SOAPParseError(str(error))
+    body = envelope.find(NS_SOAP_ENV + 'Body')
+    if body is None or len(body) == 0:
+        raise SOAPParseError("no method in the SOAP Body")
+    method = body[0]
+    methodName = method.tag
+    ns = None
+    if methodName.startswith('{') and methodName.rfind('}') > 1:
+        ns, methodName = methodName[1:].split('}')
+    arguments = []
+    try:
+        for child in method:
+            arguments.append((child.tag, _decode_value(child.text, child.get(_xsi_type))))
+    except ValueError, error:
+        raise SOAPParseError(str(error))
+    return ns, methodName, arguments
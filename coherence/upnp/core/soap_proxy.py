@@ -70,7 +70,7 @@ class SOAPProxy(log.Loggable):
             return error
 
         return getPage(self.url, postdata=payload, method="POST",
-                        headers=headers
+                        headers=headers, persistent=True
                       ).addCallbacks(self._cbGotResult, gotError, None, None, [self.url], None)
 
     def _cbGotResult(self, result):
@@ -3,6 +3,8 @@
 
 # Copyright 2007 - Frank Scholz <coherence@beebits.net>
 
+from collections import OrderedDict
+
 from twisted.web import server, resource
 from twisted.python import failure
 from twisted.internet import defer
@@ -11,8 +13,6 @@ from coherence import log, SERVER_ID
 
 from coherence.extern.et import ET, namespace_map_update
 
-from coherence.upnp.core.utils import parse_xml
-
 from coherence.upnp.core import soap_lite
 
 import coherence.extern.louie as louie
@@ -34,6 +34,13 @@ class UPnPPublisher(resource.Resource, log.Loggable):
     isLeaf = 1
     encoding = "UTF-8"
     envelope_attrib = None
+    request_cache_size = 64
+    request_cache_max_length = 4096
+    _request_cache = None
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self._request_cache = OrderedDict()
 
     def _sendResponse(self, request, response, status=200):
         self.debug('_sendResponse', status, response)
@@ -88,37 +95,46 @@ class UPnPPublisher(resource.Resource, log.Loggable):
         else:
             return None, None
 
+    def parse_request(self, data):
+        """ the namespace, method name and arguments of a request
+
+            polling clients send the same few requests over and over,
+            so the results for small bodies are kept in an LRU cache
+        """
+        cache = self._request_cache
+        if(cache is not None and self.request_cache_size and
+           len(data) <= self.request_cache_max_length):
+            try:
+                result = cache.pop(data)
+            except KeyError:
+                result = soap_lite.parse_soap_call(data)
+                if len(cache) >= self.request_cache_size:
+                    cache.popitem(last=False)
+            cache[data] = result
+            return result
+        return soap_lite.parse_soap_call(data)
+
     def render(self, request):
         """Handle a SOAP command."""
         data = request.content.read()
         headers = request.getAllHeaders()
-        self.info('soap_request:', headers)
+        self.debug('soap_request: %r', headers)
 
         # allow external check of data
         louie.send('UPnPTest.Control.Client.CommandReceived', None, headers, data)
 
-        def print_c(e):
-            for c in e.getchildren():
-                print c, c.tag
-                print_c(c)
-
-        tree = parse_xml(data)
-        #root = tree.getroot()
-        #print_c(root)
-
-        body = tree.find('{http://schemas.xmlsoap.org/soap/envelope/}Body')
-        method = body.getchildren()[0]
-        methodName = method.tag
-        ns = None
-
-        if methodName.startswith('{') and methodName.rfind('}') > 1:
-            ns, methodName = methodName[1:].split('}')
+        try:
+            ns, methodName, arguments = self.parse_request(data)
+        except soap_lite.SOAPParseError, error:
+            self.warning("malformed SOAP request from %r: %s", request.getClientIP(), error)
+            self._gotError(failure.Failure(errorCode(401)), request, None, None)
+            return server.NOT_DONE_YET
 
         args = []
         kwargs = {}
-        for child in method.getchildren():
-            kwargs[child.tag] = self.decode_result(child)
-            args.append(kwargs[child.tag])
+        for name, value in arguments:
+            kwargs[name] = value
+            args.append(value)
 
         #p, header, body, attrs = SOAPpy.parseSOAPRPC(data, 1, 1, 1)
         #methodName, args, kwargs, ns = p._name, p._aslist, p._asdict, p._ns
@@ -126,11 +142,9 @@ class UPnPPublisher(resource.Resource, log.Loggable):
         try:
             headers['content-type'].index('text/xml')
         except:
-            self._gotError(failure.Failure(errorCode(415)), request, methodName)
+            self._gotError(failure.Failure(errorCode(415)), request, methodName, ns)
             return server.NOT_DONE_YET
 
-        self.debug('headers: %r' % headers)
-
         function, useKeywords = self.lookupFunction(methodName)
         #print 'function', function, 'keywords', useKeywords, 'args', args, 'kwargs', kwargs
 
@@ -153,7 +167,7 @@ class UPnPPublisher(resource.Resource, log.Loggable):
                 keywords['X_UPnPClient'] = 'Philips-TV'
             for k, v in kwargs.items():
                 keywords[str(k)] = v
-            self.info('call', methodName, keywords)
+            self.debug('call %s %r', methodName, keywords)
             if hasattr(function, "useKeywords"):
                 d = defer.maybeDeferred(function, **keywords)
             else:
@@ -9,11 +9,13 @@
 # Implementation of a SSDP server under Twisted Python.
 #
 
+import re
+import math
+import heapq
 import random
-import string
 import sys
-import time
 import socket
+from collections import OrderedDict
 
 from twisted.internet.protocol import DatagramProtocol
 from twisted.internet import reactor, error
@@ -27,6 +29,89 @@ import coherence.extern.louie as louie
 SSDP_PORT = 1900
 SSDP_ADDR = '239.255.255.250'
 
+""" the delayed discovery responses are sent
+    in ticks of RESPONSE_RESOLUTION seconds
+"""
+RESPONSE_RESOLUTION = 0.1
+
+""" discovered devices are removed in runs every
+    EXPIRY_RESOLUTION seconds, so whatever expires
+    close together goes away together
+"""
+EXPIRY_RESOLUTION = 5.0
+DEFAULT_MAX_AGE = 1800
+
+_max_age = re.compile(r'max-age\s*=\s*"?(\d+)', re.I)
+
+""" the headers a message can't be handled without """
+REQUIRED_HEADERS = {'M-SEARCH': ('st',),
+                    'NOTIFY': ('nt', 'nts', 'usn')}
+
+_header_line = re.compile(r'([^\s:]+)[ \t]*:(.*)')
+
+
+class SSDPParseError(ValueError):
+    pass
+
+
+def parse_max_age(cache_control):
+    """ the max-age of a CACHE-CONTROL header in seconds,
+        DEFAULT_MAX_AGE if there is none
+    """
+    match = _max_age.search(cache_control or '')
+    if match is None:
+        return DEFAULT_MAX_AGE
+    return int(match.group(1))
+
+
+def parse_message(data):
+    """ split a SSDP datagram into its start line and headers
+
+        returns the three parts of the start line, with the
+        method uppercased for requests, and a dict of the
+        headers, names lowercased and values stripped
+
+        lines may end with CRLF or just LF, a datagram
+        without the empty line after the headers is accepted,
+        anything else not looking like a HTTP message raises
+        a SSDPParseError
+    """
+    end = data.find('\r\n\r\n')
+    if end < 0:
+        end = data.find('\n\n')
+    if end >= 0:
+        data = data[:end]
+    lines = data.splitlines()
+    if not lines:
+        raise SSDPParseError('empty datagram')
+    cmd = lines[0].split(None, 2)
+    if len(cmd) != 3:
+        raise SSDPParseError('invalid start line %r' % lines[0][:80])
+    if cmd[0][:5] == 'HTTP/':
+        if not cmd[1].isdigit():
+            raise SSDPParseError('invalid status %r' % cmd[1][:80])
+    elif cmd[2][:5] == 'HTTP/':
+        cmd[0] = cmd[0].upper()
+    else:
+        raise SSDPParseError('invalid start line %r' % lines[0][:80])
+
+    headers = {}
+    name = None
+    match = _header_line.match
+    for line in lines[1:]:
+        m = match(line)
+        if m is not None:
+            name, value = m.groups()
+            name = name.lower()
+            headers[name] = value.strip()
+        elif line[:1] in (' ', '\t') and name is not None:
+            """ a folded header continues the one before """
+            headers[name] = ' '.join((headers[name], line.strip()))
+        elif line:
+            raise SSDPParseError('invalid header line %r' % line[:80])
+    return cmd, headers
+
+
 class SSDPServer(DatagramProtocol, log.Loggable):
     """A class implementing a SSDP server.  The notifyReceived and
     searchReceived methods are called when the appropriate type of
@@ -49,23 +134,52 @@ class SSDPServer(DatagramProtocol, log.Loggable):
                 self.resend_notify_loop = task.LoopingCall(self.resendNotify)
                 self.resend_notify_loop.start(777.0, now=False)
 
-                self.check_valid_loop = task.LoopingCall(self.check_valid)
-                self.check_valid_loop.start(333.0, now=False)
-
             except error.CannotListenError, err:
                 self.warning("There seems to be already a SSDP server running on this host, no need starting a second one.")
 
         self.active_calls = []
 
+        """ how many datagrams we got, and how many
+            of them we dropped as not understandable
+        """
+        self.received = 0
+        self.malformed = 0
+
+        """ the prebuilt datagrams of our local USNs,
+            and which of them answer which ST
+        """
+        self.datagrams = {}
+        self.by_st = {}
+        self.announced = OrderedDict()
+
+        """ the discovery responses waiting for their delay,
+            per requester, and the ticks they are due at
+        """
+        self.pending_responses = {}
+        self.response_wheel = {}
+        self.response_ticks = []
+        self.response_call = None
+
+        """ the discovered USNs ordered by the time they
+            expire if they aren't announced again
+        """
+        self.expiry_heap = []
+        self.expiry_call = None
+
     def shutdown(self):
-        for call in reactor.getDelayedCalls():
-            if call.func == self.send_it:
-                call.cancel()
+        if self.response_call is not None and self.response_call.active():
+            self.response_call.cancel()
+        self.response_call = None
+        self.pending_responses = {}
+        self.response_wheel = {}
+        self.response_ticks = []
+        if self.expiry_call is not None and self.expiry_call.active():
+            self.expiry_call.cancel()
+        self.expiry_call = None
+        self.expiry_heap = []
         if self.test == False:
             if self.resend_notify_loop.running:
                 self.resend_notify_loop.stop()
-            if self.check_valid_loop.running:
-                self.check_valid_loop.stop()
             '''Make sure we send out the byebye notifications.'''
             for st in self.known:
                 if self.known[st]['MANIFESTATION'] == 'local':
@@ -73,21 +187,18 @@ class SSDPServer(DatagramProtocol, log.Loggable):
 
     def datagramReceived(self, data, (host, port)):
         """Handle a received multicast datagram."""
-
+        self.received += 1
         try:
-            header, payload = data.split('\r\n\r\n')[:2]
-        except ValueError, err:
-            print err
-            print 'Arggg,', data
-            import pdb; pdb.set_trace()
-
-        lines = header.split('\r\n')
-        cmd = string.split(lines[0], ' ')
-        lines = map(lambda x: x.replace(': ', ':', 1), lines[1:])
-        lines = filter(lambda x: len(x) > 0, lines)
-
-        headers = [string.split(x, ':', 1) for x in lines]
-        headers = dict(map(lambda x: (x[0].lower(), x[1]), headers))
+            cmd, headers = parse_message(data)
+            missing = [h for h in REQUIRED_HEADERS.get(cmd[0], ()) if h not in headers]
+            if missing:
+                raise SSDPParseError('missing %s' % ', '.join(missing))
+            if cmd[0] == 'NOTIFY' and headers['nts'] == 'ssdp:alive' and 'location' not in headers:
+                raise SSDPParseError('missing location')
+        except SSDPParseError, err:
+            self.malformed += 1
+            self.info('dropping malformed datagram from %s:%d - %s', host, port, err)
+            return
 
         self.msg('SSDP command %s %s - from %s:%d' % (cmd[0], cmd[1], host, port))
         self.debug('with headers:', headers)
@@ -125,12 +236,16 @@ class SSDPServer(DatagramProtocol, log.Loggable):
         self.known[usn]['MANIFESTATION'] = manifestation
         self.known[usn]['SILENT'] = silent
         self.known[usn]['HOST'] = host
-        self.known[usn]['last-seen'] = time.time()
+        self.known[usn]['last-seen'] = reactor.seconds()
 
         self.msg(self.known[usn])
 
         if manifestation == 'local':
+            self.index(usn)
             self.doNotify(usn)
+        else:
+            self.known[usn]['max-age'] = parse_max_age(cache_control)
+            self.schedule_expiry(usn)
 
         if st == 'upnp:rootdevice':
             louie.send('Coherence.UPnP.SSDP.new_device', None, device_type=st, infos=self.known[usn])
@@ -143,11 +258,19 @@ class SSDPServer(DatagramProtocol, log.Loggable):
             louie.send('Coherence.UPnP.SSDP.removed_device', None, device_type=st, infos=self.known[usn])
             #self.callback("removed_device", st, self.known[usn])
 
+        self.unindex(usn)
         del self.known[usn]
 
     def isKnown(self, usn):
         return self.known.has_key(usn)
 
+    def seen(self, usn):
+        """ a discovered USN was announced again,
+            it stays valid for another max-age
+        """
+        self.known[usn]['last-seen'] = reactor.seconds()
+        self.debug('updating last-seen for %r' % usn)
+
     def notifyReceived(self, headers, (host, port)):
         """Process a presence announcement.  We just remember the
         details of the SSDP service announced."""
@@ -157,11 +280,11 @@ class SSDPServer(DatagramProtocol, log.Loggable):
 
         if headers['nts'] == 'ssdp:alive':
             try:
-                self.known[headers['usn']]['last-seen'] = time.time()
-                self.debug('updating last-seen for %r' % headers['usn'])
+                self.seen(headers['usn'])
             except KeyError:
                 self.register('remote', headers['usn'], headers['nt'], headers['location'],
-                              headers['server'], headers['cache-control'], host=host)
+                              headers.get('server', ''),
+                              headers.get('cache-control', 'max-age=1800'), host=host)
         elif headers['nts'] == 'ssdp:byebye':
             if self.isKnown(headers['usn']):
                 self.unRegister(headers['usn'])
@@ -171,46 +294,123 @@ class SSDPServer(DatagramProtocol, log.Loggable):
         louie.send('Coherence.UPnP.Log', None, 'SSDP', host, 'Notify %s for %s' % (headers['nts'], headers['usn']))
 
 
-    def send_it(self,response,destination,delay,usn):
-        self.info('send discovery response delayed by %ds for %s to %r' % (delay,usn,destination))
-        try:
-            self.transport.write(response,destination)
-        except (AttributeError,socket.error), msg:
-            self.info("failure sending out byebye notification: %r" % msg)
+    def index(self, usn):
+        """ prebuild the datagrams for a local USN
+            and add it to the ST index
+        """
+        self.unindex(usn)
+        entry = self.known[usn]
+        headers = [('CACHE-CONTROL', entry['CACHE-CONTROL']),
+                   ('EXT', entry['EXT']),
+                   ('LOCATION', entry['LOCATION']),
+                   ('SERVER', entry['SERVER'])]
+        response = ['HTTP/1.1 200 OK'] + ['%s: %s' % h for h in headers]
+        response.append('ST: %s' % entry['ST'])
+        response.append('USN: %s' % usn)
+        response.append('DATE: ')
+        def notify(nts):
+            """ the values may contain a '%', so this
+                isn't a template to be filled in later
+            """
+            notify = ['NOTIFY * HTTP/1.1',
+                      'HOST: %s:%d' % (SSDP_ADDR, SSDP_PORT),
+                      'NTS: ' + nts] + ['%s: %s' % h for h in headers]
+            notify.append('NT: %s' % entry['ST'])
+            notify.append('USN: %s' % usn)
+            notify.extend(('', ''))
+            return '\r\n'.join(notify)
+        """ the response is completed with the date when it is sent """
+        self.datagrams[usn] = ('\r\n'.join(response),
+                               notify('ssdp:alive'),
+                               notify('ssdp:byebye'))
+        self.by_st.setdefault(entry['ST'], OrderedDict())[usn] = True
+        if not entry['SILENT']:
+            self.announced[usn] = True
+
+    def unindex(self, usn):
+        if self.datagrams.pop(usn, None) is None:
+            return
+        self.announced.pop(usn, None)
+        for st, usns in self.by_st.items():
+            if usns.pop(usn, None) and not usns:
+                del self.by_st[st]
 
     def discoveryRequest(self, headers, (host, port)):
         """Process a discovery request.  The response must be sent to
         the address specified by (host, port)."""
 
-        self.info('Discovery request from (%s,%d) for %s' % (host, port, headers['st']))
-        self.info('Discovery request for %s' % headers['st'])
+        st = headers['st']
+        self.info('Discovery request from (%s,%d) for %s', host, port, st)
 
-        louie.send('Coherence.UPnP.Log', None, 'SSDP', host, 'M-Search for %s' % headers['st'])
+        louie.send('Coherence.UPnP.Log', None, 'SSDP', host, 'M-Search for %s' % st)
 
         # Do we know about this service?
-        for i in self.known.values():
-            if i['MANIFESTATION'] == 'remote':
-                continue
-            if(headers['st'] == 'ssdp:all' and
-               i['SILENT'] == True):
-                continue
-            if( i['ST'] == headers['st'] or
-                headers['st'] == 'ssdp:all'):
-                response = []
-                response.append('HTTP/1.1 200 OK')
-
-                for k, v in i.items():
-                    if k == 'USN':
-                        usn = v
-                    if k not in ('MANIFESTATION','SILENT','HOST'):
-                        response.append('%s: %s' % (k, v))
-                response.append('DATE: %s' % datetimeToString())
+        if st == 'ssdp:all':
+            usns = self.announced
+        else:
+            usns = self.by_st.get(st)
+        if not usns:
+            return
+        try:
+            mx = int(headers['mx'])
+        except (KeyError, ValueError):
+            mx = 0
+        self.queue_responses(usns.keys(), (host, port), random.randint(0, max(mx, 0)))
 
-                response.extend(('', ''))
-                delay = random.randint(0, int(headers['mx']))
+    def queue_responses(self, usns, destination, delay):
+        """ answer a discovery request after delay seconds
 
-                reactor.callLater(delay, self.send_it,
-                                '\r\n'.join(response), (host, port), delay, usn)
+            all responses to a requester go out together,
+            a repeated request before that just adds the
+            USNs not already waiting
+        """
+        pending = self.pending_responses.get(destination)
+        if pending is not None:
+            for usn in usns:
+                pending[usn] = True
+            return
+        self.pending_responses[destination] = OrderedDict.fromkeys(usns, True)
+        tick = int(math.ceil((reactor.seconds() + delay) / RESPONSE_RESOLUTION))
+        if tick not in self.response_wheel:
+            self.response_wheel[tick] = []
+            heapq.heappush(self.response_ticks, tick)
+        self.response_wheel[tick].append(destination)
+        self.schedule_responses()
+
+    def schedule_responses(self):
+        if not self.response_ticks:
+            return
+        due = self.response_ticks[0] * RESPONSE_RESOLUTION
+        if self.response_call is not None and self.response_call.active():
+            if self.response_call.getTime() <= due:
+                return
+            self.response_call.cancel()
+        self.response_call = reactor.callLater(max(0, due - reactor.seconds()), self.send_responses)
+
+    def send_responses(self):
+        self.response_call = None
+        now = reactor.seconds() / RESPONSE_RESOLUTION + 0.001
+        date = datetimeToString()
+        while self.response_ticks and self.response_ticks[0] <= now:
+            tick = heapq.heappop(self.response_ticks)
+            for destination in self.response_wheel.pop(tick):
+                usns = self.pending_responses.pop(destination, ())
+                self.send_it(usns, destination, date)
+        self.schedule_responses()
+
+    def send_it(self, usns, destination, date):
+        self.info('send discovery response for %d USNs to %r', len(usns), destination)
+        for usn in usns:
+            try:
+                response = self.datagrams[usn][0]
+            except KeyError:
+                """ unregistered in the meantime """
+                continue
+            try:
+                self.transport.write(''.join((response, date, '\r\n\r\n')), destination)
+            except (AttributeError,socket.error), msg:
+                self.info("failure sending out the discovery response: %r" % msg)
+                return
 
     def doNotify(self, usn):
         """Do notification"""
@@ -219,24 +419,15 @@ class SSDPServer(DatagramProtocol, log.Loggable):
             return
         self.info('Sending alive notification for %s' % usn)
 
-        resp = [ 'NOTIFY * HTTP/1.1',
-            'HOST: %s:%d' % (SSDP_ADDR, SSDP_PORT),
-            'NTS: ssdp:alive',
-            ]
-        stcpy = dict(self.known[usn].iteritems())
-        stcpy['NT'] = stcpy['ST']
-        del stcpy['ST']
-        del stcpy['MANIFESTATION']
-        del stcpy['SILENT']
-        del stcpy['HOST']
-        del stcpy['last-seen']
-
-        resp.extend(map(lambda x: ': '.join(x), stcpy.iteritems()))
-        resp.extend(('', ''))
-        self.debug('doNotify content', resp)
         try:
-            self.transport.write('\r\n'.join(resp), (SSDP_ADDR, SSDP_PORT))
-            self.transport.write('\r\n'.join(resp), (SSDP_ADDR, SSDP_PORT))
+            notify = self.datagrams[usn][1]
+        except KeyError:
+            self.debug("no alive notification for %r", usn)
+            return
+        self.debug('doNotify content', notify)
+        try:
+            self.transport.write(notify, (SSDP_ADDR, SSDP_PORT))
+            self.transport.write(notify, (SSDP_ADDR, SSDP_PORT))
         except (AttributeError,socket.error), msg:
             self.info("failure sending out alive notification: %r" % msg)
 
@@ -245,55 +436,75 @@ class SSDPServer(DatagramProtocol, log.Loggable):
 
         self.info('Sending byebye notification for %s' % usn)
 
-        resp = [ 'NOTIFY * HTTP/1.1',
-                'HOST: %s:%d' % (SSDP_ADDR, SSDP_PORT),
-                'NTS: ssdp:byebye',
-                ]
         try:
-            stcpy = dict(self.known[usn].iteritems())
-            stcpy['NT'] = stcpy['ST']
-            del stcpy['ST']
-            del stcpy['MANIFESTATION']
-            del stcpy['SILENT']
-            del stcpy['HOST']
-            del stcpy['last-seen']
-            resp.extend(map(lambda x: ': '.join(x), stcpy.iteritems()))
-            resp.extend(('', ''))
-            self.debug('doByebye content', resp)
-            if self.transport:
-                try:
-                    self.transport.write('\r\n'.join(resp), (SSDP_ADDR, SSDP_PORT))
-                except (AttributeError,socket.error), msg:
-                    self.info("failure sending out byebye notification: %r" % msg)
+            byebye = self.datagrams[usn][2]
         except KeyError, msg:
             self.debug("error building byebye notification: %r" % msg)
+            return
+        self.debug('doByebye content', byebye)
+        if self.transport:
+            try:
+                self.transport.write(byebye, (SSDP_ADDR, SSDP_PORT))
+            except (AttributeError,socket.error), msg:
+                self.info("failure sending out byebye notification: %r" % msg)
 
     def resendNotify( self):
         for usn in self.known:
             if self.known[usn]['MANIFESTATION'] == 'local':
                 self.doNotify(usn)
 
+    def schedule_expiry(self, usn):
+        entry = self.known[usn]
+        entry['expires'] = entry['last-seen'] + entry['max-age']
+        heapq.heappush(self.expiry_heap, (entry['expires'], usn))
+        self.schedule_check()
+
+    def schedule_check(self):
+        if not self.expiry_heap:
+            return
+        """ round up, so that what expires close
+            together is removed in one run
+        """
+        expires = self.expiry_heap[0][0]
+        due = math.ceil(expires / EXPIRY_RESOLUTION) * EXPIRY_RESOLUTION
+        if due < expires:
+            due += EXPIRY_RESOLUTION
+        if self.expiry_call is not None and self.expiry_call.active():
+            if self.expiry_call.getTime() <= due:
+                return
+            self.expiry_call.cancel()
+        self.expiry_call = reactor.callLater(max(0, due - reactor.seconds()), self.check_valid)
+
     def check_valid(self):
-        """ check if the discovered devices are still ok, or
-            if we haven't received a new discovery response
+        """ remove the discovered devices and services whose
+            announcements have expired
+
+            an entry that was seen again since it went onto
+            the heap is put back with its new expiry time,
+            one for an USN no longer known, or registered
+            anew meanwhile, is just dropped
         """
-        self.debug("Checking devices/services are still valid")
-        removable = []
-        for usn in self.known:
-            if self.known[usn]['MANIFESTATION'] != 'local':
-                _,expiry = self.known[usn]['CACHE-CONTROL'].split('=')
-                expiry = int(expiry)
-                now = time.time()
-                last_seen = self.known[usn]['last-seen']
-                self.debug("Checking if %r is still valid - last seen %d (+%d), now %d" % (self.known[usn]['USN'],last_seen,expiry,now))
-                if last_seen + expiry + 30 < now:
-                    self.debug("Expiring: %r" % self.known[usn])
-                    if self.known[usn]['ST'] == 'upnp:rootdevice':
-                        louie.send('Coherence.UPnP.SSDP.removed_device', None, device_type=self.known[usn]['ST'], infos=self.known[usn])
-                    removable.append(usn)
-        while len(removable) > 0:
-            usn = removable.pop(0)
+        self.expiry_call = None
+        now = reactor.seconds()
+        removed = []
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            expires, usn = heapq.heappop(self.expiry_heap)
+            entry = self.known.get(usn)
+            if entry is None or entry.get('expires') != expires:
+                continue
+            expires = entry['last-seen'] + entry['max-age']
+            if expires > now:
+                entry['expires'] = expires
+                heapq.heappush(self.expiry_heap, (expires, usn))
+                continue
+            self.debug("Expiring: %r" % entry)
             del self.known[usn]
+            if entry['ST'] == 'upnp:rootdevice':
+                removed.append(entry)
+        self.schedule_check()
+        if removed:
+            self.info("%d devices expired", len(removed))
+            louie.send('Coherence.UPnP.SSDP.removed_devices', None, infos=removed)
 
     def subscribe(self, name, callback):
         self._callbacks.setdefault(name,[]).append(callback)
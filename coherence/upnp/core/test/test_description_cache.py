@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{upnp.core.description_cache}
+"""
+
+from twisted.trial import unittest
+from twisted.internet import reactor, defer, task
+from twisted.web import resource, server
+
+from coherence.upnp.core import description_cache, http_pool
+
+SCPD = '''<?xml version="1.0"?>
+<scpd xmlns="urn:schemas-upnp-org:service-1-0">
+<specVersion><major>1</major><minor>0</minor></specVersion>
+<actionList>
+<action><name>GetMute</name><argumentList>
+<argument><name>InstanceID</name><direction>in</direction><relatedStateVariable>A_ARG_TYPE_InstanceID</relatedStateVariable></argument>
+<argument><name>CurrentMute</name><direction>out</direction><relatedStateVariable>Mute</relatedStateVariable></argument>
+</argumentList></action>
+</actionList>
+<serviceStateTable>
+<stateVariable sendEvents="no"><name>A_ARG_TYPE_InstanceID</name><dataType>ui4</dataType></stateVariable>
+<stateVariable sendEvents="no"><name>Mute</name><dataType>boolean</dataType></stateVariable>
+<stateVariable><name>A_ARG_TYPE_Channel</name><dataType>string</dataType>
+<allowedValueList><allowedValue>Master</allowedValue></allowedValueList></stateVariable>
+</serviceStateTable>
+</scpd>'''
+
+
+class Document(resource.Resource):
+    """ the same SCPD under every path but /gone.xml,
+        holds back its answers while on hold
+    """
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.requested = []
+        self.on_hold = []
+        self.hold = False
+
+    def render_GET(self, request):
+        self.requested.append(request.path)
+        if request.path == '/gone.xml':
+            request.setResponseCode(404)
+            return ''
+        if self.hold:
+            self.on_hold.append(request)
+            return server.NOT_DONE_YET
+        return SCPD
+
+    def release(self):
+        self.hold = False
+        for request in self.on_hold:
+            request.write(SCPD)
+            request.finish()
+        self.on_hold = []
+
+
+class TestDescriptionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.resource = Document()
+        self.port = reactor.listenTCP(0, server.Site(self.resource), interface='127.0.0.1')
+        self.pool = http_pool.HTTPConnectionPool()
+        self.patch(http_pool, '_pool', self.pool)
+        self.cache = description_cache.DescriptionCache(max_fetches=2)
+
+    def tearDown(self):
+        self.pool.close()
+        return self.port.stopListening()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d/%s' % (self.port.getHost().port, path)
+
+    def test_parse_scpd(self):
+        actions, variables = description_cache.parse_scpd(SCPD)
+        self.assertEqual(actions, (('GetMute', (('InstanceID', 'in', 'A_ARG_TYPE_InstanceID'),
+                                                ('CurrentMute', 'out', 'Mute'))),))
+        self.assertEqual(variables, (('A_ARG_TYPE_InstanceID', 'no', 'ui4', ()),
+                                     ('Mute', 'no', 'boolean', ()),
+                                     ('A_ARG_TYPE_Channel', 'yes', 'string', ('Master',))))
+
+    def test_shared(self):
+        """ the same document at two URLs is parsed once,
+            the same URL asked for twice is fetched once
+        """
+        dl = [self.cache.get_scpd(self.url('1/scpd.xml'), 'a'),
+              self.cache.get_scpd(self.url('1/scpd.xml'), 'a'),
+              self.cache.get_scpd(self.url('2/scpd.xml'), 'b')]
+        def check(results):
+            self.assertEqual(sorted(self.resource.requested), ['/1/scpd.xml', '/2/scpd.xml'])
+            for data, table in results:
+                self.assertEqual(data, SCPD)
+                self.assertTrue(table is results[0][1])
+            stats = self.cache.get_stats()
+            self.assertEqual((stats['fetched'], stats['joined'], stats['parsed'], stats['shared']),
+                             (2, 1, 1, 2))
+            """ a device announcing the same description again """
+            return self.cache.get_scpd(self.url('1/scpd.xml'), 'a')
+        def check_cached(result):
+            self.assertEqual(len(self.resource.requested), 2)
+            self.assertEqual(self.cache.get_stats()['cached'], 1)
+            """ but not a changed description """
+            return self.cache.get_scpd(self.url('1/scpd.xml'), 'c')
+        def check_changed(result):
+            self.assertEqual(len(self.resource.requested), 3)
+        d = defer.gatherResults(dl)
+        d.addCallback(check)
+        d.addCallback(check_cached)
+        d.addCallback(check_changed)
+        return d
+
+    def test_max_fetches(self):
+        self.resource.hold = True
+        dl = [self.cache.get_scpd(self.url('%d/scpd.xml' % i)) for i in range(4)]
+        def release():
+            self.assertEqual(len(self.resource.requested), 2)
+            self.resource.release()
+            return defer.gatherResults(dl)
+        def check(_):
+            self.assertEqual(len(self.resource.requested), 4)
+        return task.deferLater(reactor, 0.1, release).addCallback(check)
+
+    def test_failed(self):
+        d = self.cache.get_description(self.url('description.xml'))
+        """ an SCPD isn't a device description, but XML anyway """
+        d.addCallback(lambda result: self.assertEqual(result[1].tag,
+                                        '{urn:schemas-upnp-org:service-1-0}scpd'))
+        d.addCallback(lambda _: self.assertFailure(
+                            self.cache.get_description(self.url('gone.xml')), Exception))
+        def check(_):
+            self.assertEqual(self.cache.get_stats()['failed'], 1)
+            self.assertEqual(self.cache.fetching, {})
+        return d.addCallback(check)
+
+    def test_lru(self):
+        lru = description_cache.LRU(2)
+        lru.put('a', 1)
+        lru.put('b', 2)
+        self.assertEqual(lru.get('a'), 1)
+        lru.put('c', 3)
+        self.assertEqual(lru.keys(), ['a', 'c'])
+        lru.put('a', 4)
+        lru.put('d', 5)
+        self.assertEqual(lru.items(), [('a', 4), ('d', 5)])
+
+    def test_detection_time(self):
+        for seconds in (1.0, 3.0):
+            self.cache.detection_completed(seconds)
+        stats = self.cache.get_stats()
+        self.assertEqual((stats['detections'], stats['detection_time'], stats['max_detection_time']),
+                         (2, 2.0, 3.0))
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{upnp.core.device_registry}
+"""
+
+from twisted.trial import unittest
+
+from coherence.upnp.core.device_registry import DeviceRegistry
+
+
+class Device(object):
+
+    def __init__(self, udn, device_type, parent=None):
+        self.udn = udn
+        self.device_type = device_type
+        self.parent = parent
+        self.devices = []
+        if parent is not None:
+            parent.devices.append(self)
+
+    def get_id(self):
+        return self.udn
+
+    def get_usn(self):
+        return self.parent.get_usn()
+
+    def get_device_type(self):
+        return self.device_type
+
+    def get_friendly_device_type(self):
+        return self.device_type.split(':')[3]
+
+
+class RootDevice(Device):
+
+    def __init__(self, udn, device_type, host, manifestation='remote'):
+        Device.__init__(self, udn, device_type)
+        self.host = host
+        self.manifestation = manifestation
+
+    def get_usn(self):
+        return '%s::upnp:rootdevice' % self.udn
+
+    def get_host(self):
+        return self.host
+
+
+MEDIA_SERVER = 'urn:schemas-upnp-org:device:MediaServer:1'
+MEDIA_RENDERER = 'urn:schemas-upnp-org:device:MediaRenderer:1'
+
+
+class TestDeviceRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = DeviceRegistry()
+        self.server = RootDevice('uuid:1', MEDIA_SERVER, '192.168.1.2', 'local')
+        self.box = RootDevice('uuid:2', MEDIA_SERVER, '192.168.1.3')
+        self.renderer = Device('uuid:3', MEDIA_RENDERER, parent=self.box)
+        for device in (self.server, self.box):
+            self.registry.add(device)
+
+    def test_lookups(self):
+        self.assertEqual(self.registry.devices, [self.server, self.box])
+        self.assertTrue(self.registry.get_by_usn('uuid:2::upnp:rootdevice') is self.box)
+        self.assertTrue(self.registry.get_by_udn('uuid:1') is self.server)
+        self.assertTrue(self.registry.get_by_udn('1') is self.server)
+        self.assertTrue(self.registry.get_by_udn('3') is self.renderer)
+        self.assertEqual(self.registry.get_by_host('192.168.1.3'), [self.box])
+        self.assertEqual(self.registry.get_by_type(MEDIA_SERVER), [self.server, self.box])
+        self.assertEqual(self.registry.get_by_type('MediaRenderer'), [self.renderer])
+        self.assertEqual(self.registry.get_by_manifestation('local'), [self.server])
+        self.assertEqual(self.registry.get_by_manifestation('remote'), [self.box])
+
+    def test_add_twice(self):
+        self.registry.add(self.box)
+        self.assertEqual(len(self.registry), 2)
+        self.assertEqual(self.registry.get_by_host('192.168.1.3'), [self.box])
+        """ the same USN again, but announced by a new device object """
+        box = RootDevice('uuid:2', MEDIA_SERVER, '192.168.1.4')
+        self.registry.add(box)
+        self.assertEqual(self.registry.devices, [self.server, box])
+        self.assertEqual(self.registry.get_by_host('192.168.1.3'), [])
+        self.assertEqual(self.registry.get_by_udn('uuid:3'), None)
+
+    def test_remove(self):
+        self.registry.remove(self.box)
+        self.registry.remove(self.box)
+        self.assertEqual(self.registry.devices, [self.server])
+        self.assertFalse(self.box in self.registry)
+        for index in (self.registry.by_usn, self.registry.by_udn,
+                      self.registry.by_host, self.registry.by_manifestation):
+            self.assertEqual(len(index), 1)
+        self.assertEqual(sorted(self.registry.by_type.keys()), ['MediaServer', MEDIA_SERVER])
+        self.registry.remove(self.server)
+        for index in (self.registry.by_usn, self.registry.by_udn, self.registry.by_host,
+                      self.registry.by_type, self.registry.by_manifestation):
+            self.assertEqual(index, {})
@@ -14,6 +14,7 @@ from copy import copy
 from twisted.trial import unittest
 
 from coherence.upnp.core import DIDLLite
+from coherence.extern.et import ET
 
 didl_fragment = """
 <DIDL-Lite xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/"
@@ -86,3 +87,163 @@ class TestDIDLLite(unittest.TestCase):
         except AttributeError:
             return
         self.assert_(False,"DIDLElement didn't return None from a totally wrong UPnP class identifier")
+
+    def test_DIDLElement_fragments(self):
+        """ tests that a DIDLElement assembled from pre-serialized
+            fragments, or from a mix of fragments and items,
+            serializes the same way as one build from items only
+        """
+        items = [DIDLLite.MusicTrack('1162','103','Track'),
+                 DIDLLite.MusicAlbum('1161','103','12')]
+        items[0].res.append(DIDLLite.Resource('http://127.0.0.1/1162',
+                                              'http-get:*:audio/mpeg:*'))
+        for item in items:
+            item.date = '1997-02-28T17:20:00+01:00'
+
+        didl_element = DIDLLite.DIDLElement(parent_container='103')
+        for item in items:
+            didl_element.addItem(item)
+
+        fragment_element = DIDLLite.DIDLElement(parent_container='103')
+        args = fragment_element.get_serialization_args()
+        for item in items:
+            fragment_element.addFragment(item, item.toFragment(**args))
+        self.assertEqual(fragment_element.numItems(),2)
+        self.assertEqual(fragment_element.toString(),didl_element.toString())
+
+        mixed_element = DIDLLite.DIDLElement(parent_container='103')
+        mixed_element.addItem(items[0])
+        mixed_element.addFragment(items[1], items[1].toFragment(**args))
+        self.assertEqual(mixed_element.numItems(),2)
+        self.assertEqual(mixed_element.toString(),didl_element.toString())
+
+    def test_DIDLElement_fragments_fallback(self):
+        """ tests that items we can't serialize on their own,
+            like the ones parsed from a foreign DIDL-Lite document,
+            are still serialized like ElementTree does it
+        """
+        items = DIDLLite.DIDLElement.fromString(didl_fragment).getItems()
+        items += DIDLLite.DIDLElement.fromString(test_didl_fragment).getItems()
+        for item in items:
+            item.date = '1997-02-28T17:20:00+01:00'
+
+        didl_element = DIDLLite.DIDLElement()
+        for item in items:
+            didl_element.addItem(item)
+
+        fragment_element = DIDLLite.DIDLElement()
+        for item in items:
+            fragment_element.addFragment(item, item.toFragment())
+        self.assertEqual(fragment_element.numItems(),2)
+        self.assertEqual(fragment_element.toString(),didl_element.toString())
+
+
+class TestIterItems(unittest.TestCase):
+
+    def test_decode(self):
+        """ the streaming decoder comes up with the
+            same data as the DIDLLite objects hold
+        """
+        items = (list(DIDLLite.iter_items(didl_fragment)) +
+                 list(DIDLLite.iter_items(test_didl_fragment)))
+        self.assertEqual(items[0], {'id': '1161', 'parent_id': '103',
+                                    'child_count': '23', 'title': '12',
+                                    'upnp_class': 'object.container.album.musicAlbum',
+                                    'date': '1997-02-28T17:20:00+01:00',
+                                    'artist': u'Herby S\xe4ngermeister',
+                                    'album_art_uri': 'http://192.168.1.1:30020/776dec17-1ce1-4c87-841e-cac61a14a2e0/1161?cover.jpg'})
+        self.assertEqual(items[1]['title'], 'New Track')
+        self.assertEqual(items[1]['upnp_class'], 'object.item.audioItem.musicTrack')
+
+    def test_fields(self):
+        items = list(DIDLLite.iter_items(didl_fragment, fields=('title',)))
+        self.assertEqual(items, [{'id': '1161', 'title': '12'}])
+        self.assertEqual(DIDLLite.browse_filter(('title', 'child_count', 'resources')),
+                         '@childCount,dc:title,res')
+
+    def test_many(self):
+        tracks = []
+        for i in range(500):
+            track = DIDLLite.MusicTrack(str(i), '0', u'Track %d' % i)
+            track.res.append(DIDLLite.Resource('http://127.0.0.1/%d' % i, 'http-get:*:audio/mpeg:*'))
+            tracks.append(ET.tostring(track.toElement()))
+        items = DIDLLite.iter_items(DIDLLite.element_to_didl(''.join(tracks)))
+        for i, item in enumerate(items):
+            self.assertEqual(item['title'], u'Track %d' % i)
+            self.assertEqual(item['resources'].keys(), ['http://127.0.0.1/%d' % i])
+        self.assertEqual(i, 499)
+
+
+class TestDIDLLiteWriter(unittest.TestCase):
+    """ the direct serialization of the DIDL-Lite objects
+        has to produce exactly what ElementTree makes of
+        the elements we get from toElement()
+    """
+
+    clients = ({},
+               {'upnp_client':'XBox'},
+               {'upnp_client':'PLAYSTATION3'},
+               {'upnp_client':'Philips-TV'},
+               {'parent_container':'103'},
+               {'parent_container':'14','upnp_client':'XBox'},
+               {'requested_id':'0'},
+               {'requested_id':'1162@103'},
+               {'transcoding':True},
+               {'transcoding':True,'upnp_client':'XBox'})
+
+    def setUp(self):
+        if not DIDLLite.can_write_directly:
+            raise unittest.SkipTest("ElementTree 1.3 needed for the direct serialization")
+
+        track = DIDLLite.MusicTrack('1162','1161',u'Sängermeister & <Söhne>')
+        track.artist = u'Herby "Q" Sängermeister'
+        track.album = u'12'
+        track.genres = [u'Rock', u'Pop & Roll']
+        track.originalTrackNumber = 7
+        track.albumArtURI = 'http://127.0.0.1/1161?cover.jpg&size=1'
+        track.refID = '1170'
+        res = DIDLLite.Resource('http://127.0.0.1/1162','http-get:*:audio/mpeg:*')
+        res.size = 4711
+        res.duration = '0:03:12'
+        track.res.append(res)
+        track.res.append(DIDLLite.Resource('http://127.0.0.1/1162.wav','http-get:*:audio/x-wav:*'))
+
+        video = DIDLLite.Movie('1163','1161',u'a\nmovie')
+        video.description = u'long & short'
+        res = DIDLLite.Resource('http://127.0.0.1/1163','http-get:*:video/x-msvideo:*')
+        res.resolution = '640x480'
+        video.res.append(res)
+
+        photo = DIDLLite.Photo('1164','1161',u'')
+        photo.rating = 3
+        photo.res.append(DIDLLite.Resource('http://127.0.0.1/1164','http-get:*:image/jpeg:*'))
+
+        album = DIDLLite.MusicAlbum('1161','103',u'12')
+        album.childCount = 3
+        album.searchable = True
+        album.searchClass = ['object.item.audioItem']
+
+        folder = DIDLLite.Container('103','0',u'root')
+        folder.restricted = True
+
+        self.items = [track, video, photo, album, folder]
+        for item in self.items:
+            item.date = '1997-02-28T17:20:00+01:00'
+
+    def test_toString(self):
+        """ tests the serialization of single DIDL-Lite objects """
+        for kwargs in self.clients:
+            for item in self.items:
+                expected = ET.tostring(item.toElement(**kwargs),encoding='utf-8')
+                self.assertEqual(item.toString(**kwargs),expected)
+
+    def test_DIDLElement_toString(self):
+        """ tests the serialization of a complete DIDL-Lite document """
+        for kwargs in self.clients:
+            didl_element = DIDLLite.DIDLElement(**kwargs)
+            tree = DIDLLite.DIDLElement(**kwargs)
+            for item in self.items:
+                didl_element.addItem(item)
+                tree.append(item.toElement(**kwargs))
+            self.assertEqual(didl_element.numItems(),len(self.items))
+            self.assertEqual(didl_element.toString(),ET.tostring(tree,encoding='utf-8'))
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{upnp.core.event}
+"""
+
+from twisted.trial import unittest
+from twisted.internet import reactor, defer, task
+from twisted.web import resource, server
+
+from coherence.upnp.core import event, http_pool
+from coherence.upnp.core.utils import parse_xml
+
+NS_EVENT = 'urn:schemas-upnp-org:event-1-0'
+NS_AVT = 'urn:schemas-upnp-org:metadata-1-0/AVT/'
+
+
+def propertyset(**properties):
+    return ('<e:propertyset xmlns:e="%s">' % NS_EVENT +
+            ''.join(['<e:property><%s>%s</%s></e:property>' % (name, value, name)
+                     for name, value in sorted(properties.items())]) +
+            '</e:propertyset>')
+
+def last_change(*variables):
+    """ variables are (instance, name, value) """
+    xml = ['<Event xmlns="%s">' % NS_AVT]
+    for instance, name, value in variables:
+        xml.append('<InstanceID val="%d"><%s val="%s"/></InstanceID>' % (instance, name, value))
+    xml.append('</Event>')
+    return ''.join(xml).replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+def properties(xml):
+    found = {}
+    for prop in parse_xml(xml).getroot():
+        for var in prop:
+            if var.tag == 'LastChange':
+                for instance in parse_xml(var.text).getroot():
+                    for v in instance:
+                        found[(instance.get('val'), v.tag[v.tag.find('}') + 1:])] = v.get('val')
+            else:
+                found[var.tag] = var.text
+    return found
+
+
+class Subscriber(resource.Resource):
+    """ the event callback of a control point,
+        holds back its answers while on hold
+    """
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.received = []
+        self.on_hold = []
+        self.hold = False
+
+    def render_NOTIFY(self, request):
+        self.received.append((int(request.getHeader('seq')),
+                              request.getHeader('sid'),
+                              request.content.read()))
+        if self.hold:
+            self.on_hold.append(request)
+            return server.NOT_DONE_YET
+        return ''
+
+    def release(self):
+        self.hold = False
+        for request in self.on_hold:
+            request.finish()
+        self.on_hold = []
+
+
+class CountingSite(server.Site):
+
+    def __init__(self, *args, **kwargs):
+        server.Site.__init__(self, *args, **kwargs)
+        self.connections = 0
+
+    def buildProtocol(self, addr):
+        self.connections += 1
+        return server.Site.buildProtocol(self, addr)
+
+
+class TestNotificationQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.resource = Subscriber()
+        self.site = CountingSite(self.resource)
+        self.port = reactor.listenTCP(0, self.site, interface='127.0.0.1')
+        self.pool = http_pool.HTTPConnectionPool()
+        self.patch(http_pool, '_pool', self.pool)
+        self.subscriber = {'sid': 'uuid:subscriber', 'seq': 0,
+                           'callback': 'http://127.0.0.1:%d/events' % self.port.getHost().port}
+
+    def tearDown(self):
+        self.pool.close()
+        return self.port.stopListening()
+
+    def test_order(self):
+        """ all go out over one connection, one after the other """
+        d, queue = event.send_notification(self.subscriber, propertyset(Count=0))
+        self.assertTrue(self.subscriber['queue'] is queue)
+        queue.max_waiting = 10
+        dl = [d]
+        for i in range(1, 5):
+            dl.append(event.send_notification(self.subscriber, propertyset(Count=i))[0])
+        def check(_):
+            self.assertEqual([(seq, properties(xml)) for seq, sid, xml in self.resource.received],
+                             [(i, {'Count': str(i)}) for i in range(5)])
+            self.assertEqual(self.resource.received[0][1], 'uuid:subscriber')
+            self.assertEqual(self.site.connections, 1)
+            self.assertEqual(self.subscriber['seq'], 5)
+        return defer.gatherResults(dl).addCallback(check)
+
+    def test_coalesce(self):
+        """ a slow subscriber gets the latest values merged into one message """
+        self.resource.hold = True
+        first, queue = event.send_notification(self.subscriber, propertyset(Volume=1))
+        dl = [first]
+        for volume, mute, variables in ((2, 0, [(0, 'TransportState', 'PLAYING')]),
+                                        (3, 0, [(0, 'TransportState', 'PAUSED_PLAYBACK'),
+                                                (1, 'NumberOfTracks', '7')]),
+                                        (4, 1, [(0, 'CurrentTrack', '3')])):
+            xml = propertyset(Volume=volume, Mute=mute, LastChange=last_change(*variables))
+            dl.append(event.send_notification(self.subscriber, xml)[0])
+        self.assertEqual(len(queue.waiting), 1)
+
+        def release():
+            self.assertEqual(len(self.resource.received), 1)
+            self.resource.release()
+            return defer.gatherResults(dl)
+        def check(_):
+            self.assertEqual(len(self.resource.received), 2)
+            seq, sid, xml = self.resource.received[1]
+            self.assertEqual(seq, 1)
+            self.assertEqual(properties(xml), {'Volume': '4', 'Mute': '1',
+                                               ('0', 'TransportState'): 'PAUSED_PLAYBACK',
+                                               ('0', 'CurrentTrack'): '3',
+                                               ('1', 'NumberOfTracks'): '7'})
+        d = task.deferLater(reactor, 0.1, release)
+        return d.addCallback(check)
+
+    def test_retry_and_drop(self):
+        d = self.port.stopListening()
+        def send(_):
+            d, queue = event.send_notification(self.subscriber, propertyset(Volume=1))
+            queue.retry_delays = (0.01, 0.01)
+            self.queue = queue
+            return self.assertFailure(d, Exception)
+        def check(_):
+            self.assertEqual((self.queue.failures, self.queue.dropped), (3, 1))
+            self.assertEqual(self.subscriber['seq'], 1)
+            """ the next one gets just one try """
+            d, queue = event.send_notification(self.subscriber, propertyset(Volume=2))
+            return self.assertFailure(d, Exception)
+        def check_dropped(_):
+            self.assertEqual((self.queue.failures, self.queue.dropped), (4, 2))
+            self.port = reactor.listenTCP(0, self.site, interface='127.0.0.1')
+        d.addCallback(send)
+        d.addCallback(check)
+        d.addCallback(check_dropped)
+        return d
+
+    def test_disconnect(self):
+        self.resource.hold = True
+        d, queue = event.send_notification(self.subscriber, propertyset(Volume=1))
+        d2, _ = event.send_notification(self.subscriber, propertyset(Volume=2))
+        queue.disconnect()
+        self.assertFailure(d, defer.CancelledError)
+        self.assertFailure(d2, defer.CancelledError)
+        d3, _ = event.send_notification(self.subscriber, propertyset(Volume=3))
+        self.assertFailure(d3, defer.CancelledError)
+        def release(_):
+            self.resource.release()
+            self.assertEqual(len(self.resource.received), 1)
+        return defer.gatherResults([d, d2, d3]).addCallback(
+                    lambda _: task.deferLater(reactor, 0.05, release, None))
+
+
+class Queue(object):
+
+    def __init__(self):
+        self.failures = 0
+        self.disconnected = False
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+class TestSubscribers(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(event, 'reactor', self.clock)
+        self.subscribers = event.Subscribers()
+
+    def subscribe(self, sid, timeout):
+        s = {'sid': sid, 'seq': 0, 'callback': 'http://127.0.0.1/',
+             'timeout': timeout, 'created': self.clock.seconds()}
+        self.subscribers.add(s)
+        return s
+
+    def test_parse_timeout(self):
+        for timeout, seconds in (('Second-1800', 1800), ('second-300', 300),
+                                 ('infinite', 86400), ('Second-', 86400), (None, 86400)):
+            self.assertEqual(event.parse_subscription_timeout(timeout), seconds)
+
+    def test_expiry(self):
+        self.subscribe('uuid:1', 'Second-300')
+        self.subscribe('uuid:2', 'Second-100')
+        s = self.subscribe('uuid:3', 'Second-200')
+        s['queue'] = Queue()
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(100)
+        self.assertEqual(sorted(self.subscribers.keys()), ['uuid:1', 'uuid:3'])
+        self.subscribers.renew('uuid:1', 'Second-300')
+        self.clock.advance(100)
+        self.assertEqual(self.subscribers.keys(), ['uuid:1'])
+        self.assertTrue(s['queue'].disconnected)
+        """ the first deadline of uuid:1 has passed, the renewed one not """
+        self.clock.advance(150)
+        self.assertEqual(self.subscribers.keys(), ['uuid:1'])
+        self.clock.advance(50)
+        self.assertEqual(self.subscribers, {})
+        self.assertEqual(self.subscribers.expiry_heap, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.subscribers.get_stats(),
+                         {'active': 0, 'subscribed': 3, 'renewed': 1,
+                          'unsubscribed': 0, 'expired': 3, 'failed': 0})
+
+    def test_failures(self):
+        s = self.subscribe('uuid:1', 'Second-300')
+        s['queue'] = Queue()
+        s['queue'].failures = event.Subscribers.max_failures - 1
+        self.subscribers.delivery_failed('uuid:1')
+        self.assertEqual(self.subscribers.keys(), ['uuid:1'])
+        s['queue'].failures += 1
+        self.subscribers.delivery_failed('uuid:1')
+        self.assertEqual(self.subscribers, {})
+        self.assertTrue(s['queue'].disconnected)
+        self.subscribe('uuid:2', 'Second-300')
+        self.assertEqual(self.subscribers.remove('uuid:2')['sid'], 'uuid:2')
+        self.assertEqual(self.subscribers.remove('uuid:2'), None)
+        self.assertEqual(self.subscribers.get_stats(),
+                         {'active': 0, 'subscribed': 2, 'renewed': 0,
+                          'unsubscribed': 1, 'expired': 0, 'failed': 1})
+        self.subscribers.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{upnp.core.http_pool}
+"""
+
+from twisted.trial import unittest
+from twisted.internet import reactor, defer, task
+from twisted.internet.error import ConnectionDone
+from twisted.web import error, http, resource, server
+
+from coherence.upnp.core import http_pool
+from coherence.upnp.core.utils import getPersistentPage
+
+
+class Page(resource.Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        if request.postpath == ['chunked']:
+            """ no Content-Length, so the response is chunked """
+            request.write('first ')
+            request.write('second')
+            request.finish()
+            return server.NOT_DONE_YET
+        if request.postpath == ['drop']:
+            request.transport.loseConnection()
+            return server.NOT_DONE_YET
+        if request.postpath == ['missing']:
+            request.setResponseCode(404)
+            return 'not here'
+        return '/'.join(request.postpath)
+
+    def render_POST(self, request):
+        return request.content.read().upper()
+
+
+class Channel(http.HTTPChannel):
+
+    def connectionLost(self, reason):
+        http.HTTPChannel.connectionLost(self, reason)
+        self.factory.channels.remove(self)
+
+
+class CountingSite(server.Site):
+    """ counts the connections made to us """
+
+    protocol = Channel
+
+    def __init__(self, *args, **kwargs):
+        server.Site.__init__(self, *args, **kwargs)
+        self.connections = 0
+        self.channels = []
+
+    def buildProtocol(self, addr):
+        p = server.Site.buildProtocol(self, addr)
+        self.connections += 1
+        self.channels.append(p)
+        return p
+
+
+class TestHTTPConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.site = CountingSite(Page())
+        self.port = reactor.listenTCP(0, self.site, interface='127.0.0.1')
+        self.url = 'http://127.0.0.1:%d/' % self.port.getHost().port
+        self.pool = http_pool.HTTPConnectionPool(max_connections=2, idle_timeout=10)
+
+    def tearDown(self):
+        self.pool.close()
+        def closed():
+            if self.pool.connections or self.site.channels:
+                return task.deferLater(reactor, 0.01, closed)
+            return self.port.stopListening()
+        return closed()
+
+    def get(self, path, **kwargs):
+        d = getPersistentPage(self.url + path, pool=self.pool, **kwargs)
+        d.addCallback(lambda (page, headers): page)
+        return d
+
+    def test_keep_alive(self):
+        d = self.get('a')
+        d.addCallback(self.assertEqual, 'a')
+        d.addCallback(lambda _: self.get('b'))
+        d.addCallback(self.assertEqual, 'b')
+        d.addCallback(lambda _: self.get('c', method='POST', postdata='soap'))
+        d.addCallback(self.assertEqual, 'SOAP')
+        d.addCallback(lambda _: self.assertEqual(self.site.connections, 1))
+        return d
+
+    def test_max_connections(self):
+        d = defer.gatherResults([self.get(str(i)) for i in range(6)])
+        d.addCallback(self.assertEqual, [str(i) for i in range(6)])
+        d.addCallback(lambda _: self.assertEqual(self.site.connections, 2))
+        return d
+
+    def test_pipelining(self):
+        self.pool.max_connections = 1
+        self.pool.pipelining = 4
+        d = defer.gatherResults([self.get(str(i)) for i in range(6)] +
+                                [self.get('chunked')])
+        d.addCallback(self.assertEqual, [str(i) for i in range(6)] + ['first second'])
+        d.addCallback(lambda _: self.assertEqual(self.site.connections, 1))
+        return d
+
+    def test_idle_timeout(self):
+        self.pool.idle_timeout = 0.05
+        d = self.get('a')
+        d.addCallback(lambda _: task.deferLater(reactor, 0.2, self.get, 'b'))
+        d.addCallback(self.assertEqual, 'b')
+        d.addCallback(lambda _: self.assertEqual(self.site.connections, 2))
+        return d
+
+    def test_server_closed(self):
+        """ a connection closed by the server is replaced """
+        def drop(_):
+            for channel in self.site.channels:
+                channel.transport.loseConnection()
+            return task.deferLater(reactor, 0.05, self.get, 'b')
+        d = self.get('a')
+        d.addCallback(drop)
+        d.addCallback(self.assertEqual, 'b')
+        d.addCallback(lambda _: self.assertEqual(self.site.connections, 2))
+        return d
+
+    def test_retry(self):
+        """ a reused connection closed without an answer is tried
+            once more on a new one, a new one is not
+        """
+        d = self.get('a')
+        d.addCallback(lambda _: self.get('drop'))
+        self.assertFailure(d, ConnectionDone)
+        d.addCallback(lambda _: self.assertEqual(self.site.connections, 2))
+        return d
+
+    def test_error(self):
+        d = self.get('missing')
+        self.assertFailure(d, error.Error)
+        d.addCallback(lambda e: self.assertEqual((e.status, e.response), ('404', 'not here')))
+        d.addCallback(lambda _: self.get('a'))
+        d.addCallback(self.assertEqual, 'a')
+        d.addCallback(lambda _: self.assertEqual(self.site.connections, 1))
+        return d
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{upnp.core.search}
+"""
+
+from twisted.trial import unittest
+
+from coherence.upnp.core import DIDLLite
+from coherence.upnp.core import search
+
+
+class TestParser(unittest.TestCase):
+
+    def test_everything(self):
+        for criteria in ('', '*', '  * '):
+            self.assertTrue(isinstance(search.parse(criteria), search.Everything))
+
+    def test_precedence(self):
+        """ 'and' binds stronger than 'or' """
+        e = search.parse('dc:title = "a" or dc:title = "b" and upnp:class = "c"')
+        self.assertEqual(repr(e), '(dc:title = "a" or (dc:title = "b" and upnp:class = "c"))')
+        e = search.parse('(dc:title = "a" or dc:title = "b") AND upnp:class = "c"')
+        self.assertEqual(repr(e), '((dc:title = "a" or dc:title = "b") and upnp:class = "c")')
+
+    def test_operators(self):
+        e = search.parse('upnp:class derivedFrom "object.item" and res@size>="10" and '
+                         'dc:title doesNotContain "x" and @refID exists false')
+        self.assertEqual(repr(e), '(((upnp:class derivedfrom "object.item" and '
+                                  'res@size >= "10") and dc:title doesnotcontain "x") and '
+                                  '@refID exists false)')
+
+    def test_escaped_quotes(self):
+        e = search.parse(r'dc:title = "say \"hello\" \\ bye"')
+        self.assertEqual(e.value, r'say "hello" \ bye')
+
+    def test_invalid(self):
+        for criteria in ('dc:title', 'dc:title = a', 'dc:title = "a" and',
+                         '(dc:title = "a"', 'dc:title = "a")', 'dc:title likes "a"',
+                         'dc:title exists maybe', 'dc:title = "a" dc:title = "b"',
+                         'dc:title = "a'):
+            self.assertRaises(search.SearchCriteriaError, search.parse, criteria)
+
+
+class Objects(object):
+
+    def setUp(self):
+        track = DIDLLite.MusicTrack('1', '0', u'Love Song')
+        track.artist = u'Herby Sängermeister'
+        track.genres = [u'Rock', u'Pop']
+        track.originalTrackNumber = 7
+        res = DIDLLite.Resource('http://127.0.0.1/1', 'http-get:*:audio/mpeg:*')
+        res.size = 4711
+        track.res.append(res)
+        movie = DIDLLite.Movie('2', '0', u'a lovely movie')
+        album = DIDLLite.MusicAlbum('3', '0', u'12')
+        photo = DIDLLite.Photo('4', '0', u'holiday')
+        self.objects = [track, movie, album, photo]
+
+    def found(self, criteria):
+        expression = search.parse(criteria)
+        return [o.id for o in self.objects if expression.matches(o)]
+
+
+class TestEvaluation(Objects, unittest.TestCase):
+
+    def test_class(self):
+        self.assertEqual(self.found('upnp:class derivedfrom "object.item"'), ['1', '2', '4'])
+        self.assertEqual(self.found('upnp:class derivedfrom "object.item.audioItem"'), ['1'])
+        self.assertEqual(self.found('upnp:class derivedfrom "object.item.audio"'), [])
+        self.assertEqual(self.found('upnp:class = "object.container.album.musicAlbum"'), ['3'])
+
+    def test_strings(self):
+        self.assertEqual(self.found('dc:title contains "LOVE"'), ['1', '2'])
+        self.assertEqual(self.found('dc:title doesNotContain "love"'), ['3', '4'])
+        self.assertEqual(self.found('dc:title startsWith "a "'), ['2'])
+        self.assertEqual(self.found(u'upnp:artist = "herby sängermeister"'), ['1'])
+        self.assertEqual(self.found('upnp:genre = "pop"'), ['1'])
+        self.assertEqual(self.found('upnp:artist != "x"'), ['1'])
+
+    def test_numbers(self):
+        self.assertEqual(self.found('res@size > "1000"'), ['1'])
+        self.assertEqual(self.found('res@size < "1000"'), [])
+        self.assertEqual(self.found('upnp:originalTrackNumber <= "7"'), ['1'])
+
+    def test_exists(self):
+        self.assertEqual(self.found('upnp:artist exists true'), ['1'])
+        self.assertEqual(self.found('upnp:artist exists false'), ['2', '3', '4'])
+
+
+class TestIndexes(Objects, unittest.TestCase):
+    """ the indexes have to come up with the
+        same objects as the evaluation does
+    """
+
+    criteria = ('*',
+                'upnp:class derivedfrom "object.item"',
+                'upnp:class = "object.item.videoItem.movie"',
+                'dc:title contains "love"',
+                'dc:title contains "ly mo"',
+                'dc:title contains " "',
+                'dc:title doesNotContain "love"',
+                'dc:title startsWith "hol"',
+                'dc:title < "b"',
+                'upnp:genre = "rock" or upnp:class derivedfrom "object.container"',
+                'upnp:class derivedfrom "object.item" and dc:title contains "love"',
+                'upnp:class derivedfrom "object.item" and res@size > "1"',
+                'upnp:artist exists false and (dc:title = "12" or dc:title = "holiday")',
+                'res@size exists true or dc:title = "12"')
+
+    def setUp(self):
+        Objects.setUp(self)
+        self.by_id = dict((o.id, o) for o in self.objects)
+        self.indexes = search.SearchIndexes(('dc:title', 'upnp:class',
+                                             'upnp:artist', 'upnp:genre'))
+        for o in self.objects:
+            self.indexes.add(o.id)
+        self.indexes.update(lambda id, p: search.get_values(self.by_id[id], p))
+
+    def test_candidates(self):
+        for criteria in self.criteria:
+            expression = search.parse(criteria)
+            ids, exact = expression.candidates(self.indexes)
+            if ids is None:
+                ids = self.indexes.ids
+            found = [id for id in self.indexes.sorted(ids)
+                     if exact or expression.matches(self.by_id[id])]
+            self.assertEqual(found, self.found(criteria), criteria)
+
+    def test_exact(self):
+        """ indexed properties don't need a look at the objects """
+        for criteria in self.criteria[:11]:
+            self.assertTrue(search.parse(criteria).candidates(self.indexes)[1], criteria)
+
+    def test_remove(self):
+        self.indexes.remove('1')
+        self.assertEqual(self.indexes.lookup('dc:title', 'contains', u'love'), set(['2']))
+        self.assertEqual(self.indexes.lookup('upnp:genre', '=', u'rock'), set())
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{upnp.core.soap_lite}
+"""
+
+from twisted.trial import unittest
+from twisted.python.util import OrderedDict
+
+from coherence.upnp.core import soap_lite
+from coherence.upnp.core.soap_service import UPnPPublisher
+from coherence.upnp.core.utils import parse_xml
+
+NS = 'urn:schemas-upnp-org:service:ContentDirectory:1'
+NS_SOAP_ENV = 'http://schemas.xmlsoap.org/soap/envelope/'
+
+didl = ('<DIDL-Lite xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/">'
+        '<item id="1" parentID="0" restricted="0"><dc:title>Tom &amp; "Jerry" '
+        '&lt;live&gt;</dc:title></item></DIDL-Lite>')
+
+
+class TestSOAPLite(unittest.TestCase):
+
+    arguments = ({},
+                 {'Result': didl, 'NumberReturned': 1, 'TotalMatches': 1, 'UpdateID': 7},
+                 {'Empty': '', 'Mute': True, 'Loud': False, 'Volume': 0, 'Ratio': 0.5},
+                 {'Text': ' <>&\'" \t\r\n ]]> '},
+                 {'CurrentURI': 'http://127.0.0.1:30020/1?a=b&c=d'})
+
+    envelopes = ({},
+                 {'is_response': True, 'encoding': None},
+                 {'encoding': None},
+                 {'envelope_attrib': [('xmlns:s', NS_SOAP_ENV), ('s:encodingStyle', soap_lite.SOAP_ENCODING)]},
+                 {'is_response': True, 'envelope_attrib': [('xmlns:s', NS_SOAP_ENV)]})
+
+    def test_same_as_elementtree(self):
+        """ the templates write exactly what ElementTree did """
+        for kwargs in self.envelopes:
+            for arguments in self.arguments:
+                for method in ('{%s}Browse' % NS, 'Browse'):
+                    self.assertEqual(soap_lite.build_soap_call(method, arguments, **kwargs),
+                                     soap_lite._build_soap_call(method, arguments, **kwargs))
+
+    def test_order(self):
+        arguments = OrderedDict()
+        for name in ('InstanceID', 'CurrentURI', 'CurrentURIMetaData'):
+            arguments[name] = name
+        data = soap_lite.build_soap_call('{%s}SetAVTransportURI' % NS, arguments)
+        self.assertEqual(data, soap_lite._build_soap_call('{%s}SetAVTransportURI' % NS, arguments))
+        self.assertTrue(data.index('InstanceID') < data.index('CurrentURI') < data.index('CurrentURIMetaData'))
+
+    def test_round_trip(self):
+        """ what we write is what a client reads """
+        arguments = {'Title': u'Sängermeister & <Söhne> €',
+                     'Result': didl, 'Count': 3, 'Empty': u''}
+        data = soap_lite.build_soap_call('{%s}Browse' % NS, arguments, is_response=True)
+        body = parse_xml(data).find('{%s}Body' % NS_SOAP_ENV)
+        response = body.find('{%s}BrowseResponse' % NS)
+        found = dict((e.tag, e.text or u'') for e in response)
+        self.assertEqual(found, {'Title': arguments['Title'], 'Result': didl,
+                                 'Count': '3', 'Empty': u''})
+
+    def test_errors(self):
+        for status in (401, 402, 501, 701, 4711):
+            error = soap_lite.build_soap_error(status)
+            self.assertTrue(error is soap_lite.build_soap_error(status))
+            body = parse_xml(error).find('{%s}Body' % NS_SOAP_ENV)
+            code = body.find('.//{urn:schemas-upnp-org:control-1-0}errorCode')
+            self.assertEqual(code.text, str(status))
+        description = body.find('.//{urn:schemas-upnp-org:control-1-0}errorDescription')
+        self.assertEqual(description.text, 'without words')
+
+
+typed_request = """<?xml version="1.0"?>
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"
+            xmlns:xsi="http://www.w3.org/1999/XMLSchema-instance"
+            s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
+  <s:Header><Ignored>1</Ignored></s:Header>
+  <s:Body>
+    <u:Seek xmlns:u="urn:schemas-upnp-org:service:AVTransport:1">
+      <InstanceID xsi:type="xsd:int">0</InstanceID>
+      <Unit>REL_TIME</Unit>
+      <Speed xsi:type="xsd:float">1.5</Speed>
+      <Now xsi:type="xsd:boolean">true</Now>
+      <u:Target>0:01:00</u:Target>
+      <Nested>before<Child>inside</Child>after</Nested>
+      <Empty/>
+    </u:Seek>
+    <Ignored/>
+  </s:Body>
+</s:Envelope>"""
+
+
+class TestParseSOAPCall(unittest.TestCase):
+
+    def parse_with_elementtree(self, data):
+        """ what UPnPPublisher.render did before """
+        body = parse_xml(data).find('{http://schemas.xmlsoap.org/soap/envelope/}Body')
+        method = body.getchildren()[0]
+        ns, methodName = method.tag[1:].split('}')
+        publisher = UPnPPublisher()
+        return ns, methodName, [(child.tag, publisher.decode_result(child))
+                                for child in method.getchildren()]
+
+    def test_same_as_elementtree(self):
+        requests = [typed_request]
+        for arguments in TestSOAPLite.arguments + ({'Title': u'S\xe4ngermeister'},):
+            requests.append(soap_lite.build_soap_call('{%s}Browse' % NS, arguments))
+        for data in requests:
+            result = soap_lite.parse_soap_call(data)
+            self.assertEqual(result, self.parse_with_elementtree(data))
+            for (_, a), (_, b) in zip(result[2], self.parse_with_elementtree(data)[2]):
+                self.assertEqual(type(a), type(b))
+
+    def test_invalid(self):
+        for data in ('', '<s:Envelope', typed_request.replace('</u:Seek>', ''),
+                     '<s:Envelope xmlns:s="%s"><s:Body/></s:Envelope>' % NS_SOAP_ENV):
+            self.assertRaises(soap_lite.SOAPParseError, soap_lite.parse_soap_call, data)
+
+    def test_cache(self):
+        publisher = UPnPPublisher()
+        publisher.request_cache_size = 2
+        requests = [soap_lite.build_soap_call('{%s}GetVolume' % NS, {'InstanceID': i})
+                    for i in range(3)]
+        first = publisher.parse_request(requests[0])
+        self.assertTrue(publisher.parse_request(requests[0]) is first)
+        publisher.parse_request(requests[1])
+        publisher.parse_request(requests[2])
+        self.assertEqual(publisher._request_cache.keys(), requests[1:])
+        self.assertFalse(publisher.parse_request(requests[0]) is first)
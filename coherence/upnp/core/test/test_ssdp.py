@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{upnp.core.ssdp}
+"""
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from coherence.upnp.core import ssdp
+
+UUID = 'uuid:e1c0b6f2-0d42-4d8c-8d8a-2b1c1a5e8f00'
+LOCATION = 'http://192.168.1.2:30020/e1c0b6f2/description-1.xml'
+
+
+class Transport(object):
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, data, destination):
+        self.written.append((data, destination))
+
+
+class TestSSDPServer(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(ssdp, 'reactor', self.clock)
+        self.server = ssdp.SSDPServer(test=True)
+        self.patch(self.server, 'known', {})
+        self.server.transport = Transport()
+        self.server.register('local', '%s::upnp:rootdevice' % UUID, 'upnp:rootdevice', LOCATION)
+        self.server.register('local', UUID, UUID, LOCATION)
+        for version in (2, 1):
+            st = 'urn:schemas-upnp-org:device:MediaServer:%d' % version
+            self.server.register('local', '%s::%s' % (UUID, st), st, LOCATION,
+                                 silent=version == 1)
+        self.server.transport.written = []
+
+    def search(self, st, host='192.168.1.3', mx='3'):
+        self.server.discoveryRequest({'st': st, 'mx': mx}, (host, 1900))
+
+    def responses(self):
+        self.clock.advance(3.1)
+        return [(ssdp_headers(data), destination) for data, destination in self.server.transport.written]
+
+    def test_datagrams(self):
+        alive, byebye = self.server.datagrams[UUID][1:]
+        self.assertEqual(alive, '\r\n'.join(['NOTIFY * HTTP/1.1',
+                                            'HOST: 239.255.255.250:1900',
+                                            'NTS: ssdp:alive',
+                                            'CACHE-CONTROL: max-age=1800',
+                                            'EXT: ',
+                                            'LOCATION: %s' % LOCATION,
+                                            'SERVER: %s' % ssdp.SERVER_ID,
+                                            'NT: %s' % UUID,
+                                            'USN: %s' % UUID, '', '']))
+        self.assertEqual(byebye, alive.replace('ssdp:alive', 'ssdp:byebye'))
+
+    def test_percent_in_values(self):
+        location = 'http://192.168.1.2:30020/my%20server/description-1.xml'
+        self.server.register('local', 'uuid:percent%s', 'uuid:percent%s', location)
+        alive = self.server.datagrams['uuid:percent%s'][1]
+        self.assertTrue('\r\nLOCATION: %s\r\n' % location in alive)
+        self.assertTrue('\r\nUSN: uuid:percent%s\r\n' in alive)
+
+    def test_search_st(self):
+        self.search('urn:schemas-upnp-org:device:MediaServer:1')
+        self.search('urn:schemas-upnp-org:device:MediaRenderer:1')
+        responses = self.responses()
+        self.assertEqual(len(responses), 1)
+        headers, destination = responses[0]
+        self.assertEqual(destination, ('192.168.1.3', 1900))
+        self.assertEqual(headers['st'], 'urn:schemas-upnp-org:device:MediaServer:1')
+        self.assertEqual(headers['usn'], '%s::urn:schemas-upnp-org:device:MediaServer:1' % UUID)
+        self.assertEqual(headers['location'], LOCATION)
+        self.assertTrue(headers['date'])
+
+    def test_search_all(self):
+        """ silent USNs don't answer ssdp:all, repeated
+            requests are answered once
+        """
+        self.search('ssdp:all')
+        self.search('ssdp:all')
+        self.search('upnp:rootdevice', host='192.168.1.4')
+        responses = self.responses()
+        usns = [headers['usn'] for headers, destination in responses
+                if destination[0] == '192.168.1.3']
+        self.assertEqual(usns, ['%s::upnp:rootdevice' % UUID, UUID,
+                                '%s::urn:schemas-upnp-org:device:MediaServer:2' % UUID])
+        self.assertEqual(len(responses), 4)
+
+    def test_delay(self):
+        """ responses are sent on the next tick of the wheel """
+        self.clock.advance(ssdp.RESPONSE_RESOLUTION / 2)
+        self.search('ssdp:all', mx='0')
+        self.search(UUID, mx='0', host='192.168.1.4')
+        self.assertEqual(len(self.server.transport.written), 0)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(ssdp.RESPONSE_RESOLUTION / 2)
+        self.assertEqual(len(self.server.transport.written), 4)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_unregister(self):
+        self.search('ssdp:all')
+        self.server.unRegister(UUID)
+        self.assertFalse(UUID in self.server.datagrams)
+        self.assertEqual(len(self.responses()), 2)
+        self.search(UUID)
+        self.assertEqual(len(self.responses()), 2)
+
+
+notify = '\r\n'.join(['NOTIFY * HTTP/1.1',
+                      'HOST: 239.255.255.250:1900',
+                      'CACHE-CONTROL: max-age=1800',
+                      'LOCATION: http://192.168.1.5:49152/description.xml',
+                      'NT: upnp:rootdevice',
+                      'NTS: ssdp:alive',
+                      'SERVER: Linux/2.6 UPnP/1.0 Device/1.0',
+                      'USN: uuid:4d696e69-444c-164e-9d41-001ec92f0001::upnp:rootdevice',
+                      '', ''])
+
+
+class TestParseMessage(unittest.TestCase):
+
+    def test_notify(self):
+        cmd, headers = ssdp.parse_message(notify)
+        self.assertEqual(cmd, ['NOTIFY', '*', 'HTTP/1.1'])
+        self.assertEqual(headers['nt'], 'upnp:rootdevice')
+        self.assertEqual(headers['location'], 'http://192.168.1.5:49152/description.xml')
+        self.assertEqual(len(headers), 7)
+
+    def test_tolerant(self):
+        """ LF line ends, odd cases and spacing, folded
+            headers and a missing final empty line
+        """
+        data = notify.replace('\r\n', '\n').replace('CACHE-CONTROL: ', 'Cache-control:')
+        data = data.replace('NT: ', 'nt :   ').replace('NOTIFY', 'notify')
+        data = data.replace('SERVER: Linux/2.6', 'SERVER: Linux/2.6\n  ')
+        self.assertEqual(ssdp.parse_message(data), ssdp.parse_message(notify))
+        self.assertEqual(ssdp.parse_message(notify.rstrip()), ssdp.parse_message(notify))
+        cmd, headers = ssdp.parse_message(notify + 'a body: not a header')
+        self.assertFalse('a body' in headers)
+
+    def test_response(self):
+        cmd, headers = ssdp.parse_message('HTTP/1.1 200 OK\r\nST: ssdp:all\r\nEXT:\r\n\r\n')
+        self.assertEqual(cmd, ['HTTP/1.1', '200', 'OK'])
+        self.assertEqual(headers, {'st': 'ssdp:all', 'ext': ''})
+
+    def test_malformed(self):
+        for data in ('', '\r\n\r\n', 'NOTIFY *', 'NOTIFY * SIP/2.0\r\n\r\n',
+                     'HTTP/1.1 OK fine\r\n\r\n', '\x00\xff\x13' * 20,
+                     'NOTIFY * HTTP/1.1\r\n  folded\r\n\r\n',
+                     'NOTIFY * HTTP/1.1\r\nNT upnp:rootdevice\r\n\r\n',
+                     'NOTIFY * HTTP/1.1\r\n: value\r\n\r\n'):
+            self.assertRaises(ssdp.SSDPParseError, ssdp.parse_message, data)
+
+    def test_dropped(self):
+        self.patch(ssdp, 'reactor', task.Clock())
+        server = ssdp.SSDPServer(test=True)
+        self.patch(server, 'known', {})
+        for data in ('NOTIFY * HTTP/1.1\r\nNT upnp:rootdevice\r\n\r\n',
+                     notify.replace('USN:', 'X-USN:'),
+                     notify.replace('LOCATION:', 'X-LOCATION:'),
+                     'M-SEARCH * HTTP/1.1\r\nMX: 3\r\n\r\n'):
+            server.datagramReceived(data, ('192.168.1.5', 1900))
+        self.assertEqual((server.received, server.malformed), (4, 4))
+        self.assertEqual(server.known, {})
+        server.datagramReceived(notify.replace('\r\n', '\n'), ('192.168.1.5', 1900))
+        self.assertEqual((server.received, server.malformed), (5, 4))
+        self.assertEqual(server.known.keys(),
+                         ['uuid:4d696e69-444c-164e-9d41-001ec92f0001::upnp:rootdevice'])
+
+
+class TestExpiry(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(ssdp, 'reactor', self.clock)
+        self.server = ssdp.SSDPServer(test=True)
+        self.patch(self.server, 'known', {})
+        self.removed = []
+        self.patch(ssdp.louie, 'send', self.send)
+
+    def tearDown(self):
+        self.server.shutdown()
+
+    def send(self, signal, sender, *args, **kwargs):
+        """ louie delivers on the next reactor turn, we record right away """
+        if signal == 'Coherence.UPnP.SSDP.removed_devices':
+            self.removed.append(sorted(info['USN'] for info in kwargs['infos']))
+
+    def alive(self, uuid, max_age):
+        for nt in ('upnp:rootdevice', uuid):
+            usn = nt == uuid and uuid or '%s::%s' % (uuid, nt)
+            data = notify.replace('upnp:rootdevice', nt).replace(
+                                  'uuid:4d696e69-444c-164e-9d41-001ec92f0001::%s' % nt, usn)
+            data = data.replace('max-age=1800', 'Max-Age = %d' % max_age)
+            self.server.datagramReceived(data, ('192.168.1.5', 1900))
+
+    def test_parse_max_age(self):
+        for value, max_age in (('max-age=1800', 1800), ('max-age = 100', 100),
+                               ('no-cache="Ext", MAX-AGE="60"', 60),
+                               ('', ssdp.DEFAULT_MAX_AGE), (None, ssdp.DEFAULT_MAX_AGE),
+                               ('max-age=forever', ssdp.DEFAULT_MAX_AGE)):
+            self.assertEqual(ssdp.parse_max_age(value), max_age)
+
+    def test_expiry(self):
+        """ what expires close together is removed in one batch,
+            what was seen again stays
+        """
+        self.alive('uuid:1', 100)
+        self.alive('uuid:2', 102)
+        self.alive('uuid:3', 100)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(99)
+        self.alive('uuid:3', 100)
+        self.assertEqual(len(self.server.known), 6)
+        self.clock.advance(ssdp.EXPIRY_RESOLUTION + 1)
+        self.assertEqual(self.removed, [['uuid:1::upnp:rootdevice', 'uuid:2::upnp:rootdevice']])
+        self.assertEqual(sorted(self.server.known.keys()), ['uuid:3', 'uuid:3::upnp:rootdevice'])
+        self.clock.advance(100)
+        self.assertEqual(self.removed[1:], [['uuid:3::upnp:rootdevice']])
+        self.assertEqual(self.server.known, {})
+        self.assertEqual(self.server.expiry_heap, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_byebye(self):
+        """ an USN gone and announced again expires only once """
+        self.alive('uuid:1', 100)
+        self.server.unRegister('uuid:1')
+        self.clock.advance(50)
+        self.alive('uuid:1', 100)
+        self.clock.advance(60)
+        self.assertEqual(self.removed, [])
+        self.clock.advance(100)
+        self.assertEqual(self.removed, [['uuid:1::upnp:rootdevice']])
+        self.assertEqual(self.server.expiry_heap, [])
+
+
+def ssdp_headers(data):
+    lines = data.split('\r\n')
+    return dict((l.split(':', 1)[0].lower(), l.split(':', 1)[1].strip())
+                for l in lines[1:] if l)
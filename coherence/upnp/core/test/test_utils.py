@@ -9,8 +9,13 @@
 Test cases for L{upnp.core.utils}
 """
 
+import os
+
 from twisted.trial import unittest
+from twisted.internet import reactor
+from twisted.web import client, error, resource
 
+from coherence.upnp.core import utils
 from coherence.upnp.core.utils import *
 
 # This data is joined using CRLF pairs.
@@ -126,4 +131,152 @@ class TestUpnpUtils(unittest.TestCase):
         self.assertEqual(newData, '\r\n'.join( testChunkedDataResult))
 
 
+
+class TestStaticFile(unittest.TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(3*1024*1024 + 17)
+        self.path = self.mktemp()
+        f = open(self.path, 'wb')
+        f.write(self.data)
+        f.close()
+        root = resource.Resource()
+        root.putChild('file', StaticFile(self.path))
+        self.port = reactor.listenTCP(0, Site(root), interface='127.0.0.1')
+        self.url = 'http://127.0.0.1:%d/file' % self.port.getHost().port
+        self.sendfile = utils.sendfile
+
+    def tearDown(self):
+        utils.sendfile = self.sendfile
+        return self.port.stopListening()
+
+    def get(self, headers=None):
+        d = self.request(headers=headers)
+        d.addCallback(lambda (status, headers, body): body)
+        return d
+
+    def request(self, headers=None, method='GET'):
+        """ returns status, headers and body of the response """
+        factory = client.HTTPClientFactory(self.url, method=method, headers=headers)
+        reactor.connectTCP('127.0.0.1', self.port.getHost().port, factory)
+        def got_error(failure):
+            failure.trap(error.Error)
+            return failure.value.response
+        factory.deferred.addErrback(got_error)
+        factory.deferred.addCallback(lambda body: (factory.status, factory.response_headers, body))
+        return factory.deferred
+
+    def check_transfers(self):
+        d = self.get()
+        d.addCallback(self.assertEqual, self.data)
+        d.addCallback(lambda _: self.get(headers={'Range': 'bytes=1000-1048576'}))
+        d.addCallback(self.assertEqual, self.data[1000:1048577])
+        d.addCallback(lambda _: self.get(headers={'Range': 'bytes=-100'}))
+        d.addCallback(self.assertEqual, self.data[-100:])
+        return d
+
+    def test_sendfile(self):
+        """ tests the transfer of a file and parts of it via sendfile """
+        if utils.sendfile is None:
+            raise unittest.SkipTest("no sendfile available on this system")
+        calls = []
+        def sendfile(*args):
+            calls.append(args)
+            return self.sendfile(*args)
+        utils.sendfile = sendfile
+        d = self.check_transfers()
+        d.addCallback(lambda _: self.assertNotEqual(calls, []))
+        return d
+
+    def test_sendfile_fallback(self):
+        """ tests the fallback to read/write when sendfile
+            doesn't work for a file
+        """
+        def sendfile(*args):
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+        utils.sendfile = sendfile
+        return self.check_transfers()
+
+    def test_multiple_ranges(self):
+        """ tests a multipart/byteranges response """
+        def got_response((status, headers, body)):
+            self.assertEqual(status, '206')
+            content_type = headers['content-type'][0]
+            self.assertTrue(content_type.startswith('multipart/byteranges; boundary='))
+            boundary = content_type.split('=')[1]
+            self.assertEqual(int(headers['content-length'][0]), len(body))
+            parts = body.split('--%s' % boundary)
+            self.assertEqual(parts[0], '')
+            self.assertEqual(parts[-1], '--\r\n')
+            parts = parts[1:-1]
+            self.assertEqual(len(parts), 2)
+            for part, (first, last) in zip(parts, ((0, 9), (2000, 2999))):
+                part_headers, data = part.split('\r\n\r\n', 1)
+                self.assertTrue('Content-Range: bytes %d-%d/%d' % (first, last, len(self.data)) in part_headers)
+                self.assertEqual(data, self.data[first:last+1] + '\r\n')
+        d = self.request(headers={'Range': 'bytes=0-9,2000-2999'})
+        d.addCallback(got_response)
+        return d
+
+    def test_range_not_satisfiable(self):
+        """ tests a request with a range beyond the end of the file """
+        def got_response((status, headers, body)):
+            self.assertEqual(status, '416')
+            self.assertEqual(headers['content-range'][0], 'bytes */%d' % len(self.data))
+            self.assertEqual(body, '')
+        d = self.request(headers={'Range': 'bytes=%d-' % len(self.data)})
+        d.addCallback(got_response)
+        return d
+
+    def test_if_range(self):
+        """ tests that a Range is only honored with a
+            matching If-Range entity tag
+        """
+        def got_head((status, headers, body)):
+            etag = headers['etag'][0]
+            d = self.request(headers={'Range': 'bytes=10-19', 'If-Range': etag})
+            d.addCallback(got_matching)
+            d.addCallback(lambda _: self.request(headers={'Range': 'bytes=10-19', 'If-Range': '"outdated"'}))
+            d.addCallback(got_outdated)
+            return d
+        def got_matching((status, headers, body)):
+            self.assertEqual(status, '206')
+            self.assertEqual(headers['content-range'][0], 'bytes 10-19/%d' % len(self.data))
+            self.assertEqual(body, self.data[10:20])
+        def got_outdated((status, headers, body)):
+            self.assertEqual(status, '200')
+            self.assertEqual(body, self.data)
+        d = self.request(method='HEAD')
+        d.addCallback(got_head)
+        return d
+
+
+class TestRange(unittest.TestCase):
+
+    def test_parse_range(self):
+        """ tests the parsing of Range headers """
+        self.assertEqual(parse_range('bytes=0-499', 10000), [(0, 499)])
+        self.assertEqual(parse_range('bytes=500-', 10000), [(500, 9999)])
+        self.assertEqual(parse_range('bytes=-500', 10000), [(9500, 9999)])
+        self.assertEqual(parse_range('bytes=-20000', 10000), [(0, 9999)])
+        self.assertEqual(parse_range('bytes=9500-20000', 10000), [(9500, 9999)])
+        self.assertEqual(parse_range('bytes=0-0,-1', 10000), [(0, 0), (9999, 9999)])
+        self.assertEqual(parse_range('bytes= 500-600 , 601-999', 10000), [(500, 999)])
+        self.assertEqual(parse_range('bytes=500-700,601-999,0-10', 10000), [(0, 10), (500, 999)])
+
+    def test_parse_range_unsatisfiable(self):
+        """ tests Range headers we can't satisfy """
+        self.assertEqual(parse_range('bytes=10000-', 10000), [])
+        self.assertEqual(parse_range('bytes=-0', 10000), [])
+        self.assertEqual(parse_range('bytes=0-', 0), [])
+
+    def test_parse_range_invalid(self):
+        """ tests Range headers that are to be ignored """
+        self.assertEqual(parse_range('bytes=500-100', 10000), None)
+        self.assertEqual(parse_range('bytes=a-b', 10000), None)
+        self.assertEqual(parse_range('bytes=', 10000), None)
+        self.assertEqual(parse_range('lines=0-10', 10000), None)
+        self.assertEqual(parse_range('0-10', 10000), None)
+
+
 # $Id:$
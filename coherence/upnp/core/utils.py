@@ -4,6 +4,11 @@
 # Copyright (C) 2006 Fluendo, S.A. (www.fluendo.com).
 # Copyright 2006, Frank Scholz <coherence@beebits.net>
 
+import os
+import sys
+import time
+import errno
+import random
 from os.path import abspath
 import urlparse
 from urlparse import urlsplit
@@ -11,12 +16,14 @@ from urlparse import urlsplit
 from coherence.extern.et import parse_xml as et_parse_xml
 
 from coherence import SERVER_ID
+from coherence import log
+from coherence.upnp.core import http_pool
 
 
 from twisted.web import server, http, static
 from twisted.web import client, error
 from twisted.web import proxy, resource, server
-from twisted.internet import reactor,protocol,defer,abstract
+from twisted.internet import reactor,protocol,defer,abstract,interfaces
 from twisted.python import failure
 
 from twisted.python.util import InsensitiveDict
@@ -33,6 +40,33 @@ try:
 except ImportError:
     have_netifaces = False
 
+""" sendfile(2), to pass data from a file to a socket
+    without copying it through our process
+
+    os.sendfile is only available with Python >= 3.3,
+    on Linux we can fetch it from the libc
+"""
+sendfile = getattr(os, 'sendfile', None)
+if sendfile is None and sys.platform.startswith('linux'):
+    try:
+        import ctypes
+        import ctypes.util
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _sendfile64 = _libc.sendfile64
+        _sendfile64.argtypes = [ctypes.c_int, ctypes.c_int,
+                                ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+        _sendfile64.restype = ctypes.c_ssize_t
+
+        def sendfile(out_fd, in_fd, offset, count):
+            offset = ctypes.c_int64(offset)
+            sent = _sendfile64(out_fd, in_fd, ctypes.byref(offset), count)
+            if sent < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+            return sent
+    except (ImportError, OSError, AttributeError):
+        sendfile = None
+
 
 def means_true(value):
     if isinstance(value,basestring):
@@ -585,8 +619,14 @@ def getPage(url, contextFactory=None, *args, **kwargs):
     page (as a string) or errback with a description of the error.
 
     See HTTPClientFactory to see what extra args can be passed.
+
+    With persistent=True a plain http request is sent
+    over a keep-alive connection from the http_pool.
     """
+    persistent = kwargs.pop('persistent', False)
     scheme, host, port, path = client._parse(url)
+    if persistent and scheme == 'http':
+        return getPersistentPage(url, *args, **kwargs)
     factory = HeaderAwareHTTPClientFactory(url, *args, **kwargs)
     if scheme == 'https':
         from twisted.internet import ssl
@@ -598,6 +638,42 @@ def getPage(url, contextFactory=None, *args, **kwargs):
     return factory.deferred
 
 
+def getPersistentPage(url, method='GET', postdata=None, headers=None,
+                      agent="Coherence PageGetter", timeout=0, cookies=None,
+                      followRedirect=True, redirectLimit=20, pool=None):
+    """ like getPage, but the request is sent over a
+        keep-alive connection from an http_pool.HTTPConnectionPool
+    """
+    if pool is None:
+        pool = http_pool.get_pool()
+    scheme, host, port, path = client._parse(url)
+    if headers is not None:
+        headers = InsensitiveDict(headers)
+    else:
+        headers = InsensitiveDict()
+    headers.setdefault('User-Agent', agent)
+    if cookies:
+        headers.setdefault('Cookie', '; '.join(['%s=%s' % c for c in cookies.items()]))
+
+    def got_response(response):
+        if(followRedirect and redirectLimit > 0 and
+           response.status in (301, 302, 303, 307) and
+           method in ('GET', 'HEAD')):
+            location = response.get_header('location')
+            if location:
+                return getPersistentPage(urlparse.urljoin(url, location), method=method,
+                                         headers=headers, agent=agent, timeout=timeout,
+                                         cookies=cookies, followRedirect=followRedirect,
+                                         redirectLimit=redirectLimit - 1, pool=pool)
+        if not 200 <= response.status < 300:
+            raise error.Error(str(response.status), response.message, response.body)
+        return response.body, response.headers
+
+    d = pool.request(host, port, method, path, headers=headers, body=postdata, timeout=timeout)
+    d.addCallback(got_response)
+    return d
+
+
 def downloadPage(url, file, contextFactory=None, *args, **kwargs):
     """Download a web page to a file.
 
@@ -618,12 +694,232 @@ def downloadPage(url, file, contextFactory=None, *args, **kwargs):
     return factory.deferred
 
 
+def parse_range(range, size):
+    """ parses the value of a Range header (RFC 7233)
+        for an entity of size bytes
+
+        returns None if the header has to be ignored,
+        as it is syntactically invalid or not about bytes,
+        an empty list if none of its ranges is satisfiable
+        and otherwise a list of (first, last) byte positions
+
+        overlapping or adjacent ranges get coalesced
+    """
+    try:
+        unit, specs = range.split('=', 1)
+    except ValueError:
+        return None
+    if unit.strip().lower() != 'bytes':
+        return None
+
+    ranges = []
+    found = False
+    for spec in specs.split(','):
+        spec = spec.strip()
+        if len(spec) == 0:
+            continue
+        found = True
+        try:
+            first, last = spec.split('-', 1)
+        except ValueError:
+            return None
+        first = first.strip()
+        last = last.strip()
+        if len(first) == 0:
+            # a suffix range, the last bytes of the entity
+            if not last.isdigit():
+                return None
+            length = int(last)
+            if length > 0 and size > 0:
+                ranges.append((max(0, size - length), size - 1))
+            continue
+        if not first.isdigit():
+            return None
+        first = int(first)
+        if len(last) == 0:
+            last = size - 1
+        elif last.isdigit():
+            last = int(last)
+            if last < first:
+                return None
+        else:
+            return None
+        if first < size:
+            ranges.append((first, min(last, size - 1)))
+
+    if found == False:
+        return None
+
+    if len(ranges) > 1:
+        ordered = sorted(ranges)
+        coalesced = [ordered[0]]
+        for first, last in ordered[1:]:
+            if first <= coalesced[-1][1] + 1:
+                coalesced[-1] = (coalesced[-1][0], max(last, coalesced[-1][1]))
+            else:
+                coalesced.append((first, last))
+        if len(coalesced) < len(ranges):
+            ranges = coalesced
+    return ranges
+
+
+def if_range_matches(request, etag=None, last_modified=None):
+    """ checks the If-Range header of request against our
+        entity tag or the time of the last modification
+
+        weak entity tags never match
+    """
+    value = request.getHeader('if-range')
+    if value is None:
+        return True
+    value = value.strip()
+    if value.startswith('W/'):
+        return False
+    if value.startswith('"'):
+        return etag is not None and value == etag
+    if last_modified is None:
+        return False
+    try:
+        return http.stringToDatetime(value) == int(last_modified)
+    except (ValueError, IndexError, KeyError):
+        return False
+
+
+def prepare_range_response(request, size, content_type=None,
+                           etag=None, last_modified=None, multipart=True):
+    """ evaluates the Range and If-Range headers of request,
+        for an entity of size bytes, sets the response code
+        and the content-length/content-range/content-type headers
+        accordingly
+
+        returns the parts of the entity to send, as a list
+        of (prefix, start, end) tuples - with prefix to be sent
+        before the bytes from start up to end - and a trailer
+        to be sent after the last part
+
+        without multipart several requested ranges are
+        coalesced into one
+
+        the parts are an empty list if the request isn't satisfiable
+    """
+    range = request.getHeader('range')
+    if range is not None and if_range_matches(request, etag, last_modified):
+        ranges = parse_range(range, size)
+        if ranges == []:
+            request.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
+            request.setHeader('content-range', 'bytes */%d' % size)
+            request.setHeader('content-length', '0')
+            return [], ''
+        if ranges is not None:
+            request.setResponseCode(http.PARTIAL_CONTENT)
+            if len(ranges) > 1 and multipart == False:
+                ranges = [(min([r[0] for r in ranges]), max([r[1] for r in ranges]))]
+            if len(ranges) == 1:
+                first, last = ranges[0]
+                request.setHeader('content-range', 'bytes %d-%d/%d' % (first, last, size))
+                request.setHeader('content-length', str(last - first + 1))
+                return [('', first, last + 1)], ''
+
+            boundary = '%016x' % random.getrandbits(64)
+            request.setHeader('content-type', 'multipart/byteranges; boundary=%s' % boundary)
+            parts = []
+            length = 0
+            for first, last in ranges:
+                prefix = ['--%s' % boundary]
+                if len(parts) > 0:
+                    prefix.insert(0, '')
+                if content_type:
+                    prefix.append('Content-Type: %s' % content_type)
+                prefix.append('Content-Range: bytes %d-%d/%d' % (first, last, size))
+                prefix = '\r\n'.join(prefix + ['', ''])
+                parts.append((prefix, first, last + 1))
+                length += len(prefix) + last + 1 - first
+            trailer = '\r\n--%s--\r\n' % boundary
+            request.setHeader('content-length', str(length + len(trailer)))
+            return parts, trailer
+
+    request.setHeader('content-length', str(size))
+    return [('', 0, size)], ''
+
+
+class FileCache(object):
+    """ a small cache for the files we serve
+
+        renderers that seek send lots of small range requests,
+        often reconnecting for each of them, so we keep the stat
+        results for a moment and the file handles of finished
+        transfers for the next request of that file
+    """
+
+    def __init__(self, max_handles=16, stat_timeout=1.0):
+        self.max_handles = max_handles
+        self.stat_timeout = stat_timeout
+        self.stats = {}
+        self.handles = []   # the idle ones, oldest first
+
+    def stat(self, path):
+        now = time.time()
+        try:
+            checked, st = self.stats[path]
+            if now - checked < self.stat_timeout:
+                return st
+        except KeyError:
+            pass
+        st = os.stat(path)
+        if len(self.stats) > 256:
+            self.stats = {}
+        self.stats[path] = (now, st)
+        return st
+
+    def _key(self, st):
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def open(self, path, st):
+        """ returns an idle file handle for the file,
+            as described by the stat result st,
+            or opens a new one
+        """
+        for i, (p, key, f) in enumerate(self.handles):
+            if p == path:
+                del self.handles[i]
+                if key == self._key(st):
+                    return f
+                f.close()
+                break
+        return open(path, 'rb')
+
+    def release(self, path, st, f):
+        """ the transfer is done, keep f for the next one """
+        if f.closed:
+            return
+        self.handles.append((path, self._key(st), f))
+        while len(self.handles) > self.max_handles:
+            self.handles.pop(0)[2].close()
+
+    def forget(self, path):
+        try:
+            del self.stats[path]
+        except KeyError:
+            pass
+        for p, key, f in [h for h in self.handles if h[0] == path]:
+            self.handles.remove((p, key, f))
+            f.close()
+
+
+def make_etag(st):
+    """ a strong entity tag from a stat result """
+    return '"%x-%x-%x"' % (st.st_ino, st.st_size, int(st.st_mtime))
+
+
 class StaticFile(static.File):
     """ taken from twisted.web.static and modified
         accordingly to the patch by John-Mark Gurney
         http://resnet.uoregon.edu/~gurney_j/jmpc/dist/twisted.web.static.patch
     """
 
+    use_sendfile = True
+    file_cache = FileCache()
+
     # BEGIN patch for #266
     def __init__(self, path, defaultType="text/html", ignoredExts=(), registry=None, allowExt=0):
         static.File.__init__(self, unquote(path), defaultType=defaultType, ignoredExts=ignoredExts, registry=registry, allowExt=allowExt) # added for #
@@ -635,7 +931,10 @@ class StaticFile(static.File):
         #print "StaticFile in", request.received_headers
 
         """You know what you doing."""
-        self.restat()
+        try:
+            self.statinfo = self.file_cache.stat(self.path)
+        except OSError:
+            self.statinfo = 0
 
         if self.type is None:
             self.type, self.encoding = static.getTypeAndEncoding(self.basename(),
@@ -649,9 +948,6 @@ class StaticFile(static.File):
         if self.isdir():
             return self.redirect(request)
 
-        #for content-length
-        fsize = size = self.getFileSize()
-
         request.setHeader('accept-ranges','bytes')
 
         if self.type:
@@ -659,80 +955,190 @@ class StaticFile(static.File):
         if self.encoding:
             request.setHeader('content-encoding', self.encoding)
 
+        st = self.statinfo
         try:
-            f = self.openForReading()
+            f = self.file_cache.open(self.path, st)
         except IOError, e:
             import errno
             if e[0] == errno.EACCES:
                 return error.ForbiddenResource().render(request)
             else:
                 raise
-        if request.setLastModified(self.getmtime()) is http.CACHED:
+        def release(f):
+            self.file_cache.release(self.path, st, f)
+
+        etag = make_etag(st)
+        if(request.setLastModified(self.getmtime()) is http.CACHED or
+           request.setETag(etag) is http.CACHED):
+            release(f)
             return ''
-        trans = True
-
-        range = request.getHeader('range')
-        #print "StaticFile", range
-
-        tsize = size
-        if range is not None:
-            # This is a request for partial data...
-            bytesrange = range.split('=')
-            assert bytesrange[0] == 'bytes',\
-                   "Syntactically invalid http range header!"
-            start, end = bytesrange[1].split('-', 1)
-            if start:
-                f.seek(int(start))
-                if end:
-                    end = int(end)
-                else:
-                    end = size - 1
-            else:
-                lastbytes = int(end)
-                if size < lastbytes:
-                    lastbytes = size
-                start = size - lastbytes
-                f.seek(start)
-                fsize = lastbytes
-                end = size - 1
-            size = end + 1
-            fsize = end - int(start) + 1
-            # start is the byte offset to begin, and end is the byte offset
-            # to end..  fsize is size to send, tsize is the real size of
-            # the file, and size is the byte position to stop sending.
-
-            if fsize <= 0:
-                request.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
-                fsize = tsize
-                trans = False
-            else:
-                request.setResponseCode(http.PARTIAL_CONTENT)
-                request.setHeader('content-range',"bytes %s-%s/%s " % (
-                    str(start), str(end), str(tsize)))
-                #print "StaticFile", start, end, tsize
 
-        request.setHeader('content-length', str(fsize))
+        parts, trailer = prepare_range_response(request, self.getFileSize(),
+                                                self.type, etag, self.getmtime())
 
-        if request.method == 'HEAD' or trans == False:
-            # pretend we're a HEAD request, so content-length
-            # won't be overwritten.
+        if len(parts) == 0:
+            release(f)
+            return ''
+
+        if request.method == 'HEAD':
             #print "HEAD request"
-            request.method = 'HEAD'
+            release(f)
             return ''
 
         #print "StaticFile out", request.headers, request.code
 
         # return data
-        # size is the byte position to stop sending, not how many bytes to send
-        static.FileTransfer(f, size, request)
+        FileRangeTransfer(f, parts, request, trailer=trailer,
+                          use_sendfile=self.use_sendfile and can_sendfile(request),
+                          release=release)
         # and make sure the connection doesn't get closed
         return server.NOT_DONE_YET
 
-class BufferFile(static.File):
+
+def can_sendfile(request):
+    """ check if we can pass the response body for request
+        via sendfile directly to its socket
+
+        that needs a plain TCP connection of our own, no TLS
+        and no pipelined request still waiting for its turn
+    """
+    if sendfile is None:
+        return False
+    if getattr(request, 'queued', 0):
+        return False
+    transport = request.transport
+    if not isinstance(transport, abstract.FileDescriptor):
+        return False
+    if(interfaces.ISSLTransport.providedBy(transport) or
+       getattr(transport, 'TLS', False)):
+        return False
+    if not hasattr(transport, '_tempDataLen'):
+        return False
+    return True
+
+
+class FileRangeTransfer(object):
+    """
+    A class to represent the transfer of parts of a file over the network.
+
+    parts is a list of (prefix, start, end) tuples, prefix is
+    sent before the bytes from start up to end of the file,
+    trailer after the last part.
+
+    With use_sendfile the data is passed via sendfile from the file
+    to the socket. We are registered as a pull producer, the transport
+    calls resumeProducing when its own buffer is flushed - that's where
+    our headers and prefixes went - and whenever we ask for it via
+    startWriting once the socket is writable again.
+
+    When done, the file is passed to release or closed.
+    """
+    request = None
+
+    chunk_size = 1024*1024  # bytes per round, before giving the reactor a go
+
+    def __init__(self, file, parts, request, trailer='', use_sendfile=False, release=None):
+        self.file = file
+        self.parts = list(parts)
+        self.trailer = trailer
+        self.request = request
+        self.transport = request.transport
+        self.use_sendfile = use_sendfile
+        self.release = release
+        self.sent = 0
+        request.write('')  # the headers
+        if getattr(request, 'chunked', False):
+            self.use_sendfile = False
+        self.next_part()
+        request.registerProducer(self, 0)
+
+    def next_part(self):
+        if len(self.parts) == 0:
+            return False
+        prefix, self.position, self.end = self.parts.pop(0)
+        if prefix:
+            self.request.write(prefix)
+        if self.use_sendfile == False:
+            self.file.seek(self.position)
+        return True
+
+    def resumeProducing(self):
+        if not self.request:
+            return
+        if self.position >= self.end and not self.next_part():
+            if self.trailer:
+                self.request.write(self.trailer)
+            self.request.unregisterProducer()
+            self.request.finish()
+            self.stopProducing()
+            return
+        if self.use_sendfile == True:
+            self._sendfile()
+            return
+        data = self.file.read(min(abstract.FileDescriptor.bufferSize, self.end - self.position))
+        if data:
+            self.position += len(data)
+            self.request.write(data)
+        else:
+            """ the file got shorter meanwhile """
+            self.request.unregisterProducer()
+            self.request.finish()
+            self.stopProducing()
+
+    def _sendfile(self):
+        transport = self.transport
+        if len(transport.dataBuffer) - transport.offset > 0 or transport._tempDataLen > 0:
+            """ the headers are still on their way,
+                we'll be called again once they are out
+            """
+            return
+        try:
+            sent = sendfile(transport.fileno(), self.file.fileno(),
+                            self.position,
+                            min(self.chunk_size, self.end - self.position))
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                transport.startWriting()
+            elif self.sent == 0 and e.errno in (errno.EINVAL, errno.ENOSYS):
+                """ nothing sent so far and not supported
+                    for this file, back to read/write
+                """
+                self.use_sendfile = False
+                self.file.seek(self.position)
+                self.resumeProducing()
+            else:
+                transport.loseConnection()
+            return
+        if sent == 0:
+            """ the file got shorter meanwhile """
+            self.request.unregisterProducer()
+            self.request.finish()
+            self.stopProducing()
+            return
+        self.position += sent
+        self.sent += sent
+        self.request.sentLength += sent
+        transport.startWriting()
+
+    def pauseProducing(self):
+        pass
+
+    def stopProducing(self):
+        self.request = None
+        if self.file is not None:
+            if self.release is not None:
+                self.release(self.file)
+            else:
+                self.file.close()
+            self.file = None
+
+
+class BufferFile(static.File, log.Loggable):
     """ taken from twisted.web.static and modified
         accordingly to the patch by John-Mark Gurney
         http://resnet.uoregon.edu/~gurney_j/jmpc/dist/twisted.web.static.patch
     """
+    logCategory = 'buffer_file'
 
     def __init__(self, path, target_size=0, *args):
         static.File.__init__(self, path, *args)
@@ -765,11 +1171,9 @@ class BufferFile(static.File):
 
         #for content-length
         if (self.target_size > 0):
-            fsize = size = int(self.target_size)
+            size = int(self.target_size)
         else:
-            fsize = size = int(self.getFileSize())
-
-        #print fsize
+            size = int(self.getFileSize())
 
         if size == int(self.getFileSize()):
             request.setHeader('accept-ranges','bytes')
@@ -789,72 +1193,36 @@ class BufferFile(static.File):
                 raise
         if request.setLastModified(self.getmtime()) is http.CACHED:
             return ''
-        trans = True
-
-        range = request.getHeader('range')
-        #print "StaticFile", range
-
-        tsize = size
-        if range is not None:
-            # This is a request for partial data...
-            bytesrange = range.split('=')
-            assert bytesrange[0] == 'bytes',\
-                   "Syntactically invalid http range header!"
-            start, end = bytesrange[1].split('-', 1)
-            if start:
-                start = int(start)
-                # Are we requesting something beyond the current size of the file?
-                if (start >= self.getFileSize()):
-                    # Retry later!
-                    print bytesrange
-                    print "Requesting data beyond current scope -> postpone rendering!"
-                    self.upnp_retry = reactor.callLater(1.0, self.render, request)
-                    return server.NOT_DONE_YET
-
-                f.seek(start)
-                if end:
-                    #print ":%s" % end
-                    end = int(end)
-                else:
-                    end = size - 1
-            else:
-                lastbytes = int(end)
-                if size < lastbytes:
-                    lastbytes = size
-                start = size - lastbytes
-                f.seek(start)
-                fsize = lastbytes
-                end = size - 1
-            size = end + 1
-            fsize = end - int(start) + 1
-            # start is the byte offset to begin, and end is the byte offset
-            # to end..  fsize is size to send, tsize is the real size of
-            # the file, and size is the byte position to stop sending.
-            if fsize <= 0:
-                request.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
-                fsize = tsize
-                trans = False
-            else:
-                request.setResponseCode(http.PARTIAL_CONTENT)
-                request.setHeader('content-range',"bytes %s-%s/%s " % (
-                    str(start), str(end), str(tsize)))
-                #print "StaticFile", start, end, tsize
 
-        request.setHeader('content-length', str(fsize))
+        """ the file is still growing, so there's no validator
+            for If-Range and we send several ranges as one
+        """
+        parts, trailer = prepare_range_response(request, size, self.type,
+                                                multipart=False)
+        self.debug("range %r, parts %r", request.getHeader('range'), parts)
 
-        if request.method == 'HEAD' or trans == False:
-            # pretend we're a HEAD request, so content-length
-            # won't be overwritten.
-            request.method = 'HEAD'
+        if len(parts) == 0:
+            return ''
+
+        _, start, end = parts[0]
+        if start > 0 and start >= self.getFileSize():
+            # Are we requesting something beyond the current size of the file?
+            # Retry later!
+            self.debug("requesting %r beyond the current size, postpone rendering",
+                       request.getHeader('range'))
+            self.upnp_retry = reactor.callLater(1.0, self.render, request)
+            return server.NOT_DONE_YET
+
+        if request.method == 'HEAD':
             return ''
 
         #print "StaticFile out", request.headers, request.code
 
         # return data
-        # size is the byte position to stop sending, not how many bytes to send
-
-        BufferFileTransfer(f, size - f.tell(), request)
-		# and make sure the connection doesn't get closed
+        # end is the byte position to stop sending, not how many bytes to send
+        f.seek(start)
+        BufferFileTransfer(f, end, request)
+        # and make sure the connection doesn't get closed
         return server.NOT_DONE_YET
 
 
@@ -898,7 +1266,6 @@ class BufferFileTransfer(object):
 
 
 from datetime import datetime, tzinfo, timedelta
-import random
 
 class CET(tzinfo):
 
@@ -6,6 +6,7 @@
 
 import time
 from sets import Set
+from xml.sax.saxutils import escape
 
 from coherence.upnp.core import utils
 try:
@@ -21,6 +22,8 @@ from coherence import log
 
 import coherence.extern.louie as louie
 
+_attribute_entities = {'"': '&quot;', '\n': '&#10;'}
+
 class StateVariable(log.Loggable):
     logCategory = 'variable'
 
@@ -45,6 +48,7 @@ class StateVariable(log.Loggable):
         self.old_value = ''
         self.value = ''
         self.last_time_touched = None
+        self._last_change_fragment = None
 
         self._callbacks = []
         if isinstance( self.service, service.ServiceServer):
@@ -83,6 +87,23 @@ class StateVariable(log.Loggable):
     def set_never_evented(self, value):
         self.never_evented = utils.means_true(value)
 
+    def get_last_change_fragment(self):
+        """ the element for this variable in a LastChange event,
+            built again only when the value has changed
+        """
+        channel = None
+        if self.dependant_variable != None:
+            dependants = self.dependant_variable.get_allowed_values()
+            if dependants != None and len(dependants) > 0:
+                channel = dependants[0]
+        key = (self.value, channel)
+        if self._last_change_fragment is None or self._last_change_fragment[0] != key:
+            attributes = ' val="%s"' % escape(str(self.value), _attribute_entities)
+            if channel != None:
+                attributes = ' channel="%s"%s' % (escape(channel, _attribute_entities), attributes)
+            self._last_change_fragment = (key, '<%s%s />' % (self.name, attributes))
+        return self._last_change_fragment[1]
+
     def update(self, value):
         self.info("variable check for update", self.name, value, self.service)
         if not isinstance( self.service, service.Service):
@@ -190,6 +211,7 @@ class StateVariable(log.Loggable):
             self.updated = True
             if self.service.last_change != None:
                 self.service.last_change.updated = True
+                self.service.variable_changed(self)
         self.info("variable updated", self.name, self.value)
 
     def subscribe(self, callback):
@@ -306,10 +306,6 @@ class BasicDeviceMixin(object):
             return
 
         for service in self._services:
-            try:
-                service.check_subscribers_loop.stop()
-            except:
-                pass
             if hasattr(service,'check_moderated_loop') and service.check_moderated_loop != None:
                 try:
                     service.check_moderated_loop.stop()
@@ -127,6 +127,9 @@ class ControlPoint(log.Loggable):
     def get_device_by_host(self, host):
         return self.coherence.get_device_by_host(host)
 
+    def get_devices_by_type(self, device_type):
+        return self.coherence.get_devices_by_type(device_type)
+
     def check_device( self, device):
         if device.client == None:
             self.info("found device %s of type %s - %r" %(device.get_friendly_name(),
@@ -168,7 +168,7 @@ class MSRoot(resource.Resource, log.Loggable):
                     try:
                         from coherence.transcoder import TranscoderManager
                         manager = TranscoderManager(self.server.coherence)
-                        return manager.select(format,uri)
+                        return manager.transcode(format,uri,request.method)
                     except:
                         self.debug(traceback.format_exc())
                         request.setResponseCode(404)
@@ -62,5 +62,5 @@ class WANConnectionDeviceClient(log.Loggable):
             if self.wan_ppp_connection.service.last_time_updated == None:
                 return
         self.detection_completed = True
-        louie.send('Coherence.UPnP.EmbeddedDeviceClient.detection_completed', None,
+        louie.send('Coherence.UPnP.EmbeddedDeviceClient.detection_completed', self.device.parent,
                                self)
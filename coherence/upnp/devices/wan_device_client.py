@@ -58,7 +58,7 @@ class WANDeviceClient(log.Loggable):
 
         self.embedded_device_detection_completed = True
         if self.embedded_device_detection_completed == True and self.service_detection_completed == True:
-            louie.send('Coherence.UPnP.EmbeddedDeviceClient.detection_completed', None,
+            louie.send('Coherence.UPnP.EmbeddedDeviceClient.detection_completed', self.device.parent,
                                self)
 
     def service_notified(self, service):
@@ -72,5 +72,5 @@ class WANDeviceClient(log.Loggable):
                 return
         self.service_detection_completed = True
         if self.embedded_device_detection_completed == True and self.service_detection_completed == True:
-            louie.send('Coherence.UPnP.EmbeddedDeviceClient.detection_completed', None,
+            louie.send('Coherence.UPnP.EmbeddedDeviceClient.detection_completed', self.device.parent,
                                self)
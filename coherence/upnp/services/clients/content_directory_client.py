@@ -61,7 +61,12 @@ class ContentDirectoryClient:
                filter='*', sort_criteria='',
                starting_index=0, requested_count=0,
                process_result=True,
-               backward_compatibility=False):
+               backward_compatibility=False,
+               fields=None):
+        """ with process_result the DIDL-Lite Result is decoded
+            into a dict per object, with fields limiting its keys
+            and the Filter of the request
+        """
 
         def got_result(results):
             items = []
@@ -77,34 +82,12 @@ class ContentDirectoryClient:
             r['total_matches'] = result['TotalMatches']
             r['update_id'] = result['UpdateID']
             r['items'] = {}
-            elt = DIDLLite.DIDLElement.fromString(result['Result'])
-            for item in elt.getItems():
-                #print "process_result", item
-                i = {}
-                i['upnp_class'] = item.upnp_class
-                i['id'] =  item.id
-                i['title'] =  item.title
-                i['parent_id'] =  item.parentID
-                if hasattr(item,'childCount'):
-                    i['child_count'] =  str(item.childCount)
-                if hasattr(item,'date') and item.date:
-                    i['date'] =  item.date
-                if hasattr(item,'album') and item.album:
-                    i['album'] =  item.album
-                if hasattr(item,'artist') and item.artist:
-                    i['artist'] =  item.artist
-                if hasattr(item,'albumArtURI') and item.albumArtURI:
-                    i['album_art_uri'] = item.albumArtURI
-                if hasattr(item,'res'):
-                    resources = {}
-                    for res in item.res:
-                        url = res.data
-                        resources[url] = res.protocolInfo
-                    if len(resources):
-                        i['resources']= resources
-                r['items'][item.id] = i
+            for item in DIDLLite.iter_items(result['Result'], fields):
+                r['items'][item['id']] = item
             return r
 
+        if fields is not None and filter == '*':
+            filter = DIDLLite.browse_filter(fields)
         action = self.service.get_action('Browse')
         d = action.call( ObjectID=object_id,
                             BrowseFlag=browse_flag,
@@ -117,6 +100,46 @@ class ContentDirectoryClient:
         #    d.addCallback(got_result)
         return d
 
+    def browse_iter(self, object_id=0, page_size=100, sort_criteria='', fields=None):
+        """ browse the children of a container page by page
+
+            returns a generator of Deferreds, each one firing with
+            a list of item dicts, like browse() decodes them
+
+            the next page is requested as soon as one arrives, so
+            it is on its way while the current one is processed
+
+                for d in client.browse_iter(container_id):
+                    items = yield d   # in an inlineCallbacks function
+
+            wait for a page before asking for the next one
+        """
+        pages = {}
+
+        def fetch(index):
+            d = self.browse(object_id, filter=DIDLLite.browse_filter(fields),
+                            sort_criteria=sort_criteria,
+                            starting_index=index, requested_count=page_size,
+                            process_result=False)
+            d.addCallback(got_page, index)
+            return d
+
+        def got_page(result, index):
+            returned = int(result['NumberReturned'])
+            total = int(result['TotalMatches'])
+            index += returned
+            """ a TotalMatches of 0 means the server doesn't know """
+            if returned > 0 and (index < total or (total == 0 and returned >= page_size)):
+                pages['next'] = fetch(index)
+            return list(DIDLLite.iter_items(result['Result'], fields))
+
+        page = fetch(0)
+        while page is not None:
+            yield page
+            if not page.called:
+                raise ValueError("browse_iter: page requested before the previous one arrived")
+            page = pages.pop('next', None)
+
     def search(self, container_id, criteria, starting_index=0,
                requested_count=0):
         #print "search:", criteria
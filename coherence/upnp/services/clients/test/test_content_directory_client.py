@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{upnp.services.clients.content_directory_client}
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from coherence.extern.et import ET
+from coherence.upnp.core import DIDLLite
+from coherence.upnp.services.clients.content_directory_client import ContentDirectoryClient
+
+
+class BrowseAction(object):
+    """ answers Browse requests for a container
+        with total children, later on request
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.calls = []
+
+    def call(self, **kwargs):
+        self.calls.append(kwargs)
+        d = defer.Deferred()
+        self.calls[-1]['deferred'] = d
+        return d
+
+    def answer(self, n=-1):
+        kwargs = self.calls[n]
+        start = int(kwargs['StartingIndex'])
+        end = min(start + int(kwargs['RequestedCount']), self.total)
+        items = []
+        for i in range(start, end):
+            item = DIDLLite.MusicTrack(str(i), '0', u'Track %d' % i)
+            items.append(ET.tostring(item.toElement()))
+        kwargs['deferred'].callback({'Result': DIDLLite.element_to_didl(''.join(items)),
+                                     'NumberReturned': str(end - start),
+                                     'TotalMatches': str(self.total),
+                                     'UpdateID': '1'})
+
+
+class FakeService(object):
+
+    def __init__(self, action):
+        self.action = action
+
+    def get_type(self):
+        return 'urn:schemas-upnp-org:service:ContentDirectory:1'
+
+    def get_control_url(self):
+        return 'http://127.0.0.1/control'
+
+    def subscribe(self):
+        pass
+
+    def get_action(self, name):
+        return self.action
+
+
+class TestBrowseIter(unittest.TestCase):
+
+    def setUp(self):
+        self.action = BrowseAction(25)
+        self.client = ContentDirectoryClient(FakeService(self.action))
+
+    def test_pages(self):
+        pages = self.client.browse_iter('0', page_size=10, fields=('title',))
+        found = []
+        for d in pages:
+            self.assertEqual(len(self.action.calls), len(found) + 1)
+            self.action.answer()
+            """ the next page is requested right away """
+            if len(found) < 2:
+                self.assertEqual(len(self.action.calls), len(found) + 2)
+            d.addCallback(found.append)
+        self.assertEqual([len(page) for page in found], [10, 10, 5])
+        self.assertEqual(found[2][-1], {'id': '24', 'title': u'Track 24'})
+        self.assertEqual([c['StartingIndex'] for c in self.action.calls], ['0', '10', '20'])
+        self.assertEqual(self.action.calls[0]['Filter'], 'dc:title')
+
+    def test_page_not_arrived(self):
+        pages = self.client.browse_iter('0', page_size=10)
+        pages.next()
+        self.assertRaises(ValueError, pages.next)
+
+    def test_browse(self):
+        results = []
+        self.client.browse('0', requested_count=3).addCallback(results.append)
+        self.action.answer()
+        result = results[0]
+        self.assertEqual(result['number_returned'], '3')
+        self.assertEqual(sorted(result['items'].keys()), ['0', '1', '2'])
+        self.assertEqual(result['items']['1']['upnp_class'], 'object.item.audioItem.musicTrack')
@@ -14,6 +14,7 @@ from coherence.upnp.core import service
 class AVTransportControl(service.ServiceControl,UPnPPublisher):
 
     def __init__(self, server):
+        UPnPPublisher.__init__(self)
         self.service = server
         self.variables = server.get_variables()
         self.actions = server.get_actions()
@@ -7,6 +7,9 @@
 
 # Content Directory service
 
+import weakref
+from collections import OrderedDict
+
 from twisted.python import failure
 from twisted.web import resource
 from twisted.internet import defer
@@ -15,6 +18,7 @@ from twisted.internet import defer
 from coherence.upnp.core.soap_service import UPnPPublisher
 from coherence.upnp.core.soap_service import errorCode
 from coherence.upnp.core.DIDLLite import DIDLElement
+from coherence.upnp.core import search
 
 from coherence.upnp.core import service
 
@@ -23,11 +27,60 @@ from coherence import log
 class ContentDirectoryControl(service.ServiceControl,UPnPPublisher):
 
     def __init__(self, server):
+        UPnPPublisher.__init__(self)
         self.service = server
         self.variables = server.get_variables()
         self.actions = server.get_actions()
 
 
+class DIDLFragmentCache(object):
+    """ keeps the serialized DIDL-Lite form of the objects
+        we've sent out in a Browse or Search response
+
+        an entry is keyed by the object id and the arguments
+        that influence its serialization - the requesting client
+        and the requested_id/parent_container rewrite -
+        and is only valid as long as the backend still returns
+        the very same DIDL-Lite object and neither the item's
+        nor the store's update_id changed
+
+        the object itself is only weakly referenced, backends
+        creating their objects on demand can drop them without
+        us keeping them alive
+
+        when full, the entry used least recently is dropped
+    """
+
+    def __init__(self, max_entries=50000):
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_fragment(self, didl, obj, token):
+        args = didl.get_serialization_args()
+        key = (obj.id, args['upnp_client'], args['requested_id'],
+               args['parent_container'], args['transcoding'])
+        try:
+            entry = self._cache.pop(key)
+            cached_obj, cached_token, fragment = entry
+            if cached_obj() is obj and cached_token == token:
+                self.hits += 1
+                self._cache[key] = entry
+                return fragment
+        except KeyError:
+            pass
+        self.misses += 1
+        fragment = obj.toFragment(**args)
+        if len(self._cache) >= self.max_entries:
+            self._cache.popitem(last=False)
+        self._cache[key] = (weakref.ref(obj), token, fragment)
+        return fragment
+
+    def clear(self):
+        self._cache = OrderedDict()
+
+
 class ContentDirectoryServer(service.ServiceServer, resource.Resource,
                              log.Loggable):
     logCategory = 'content_directory_server'
@@ -46,6 +99,24 @@ class ContentDirectoryServer(service.ServiceServer, resource.Resource,
 
         self.set_variable(0, 'SystemUpdateID', 0)
         self.set_variable(0, 'ContainerUpdateIDs', '')
+        if getattr(self.backend, 'search_indexes', None) is not None:
+            self.set_variable(0, 'SearchCapabilities', ','.join(search.SEARCH_CAPABILITIES))
+
+        self.didl_cache = DIDLFragmentCache()
+
+    def add_to_didl(self, didl, backend_item, obj):
+        """ add obj, the DIDL-Lite object we got from
+            backend_item.get_item(), to the response
+
+            use the pre-serialized form if our backend
+            allows us to cache it
+        """
+        if getattr(self.backend, 'cache_didl_fragments', False) == False:
+            didl.addItem(obj)
+            return
+        token = (getattr(backend_item, 'update_id', None),
+                 getattr(self.backend, 'update_id', None))
+        didl.addFragment(obj, self.didl_cache.get_fragment(didl, obj, token))
 
     def listchilds(self, uri):
         cl = ''
@@ -100,13 +171,14 @@ class ContentDirectoryServer(service.ServiceServer, resource.Resource,
             def process_items(result, tm):
                 if result == None:
                     result = []
-                for i in result:
+                for backend_item, i in zip(children, result):
                     if i[0] == True:
-                        didl.addItem(i[1])
+                        self.add_to_didl(didl, backend_item, i[1])
 
                 return build_response(tm)
 
-            for i in result:
+            children = list(result)
+            for i in children:
                 d = defer.maybeDeferred( i.get_item)
                 l.append(d)
 
@@ -176,11 +248,23 @@ class ContentDirectoryServer(service.ServiceServer, resource.Resource,
                 else:
                     return proceed(item)
 
+        try:
+            expression = search.parse(SearchCriteria)
+        except search.SearchCriteriaError, msg:
+            self.info("invalid SearchCriteria %r: %s" % (SearchCriteria, msg))
+            return failure.Failure(errorCode(708))
 
         item = self.backend.get_by_id(root_id)
         if item == None:
             return failure.Failure(errorCode(701))
 
+        if(getattr(self.backend, 'search_indexes', None) is not None and
+           not isinstance(item,defer.Deferred)):
+            result = self.backend.search(item, expression, StartingIndex, RequestedCount)
+            if result is not None:
+                items, total = result
+                return process_result(items,total=total)
+
         if isinstance(item,defer.Deferred):
             item.addCallback(proceed)
             return item
@@ -233,13 +317,14 @@ class ContentDirectoryServer(service.ServiceServer, resource.Resource,
                 def process_items(result, tm):
                     if result == None:
                         result = []
-                    for i in result:
+                    for backend_item, i in zip(children, result):
                         if i[0] == True:
-                            didl.addItem(i[1])
+                            self.add_to_didl(didl, backend_item, i[1])
 
                     return build_response(tm)
 
-                for i in result:
+                children = list(result)
+                for i in children:
                     d = defer.maybeDeferred( i.get_item)
                     l.append(d)
 
@@ -260,7 +345,7 @@ class ContentDirectoryServer(service.ServiceServer, resource.Resource,
                 dl.addCallback(process_items, total)
                 return dl
             else:
-                didl.addItem(result)
+                self.add_to_didl(didl, found_item, result)
                 total = 1
 
             return build_response(total)
@@ -16,6 +16,7 @@ from coherence import log
 class DimmingControl(service.ServiceControl,UPnPPublisher):
 
     def __init__(self, server):
+        UPnPPublisher.__init__(self)
         self.service = server
         self.variables = server.get_variables()
         self.actions = server.get_actions()
@@ -31,6 +31,7 @@ class FakeMediaReceiverRegistrarBackend:
 class MediaReceiverRegistrarControl(service.ServiceControl,UPnPPublisher):
 
     def __init__(self, server):
+        UPnPPublisher.__init__(self)
         self.service = server
         self.variables = server.get_variables()
         self.actions = server.get_actions()
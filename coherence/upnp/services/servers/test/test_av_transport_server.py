@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for the LastChange events of L{upnp.services.servers.av_transport_server}
+and L{upnp.services.servers.rendering_control_server}
+"""
+
+from twisted.trial import unittest
+
+from coherence.upnp.core.utils import parse_xml
+from coherence.upnp.services.servers.av_transport_server import AVTransportServer
+from coherence.upnp.services.servers.rendering_control_server import RenderingControlServer
+
+
+class DummyBackend(object):
+    """ has every action a service asks for """
+
+    def __getattr__(self, name):
+        if name.startswith('upnp_'):
+            return lambda *args, **kwargs: {}
+        raise AttributeError(name)
+
+
+class DummyDevice(object):
+
+    version = 2
+    backend = DummyBackend()
+
+    class coherence(object):
+        config = {}
+
+
+def last_change(xml):
+    """ {(instance, variable): (value, channel)} of a LastChange event """
+    found = {}
+    for instance in parse_xml(xml).getroot():
+        for v in instance:
+            found[(instance.get('val'), v.tag[v.tag.find('}') + 1:])] = (v.get('val'), v.get('channel'))
+    return found
+
+
+class TestLastChange(unittest.TestCase):
+
+    def setUp(self):
+        self.server = AVTransportServer(DummyDevice())
+        self.server.check_moderated_loop.stop()
+        self.server.create_new_instance(1)
+
+    def test_changed(self):
+        self.assertEqual(self.server.build_last_change_event(), None)
+        self.server.set_variable(0, 'TransportState', 'PLAYING')
+        self.server.set_variable(1, 'CurrentTrackURI', 'http://127.0.0.1/1?a=b&c="d"')
+        self.server.set_variable(0, 'TransportState', 'STOPPED')
+        """ never evented """
+        self.server.set_variable(0, 'RelativeTimePosition', '00:00:01')
+        self.assertEqual(last_change(self.server.build_last_change_event()),
+                         {('0', 'TransportState'): ('STOPPED', None),
+                          ('1', 'CurrentTrackURI'): ('http://127.0.0.1/1?a=b&c="d"', None)})
+        self.assertFalse(self.server.get_variable('TransportState').updated)
+        self.assertEqual(self.server.build_last_change_event(), None)
+
+    def test_forced(self):
+        """ a new subscriber gets everything, the others
+            still get what changed
+        """
+        self.server.set_variable(1, 'NumberOfTracks', 3)
+        everything = last_change(self.server.build_last_change_event(force=True))
+        self.assertEqual(everything[('1', 'NumberOfTracks')], ('3', None))
+        self.assertEqual(everything[('0', 'TransportState')], ('NO_MEDIA_PRESENT', None))
+        self.assertEqual(len(everything), 2 * len([k for k in everything if k[0] == '0']))
+        self.assertEqual(last_change(self.server.build_last_change_event()),
+                         {('1', 'NumberOfTracks'): ('3', None)})
+
+    def test_removed_instance(self):
+        self.server.set_variable(1, 'NumberOfTracks', 3)
+        self.server.remove_instance(1)
+        self.assertEqual(self.server.build_last_change_event(), None)
+
+    def test_channel(self):
+        server = RenderingControlServer(DummyDevice())
+        server.check_moderated_loop.stop()
+        server.set_variable(0, 'Volume', 20)
+        server.set_variable(0, 'Mute', True)
+        self.assertEqual(last_change(server.build_last_change_event()),
+                         {('0', 'Volume'): ('20', 'Master'),
+                          ('0', 'Mute'): ('1', 'Master')})
+
+    def test_moderation_interval(self):
+        self.assertEqual(self.server.check_moderated_loop.interval, 0.5)
+        device = DummyDevice()
+        device.coherence = DummyDevice.coherence()
+        device.coherence.config = {'event_moderation_interval': '2'}
+        server = AVTransportServer(device)
+        server.check_moderated_loop.stop()
+        self.assertEqual(server.check_moderated_loop.interval, 2.0)
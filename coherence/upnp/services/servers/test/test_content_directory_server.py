@@ -10,10 +10,11 @@ Test cases for L{upnp.services.servers.content_directory_server}
 """
 
 import os
+import re
 
 from twisted.trial import unittest
-from twisted.internet import reactor
-from twisted.internet.defer import Deferred
+from twisted.internet import reactor, task
+from twisted.internet.defer import Deferred, succeed, inlineCallbacks
 
 from twisted.python.filepath import FilePath
 
@@ -22,6 +23,10 @@ from coherence.base import Coherence
 from coherence.upnp.core.uuid import UUID
 from coherence.upnp.devices.control_point import DeviceQuery
 from coherence.upnp.core import DIDLLite
+from coherence.upnp.core import event
+from coherence.upnp.services.servers.content_directory_server import (ContentDirectoryServer,
+        DIDLFragmentCache)
+from coherence.backends.fs_storage import FSStore
 
 import coherence.extern.louie as louie
 
@@ -244,3 +249,191 @@ class TestContentDirectoryServer(unittest.TestCase):
 
         self.coherence.ctrl.add_query(DeviceQuery('uuid', str(self.uuid), the_result, timeout=10, oneshot=True))
         return d
+
+
+class DummyDevice(object):
+
+    version = 2
+
+    class coherence(object):
+        config = {}
+
+
+class TestContainerUpdateIDs(unittest.TestCase):
+    """ a burst of changes in a folder, like the inotify events
+        we get when an album is copied into it, has to end up
+        as a few ContainerUpdateIDs events, not one per file
+    """
+
+    files = 500
+
+    def setUp(self):
+        self.tmp_content = FilePath('tmp_content_coherence-%d'%os.getpid())
+        self.album = self.tmp_content.child('content').child('album')
+        self.album.makedirs()
+        self.device = DummyDevice()
+        self.store = FSStore(self.device, name='MediaServer-%d'%os.getpid(),
+                             content=self.album.parent().path, enable_inotify='no',
+                             urlbase='http://127.0.0.1/')
+        self.server = ContentDirectoryServer(self.device, backend=self.store)
+        self.device.content_directory_server = self.server
+
+        self.notifications = []
+        def send_notification(s, xml):
+            self.notifications.append(xml)
+            return succeed(None), None
+        self.patch(event, 'send_notification', send_notification)
+        self.server._subscribers['uuid:test'] = {'sid':'uuid:test', 'seq':0,
+                                                 'callback':'http://127.0.0.1/',
+                                                 'timeout':'Second-1800',
+                                                 'created':0}
+
+    def tearDown(self):
+        self.server.check_moderated_loop.stop()
+        self.server._subscribers.stop()
+        self.tmp_content.remove()
+
+    @inlineCallbacks
+    def test_burst(self):
+        """ adds the files one per reactor iteration,
+            as the inotify callbacks would do
+        """
+        yield task.deferLater(reactor, 0.6, lambda: None)
+        album = self.store.get_by_id(self.store.get_id_by_name('1000', self.album.path))
+        variable = self.server.get_variable('ContainerUpdateIDs')
+        updates = []
+        variable.subscribe(updates.append)
+        del updates[:]
+        self.notifications = []
+        for i in range(self.files):
+            path = self.album.child('track-%d.mp3' % i)
+            path.touch()
+            yield task.deferLater(reactor, 0, self.store.append, path.path, album)
+        yield task.deferLater(reactor, 1.1, lambda: None)
+
+        self.assertEqual(album.get_child_count(), self.files)
+        self.assertTrue(0 < len(updates) <= 4,
+                        "%d variable updates for %d files" % (len(updates), self.files))
+        self.assertTrue(0 < len(self.notifications) <= 4,
+                        "%d notifications for %d files" % (len(self.notifications), self.files))
+        self.assertEqual(variable.value, '%s,%d' % (album.get_id(), album.get_update_id()))
+        self.assertTrue(variable.value in self.notifications[-1])
+
+
+class TestSearch(unittest.TestCase):
+    """ searches an FSStore with the SearchCriteria
+        clients like the PS3 and WMP send
+    """
+
+    def setUp(self):
+        self.tmp_content = FilePath('tmp_content_coherence-%d'%os.getpid())
+        f = self.tmp_content.child('content')
+        album = f.child('audio').child('album-1')
+        album.makedirs()
+        for name in ('01 - Love Song.mp3', '02 - Lovely Day.mp3', '03 - Rain.mp3'):
+            album.child(name).touch()
+        f.child('video').makedirs()
+        f.child('video').child('Love Actually.avi').touch()
+        f.child('images').makedirs()
+        f.child('images').child('lovebirds.jpg').touch()
+        self.device = DummyDevice()
+        self.store = FSStore(self.device, name='MediaServer-%d'%os.getpid(),
+                             content=f.path, enable_inotify='no',
+                             urlbase='http://127.0.0.1/')
+        self.server = ContentDirectoryServer(self.device, backend=self.store)
+        self.device.content_directory_server = self.server
+        self.album = album
+        return task.deferLater(reactor, 0.2, lambda: None)
+
+    def tearDown(self):
+        self.server.check_moderated_loop.stop()
+        self.server._subscribers.stop()
+        self.tmp_content.remove()
+
+    def search(self, criteria, container_id='0', start=0, count=0):
+        d = self.server.upnp_Search(ContainerID=container_id, Filter='*',
+                                    StartingIndex=start, RequestedCount=count,
+                                    SortCriteria='', SearchCriteria=criteria)
+        def got_result(r):
+            # depending on the ElementTree version the namespace
+            # declarations of the DIDL-Lite root element may be
+            # duplicated, so we don't parse it here
+            titles = re.findall('<dc:title>([^<]*)</dc:title>', r['Result'])
+            self.assertEqual(len(titles), r['NumberReturned'])
+            return int(r['TotalMatches']), titles
+        d.addCallback(got_result)
+        return d
+
+    @inlineCallbacks
+    def test_class(self):
+        total, titles = yield self.search('upnp:class derivedfrom "object.item.audioItem"')
+        self.assertEqual(total, 3)
+        self.assertEqual(sorted(titles), ['01 - Love Song.mp3', '02 - Lovely Day.mp3', '03 - Rain.mp3'])
+        total, titles = yield self.search('upnp:class derivedfrom "object.container"')
+        self.assertEqual(total, 4)
+
+    @inlineCallbacks
+    def test_title(self):
+        total, titles = yield self.search('dc:title contains "love" and '
+                                          '(upnp:class derivedfrom "object.item.audioItem" or '
+                                          'upnp:class derivedfrom "object.item.videoItem")')
+        self.assertEqual(sorted(titles), ['01 - Love Song.mp3', '02 - Lovely Day.mp3',
+                                          'Love Actually.avi'])
+        self.assertEqual(self.server.get_variable('SearchCapabilities').value.split(',')[3],
+                         'dc:title')
+
+    @inlineCallbacks
+    def test_container_and_paging(self):
+        album_id = self.store.get_id_by_name(self.store.get_id_by_name('1000',
+                                                self.album.parent().path), self.album.path)
+        total, titles = yield self.search('*', album_id, 1, 1)
+        self.assertEqual(total, 3)
+        self.assertEqual(len(titles), 1)
+        total, titles = yield self.search('dc:title contains "love"', album_id)
+        self.assertEqual(total, 2)
+
+    @inlineCallbacks
+    def test_changes(self):
+        """ the indexes follow additions and removals """
+        total, titles = yield self.search('dc:title contains "rain"')
+        self.assertEqual(total, 1)
+        path = self.album.child('04 - More Rain.mp3')
+        path.touch()
+        album = self.store.get_by_id(self.store.get_id_by_name('1000', self.album.parent().path))
+        album = self.store.get_by_id(self.store.get_id_by_name(album.get_id(), self.album.path))
+        self.store.append(path.path, album)
+        total, titles = yield self.search('dc:title contains "rain"')
+        self.assertEqual(total, 2)
+        self.store.remove(self.store.get_id_by_name(album.get_id(), path.path))
+        total, titles = yield self.search('dc:title contains "rain"')
+        self.assertEqual(total, 1)
+
+    def test_invalid(self):
+        result = self.server.upnp_Search(ContainerID='0', Filter='*',
+                                         StartingIndex=0, RequestedCount=0,
+                                         SortCriteria='', SearchCriteria='dc:title = love')
+        self.assertEqual(result.value.status, 708)
+
+
+class TestDIDLFragmentCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = DIDLFragmentCache(max_entries=2)
+        self.didl = DIDLLite.DIDLElement()
+        self.items = [DIDLLite.Item(str(i), '0', 'item %d' % i) for i in range(3)]
+
+    def test_least_recently_used_goes(self):
+        for item in self.items[:2]:
+            self.cache.get_fragment(self.didl, item, 0)
+        """ 0 is used again, so 1 is the one to go """
+        self.cache.get_fragment(self.didl, self.items[0], 0)
+        self.cache.get_fragment(self.didl, self.items[2], 0)
+        self.assertEqual([key[0] for key in self.cache._cache.keys()], ['0', '2'])
+        self.cache.get_fragment(self.didl, self.items[0], 0)
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 3))
+
+    def test_changed_token(self):
+        self.cache.get_fragment(self.didl, self.items[0], 0)
+        self.cache.get_fragment(self.didl, self.items[0], 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+        self.assertEqual(len(self.cache._cache), 1)
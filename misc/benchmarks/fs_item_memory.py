@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+# fs_item_memory.py
+#
+# measures the memory an FSStore needs per item,
+# right after the content folder is walked and after
+# the DIDL-Lite objects of all items were requested once,
+# like a client browsing through the whole collection does
+#
+# usage: fs_item_memory.py [number of files]
+#
+
+import os
+import gc
+import sys
+import time
+import shutil
+import tempfile
+
+from twisted.internet import reactor
+
+import coherence.extern.louie as louie
+from coherence.backends.fs_storage import FSStore
+
+
+class DummyCoherence(object):
+    config = {}
+    hostname = '127.0.0.1'
+
+class DummyServer(object):
+    coherence = DummyCoherence()
+
+
+def rss():
+    """ the resident set size of our process in bytes """
+    pages = int(open('/proc/self/statm').read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def create_content(path, files, per_folder=100):
+    for i in range(files):
+        folder = os.path.join(path, 'album %04d' % (i / per_folder))
+        if i % per_folder == 0:
+            os.mkdir(folder)
+        open(os.path.join(folder, '%02d - track.mp3' % (i % per_folder)), 'w').close()
+
+
+def run(path, files):
+    gc.collect()
+    start = rss()
+    t = time.time()
+    store = FSStore(DummyServer(), name='benchmark', content=path,
+                    urlbase='http://127.0.0.1:30020/benchmark/',
+                    enable_inotify='no')
+
+    def walked(finished, **kwargs):
+        if finished:
+            reactor.stop()
+    louie.connect(walked, 'Coherence.UPnP.Backend.walk_progress', louie.Any)
+    reactor.run()
+    duration = time.time() - t
+
+    items = len(store.store)
+    gc.collect()
+    walked_rss = rss()
+    print "%d items, walked in %.2fs" % (items, duration)
+    print "after the walk:             %6.0f bytes per item" % (
+            float(walked_rss - start) / items)
+
+    for item in store.store.values():
+        item.get_item()
+    gc.collect()
+    print "after get_item() on all:    %6.0f bytes per item" % (
+            float(rss() - start) / items)
+    return store
+
+
+if __name__ == '__main__':
+    files = 20000
+    if len(sys.argv) > 1:
+        files = int(sys.argv[1])
+
+    path = tempfile.mkdtemp()
+    try:
+        create_content(path, files)
+        run(path, files)
+    finally:
+        shutil.rmtree(path)
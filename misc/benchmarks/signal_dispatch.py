@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+# signal_dispatch.py
+#
+# sends signals as fast as possible through the louie dispatcher
+# as it was before, one list of receivers per signal and a
+# callLater for each send, and through the SignalDispatcher,
+# and reports the signals per second each of them delivers
+#
+# a send with no receiver, like most Coherence.UPnP.Log ones,
+# a send with one receiver for any sender, like the one for
+# every SSDP datagram, and a send for one of many devices,
+# which all have their receivers connected for their own sends
+#
+# usage: signal_dispatch.py [devices]
+#
+
+import sys
+import time
+
+from twisted.internet import reactor
+
+from coherence.dispatcher import Dispatcher, SignalDispatcher
+
+
+class ListDispatcher(Dispatcher):
+    """ the dispatcher behind extern.louie before,
+        it knows nothing about senders, so receivers
+        filter the signals themselves
+    """
+
+    def connect(self, signal, callback, sender=None, weak=True):
+        if not signal in self.receivers:
+            self.receivers[signal] = []
+        return Dispatcher.connect(self, signal, callback)
+
+    def send(self, signal, sender=None, *args, **kwargs):
+        return self.save_emit(signal, *args, **kwargs)
+
+    def _get_receivers(self, signal):
+        try:
+            return self.receivers[signal]
+        except KeyError:
+            return []
+
+
+class Device(object):
+
+    def __init__(self):
+        self.received = 0
+
+    def detection_completed(self, device=None):
+        if device is not self:
+            return
+        self.received += 1
+
+
+def measure(name, dispatcher, signal, sender, batch=100, seconds=2.0):
+    """ batch sends per mainloop iteration """
+    count = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        for i in xrange(batch):
+            dispatcher.send(signal, sender, device=sender)
+        reactor.iterate(0)
+        count += batch
+    duration = time.time() - start
+    print "%-52s %9.0f signals/s  %6.2f us/signal" % (
+            name, count / duration, duration * 1000000 / count)
+
+
+def run(devices):
+    for dispatcher in (ListDispatcher(), SignalDispatcher()):
+        name = dispatcher.__class__.__name__
+        received = []
+        dispatcher.connect('Coherence.UPnP.SSDP.datagram_received',
+                           lambda *args, **kwargs: received.append(1))
+        all = [Device() for i in range(devices)]
+        for device in all:
+            dispatcher.connect('Coherence.UPnP.Device.detection_completed',
+                               device.detection_completed, device)
+        measure('%s, no receiver' % name, dispatcher,
+                'Coherence.UPnP.Log', None)
+        measure('%s, one receiver' % name, dispatcher,
+                'Coherence.UPnP.SSDP.datagram_received', None)
+        measure('%s, one of %d devices' % (name, devices), dispatcher,
+                'Coherence.UPnP.Device.detection_completed', all[devices / 2])
+
+
+if __name__ == '__main__':
+    devices = 200
+    if len(sys.argv) > 1:
+        devices = int(sys.argv[1])
+    run(devices)
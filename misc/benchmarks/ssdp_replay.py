@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+# ssdp_replay.py
+#
+# replays SSDP datagrams as fast as possible through
+# the SSDP message parser and through SSDPServer.datagramReceived,
+# and reports the packets per second each of them handles
+#
+# the datagrams are taken from pcap captures, e.g. made with
+#   tcpdump -i eth0 -w ssdp.pcap udp port 1900
+# or, without a capture given, from a built-in mix of alive
+# and byebye notifications, searches, responses and broken packets
+#
+# usage: ssdp_replay.py [capture.pcap ...]
+#
+
+import sys
+import time
+import struct
+
+from coherence.upnp.core import ssdp
+from coherence.upnp.core.utils import parse_http_response
+
+
+def read_pcap(path):
+    """ the UDP payloads to or from port 1900 in
+        a libpcap file with Ethernet or Linux cooked frames
+    """
+    f = open(path, 'rb')
+    header = f.read(24)
+    magic = header[:4]
+    if magic == '\xd4\xc3\xb2\xa1':
+        endian = '<'
+    elif magic == '\xa1\xb2\xc3\xd4':
+        endian = '>'
+    else:
+        raise ValueError('%s is not a pcap file' % path)
+    linktype = struct.unpack(endian + 'I', header[20:24])[0]
+    offset = {1: 14, 113: 16}.get(linktype)
+    if offset is None:
+        raise ValueError('unsupported link type %d in %s' % (linktype, path))
+    datagrams = []
+    while True:
+        record = f.read(16)
+        if len(record) < 16:
+            break
+        length = struct.unpack(endian + 'I', record[8:12])[0]
+        frame = f.read(length)
+        ip = frame[offset:]
+        if len(ip) < 20 or ord(ip[0]) >> 4 != 4 or ord(ip[9]) != 17:
+            continue
+        udp = ip[(ord(ip[0]) & 0x0f) * 4:]
+        source, destination = struct.unpack('!HH', udp[:4])
+        if ssdp.SSDP_PORT in (source, destination):
+            datagrams.append(udp[8:])
+    return datagrams
+
+
+def sample_datagrams(devices=50):
+    datagrams = []
+    for i in range(devices):
+        uuid = 'uuid:4d696e69-444c-164e-9d41-%012x' % i
+        for nt in ('upnp:rootdevice', uuid,
+                   'urn:schemas-upnp-org:device:MediaRenderer:1',
+                   'urn:schemas-upnp-org:service:AVTransport:1',
+                   'urn:schemas-upnp-org:service:RenderingControl:1'):
+            usn = nt == uuid and uuid or '%s::%s' % (uuid, nt)
+            for nts in ('ssdp:alive', 'ssdp:alive', 'ssdp:byebye'):
+                datagrams.append('\r\n'.join(['NOTIFY * HTTP/1.1',
+                                              'HOST: 239.255.255.250:1900',
+                                              'CACHE-CONTROL: max-age=1800',
+                                              'LOCATION: http://10.0.%d.%d:49152/description.xml' % (i / 250, i % 250 + 1),
+                                              'NT: %s' % nt,
+                                              'NTS: %s' % nts,
+                                              'SERVER: Linux/2.6 UPnP/1.0 Renderer/1.0',
+                                              'USN: %s' % usn, '', '']))
+            datagrams.append('\r\n'.join(['HTTP/1.1 200 OK',
+                                          'CACHE-CONTROL: max-age=1800',
+                                          'EXT:',
+                                          'LOCATION: http://10.0.%d.%d:49152/description.xml' % (i / 250, i % 250 + 1),
+                                          'SERVER: Linux/2.6 UPnP/1.0 Renderer/1.0',
+                                          'ST: %s' % nt,
+                                          'USN: %s' % usn, '', '']))
+        """ cheap devices with LF only lines and lowercase headers """
+        datagrams.append(datagrams[-2].replace('\r\n', '\n').lower())
+        datagrams.append('\r\n'.join(['M-SEARCH * HTTP/1.1',
+                                      'HOST: 239.255.255.250:1900',
+                                      'MAN: "ssdp:discover"',
+                                      'MX: 3',
+                                      'ST: urn:schemas-upnp-org:device:MediaServer:1', '', '']))
+        datagrams.append('NOTIFY * HTTP/1.1\r\nNT upnp:rootdevice\r\n\r\n')
+        datagrams.append('\x00\x01garbage' * 10)
+    return datagrams
+
+
+def measure(name, f, datagrams, seconds=2.0):
+    count = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        for data in datagrams:
+            try:
+                f(data)
+            except Exception:
+                pass
+        count += len(datagrams)
+    duration = time.time() - start
+    print "%-36s %8.0f packets/s  %6.2f us/packet" % (
+            name, count / duration, duration * 1000000 / count)
+
+
+def run(datagrams):
+    print "%d datagrams, %d bytes" % (len(datagrams), sum(map(len, datagrams)))
+    measure('parse_http_response (old parser)', parse_http_response, datagrams)
+    measure('ssdp.parse_message', ssdp.parse_message, datagrams)
+
+    """ keep the known devices constant between the runs
+        and don't let the searches send anything
+    """
+    server = ssdp.SSDPServer(test=True)
+    server.known = {}
+    server.queue_responses = lambda *args: None
+    sender = ('10.0.0.1', ssdp.SSDP_PORT)
+    measure('SSDPServer.datagramReceived',
+            lambda data: server.datagramReceived(data, sender), datagrams)
+    print "dropped %d of %d datagrams as malformed" % (server.malformed, server.received)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        datagrams = []
+        for path in sys.argv[1:]:
+            datagrams.extend(read_pcap(path))
+    else:
+        datagrams = sample_datagrams()
+    run(datagrams)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+# static_file_transfer.py
+#
+# measures throughput and server CPU time per stream
+# when serving a file with utils.StaticFile to several
+# clients at once, with and without sendfile
+#
+# usage: static_file_transfer.py [size in MB] [number of streams]
+#
+
+import os
+import sys
+import time
+import socket
+import tempfile
+import threading
+
+from twisted.internet import reactor
+from twisted.web import resource
+
+from coherence.upnp.core import utils
+
+
+def serve(path, streams, use_sendfile, ready, report):
+    """ runs in the forked server process,
+        stops after streams requests are done
+        and reports its cpu time
+    """
+    utils.StaticFile.use_sendfile = use_sendfile
+
+    transports = []
+    def check_done():
+        """ with read/write the data may still be buffered
+            after the request is finished, so we wait for
+            the connections to be closed
+        """
+        if(len(transports) == streams and
+           len([t for t in transports if not t.disconnected]) == 0):
+            reactor.stop()
+        else:
+            reactor.callLater(0.01, check_done)
+
+    class CountingStaticFile(utils.StaticFile):
+        def render(self, request):
+            transports.append(request.transport)
+            return utils.StaticFile.render(self, request)
+
+    root = resource.Resource()
+    root.putChild('file', CountingStaticFile(path))
+    port = reactor.listenTCP(0, utils.Site(root), interface='127.0.0.1')
+    os.write(ready, '%d\n' % port.getHost().port)
+    start = os.times()
+    reactor.callLater(0.01, check_done)
+    reactor.run()
+    end = os.times()
+    os.write(report, '%f\n' % ((end[0] - start[0]) + (end[1] - start[1])))
+
+
+def fetch(port, result):
+    s = socket.create_connection(('127.0.0.1', port))
+    s.sendall('GET /file HTTP/1.0\r\nHost: 127.0.0.1\r\n\r\n')
+    received = 0
+    while True:
+        data = s.recv(256*1024)
+        if not data:
+            break
+        received += len(data)
+    s.close()
+    result.append(received)
+
+
+def run(path, size, streams, use_sendfile):
+    ready_r, ready_w = os.pipe()
+    report_r, report_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            serve(path, streams, use_sendfile, ready_w, report_w)
+        finally:
+            os._exit(0)
+
+    port = int(os.fdopen(ready_r).readline())
+    result = []
+    threads = [threading.Thread(target=fetch, args=(port, result))
+               for i in range(streams)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duration = time.time() - start
+    cpu = float(os.fdopen(report_r).readline())
+    os.waitpid(pid, 0)
+
+    received = sum(result)
+    mb = received / (1024.0*1024.0)
+    print "%-10s %d streams, %.1f MB in %.2fs: %.1f MB/s total, %.1f MB/s per stream" % (
+            use_sendfile and 'sendfile' or 'read/write',
+            streams, mb, duration, mb / duration, mb / duration / streams)
+    print "%-10s server cpu %.2fs, %.3fs per stream, %.3fs per GB" % (
+            '', cpu, cpu / streams, cpu / (mb / 1024.0))
+
+
+if __name__ == '__main__':
+    size = 256
+    streams = 4
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        streams = int(sys.argv[2])
+
+    fd, path = tempfile.mkstemp()
+    block = os.urandom(1024*1024)
+    for i in range(size):
+        os.write(fd, block)
+    os.close(fd)
+
+    try:
+        if utils.sendfile is None:
+            print "no sendfile available on this system"
+        else:
+            run(path, size, streams, True)
+        run(path, size, streams, False)
+    finally:
+        os.unlink(path)